@@ -1,30 +1,75 @@
 # agents/classifier_agent.py
+import hashlib
 import json
+import logging
 import re
-import uuid
-from typing import Dict, Any
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+from agents.formatmodel import FormatModel
+from agents.registry import route_for
+from document import Document, read_document
 from memory import SharedMemory  # Import your SharedMemory class
+from metrics import metrics
 # from llm_integration import LLM  # Assuming you have a module for LLM interaction
 
+logger = logging.getLogger(__name__)
+
+# Header lines that mark the start of an email.
+_EMAIL_HEADER = re.compile(r"^\W*(From|Sender|To|Subject|Date|Return-Path|Received|MIME-Version):",
+                           re.IGNORECASE | re.MULTILINE)
+
+# Intents the LLM tier may answer with, and the format each implies.
+_INTENT_FORMATS = {
+    "process_plain_invoice": "plain_invoice",
+    "process_json_invoice": "json",
+    "process_email_invoice": "email",
+}
+
 class InvoiceClassifierAgent:
-    def __init__(self, memory: SharedMemory, llm=None):
+    PROMPT_VERSION = "intent-v1"
+
+    def __init__(self, memory: SharedMemory, llm=None, model: FormatModel = None,
+                 confidence_threshold: float = 0.75, cache=None, cache_size: int = 4096):
         """
         Initializes the InvoiceClassifierAgent, focused on invoice processing.
 
+        Formats are decided by a cascade: cheap rules first, then the local
+        `model`, and the LLM only for documents neither is confident about.
+
         Args:
             memory: An instance of the SharedMemory class for logging.
-            llm: An instance of your LLM integration class (optional).
+            llm: An instance of your LLM integration class (optional); an
+                LLMClient or anything with generate_response(prompt).
+            model: A trained FormatModel (optional).
+            confidence_threshold: Answers below this confidence go on to the
+                next tier.
+            cache: An ExtractionCache to keep LLM answers across runs (optional).
+            cache_size: How many LLM answers to keep in process.
         """
         self.memory = memory
         self.llm = llm
+        self.model = model
+        self.confidence_threshold = confidence_threshold
+        self.cache = cache
+        self.cache_size = cache_size
+        self._llm_answers = OrderedDict()
+        # The pipeline classifies from several threads at once.
+        self._llm_answers_lock = threading.Lock()
 
-    def classify_invoice(self, raw_input: str, interaction_id: str) -> Dict[str, str]:
+    def classify_invoice(self, raw_input: Union[str, Document], interaction_id: str) -> Dict[str, str]:
         """
         Classifies the format of the raw input as it relates to invoices
         and attempts to determine a specific invoice processing intent.
 
+        When given a Document (see read_document), the classifier records
+        the detected format on it and keeps anything it parsed, so the agent
+        it is routed to can reuse it instead of parsing again.
+
         Args:
-            raw_input: The raw input string (content of file, email, or JSON).
+            raw_input: The raw input string (content of file, email, or JSON),
+                or a Document.
             interaction_id: A unique ID for this interaction.
 
         Returns:
@@ -32,15 +77,19 @@ class InvoiceClassifierAgent:
             invoice processing intent (e.g., "process_plain_invoice",
             "process_json_invoice", "process_email_invoice").
         """
-        format = self._detect_invoice_format(raw_input)
-        #intent = self._classify_invoice_intent_with_llm(raw_input, format) if self.llm else f"process_{format}_invoice"
+        document = Document.from_text(raw_input)
+        with metrics.span("classify", interaction_id, "classifier_agent"):
+            format, confidence, tier = self._classify_format(document)
+        document.format = format
+        metrics.incr("documents_classified", format=format, tier=tier)
 
         self.memory.store_data(interaction_id, "invoice_format", format)
-        #self.memory.store_data(interaction_id, "invoice_intent", intent)
-        return {"format": format}
-        # return {"format": format, "intent": intent}
+        self.memory.store_data(interaction_id, "format_confidence", confidence)
+        self.memory.store_data(interaction_id, "classification_tier", tier)
+        self.memory.store_data(interaction_id, "document_sniff", document.sniff)
+        return {"format": format, "confidence": confidence, "tier": tier}
 
-    def route_invoice(self, raw_input: str, classification: Dict[str, str], interaction_id: str) -> str or None:
+    def route_invoice(self, raw_input: str, classification: Dict[str, str], interaction_id: str) -> Optional[str]:
         """
         Routes the input to the appropriate invoice processing agent
         based on the classification.
@@ -54,106 +103,150 @@ class InvoiceClassifierAgent:
             The name of the agent to route to (e.g., "invoice_agent", "json_agent", "email_agent"),
             or None if no suitable agent is found.
         """
-        format = classification.get("format")
-        # intent = classification.get("intent")
-
-        # if format == "plain_invoice" and "plain" in intent:
-        #     return "invoice_agent"
-        # elif format == "json" and "json" in intent:
-        #     return "json_agent"
-        # elif format == "email" and "email" in intent:
-        #     return "email_agent"
-        # return None
-
-        if format == "plain_invoice":
-            return "invoice_agent"
-        elif format == "json":
-            return "json_agent"
-        elif format == "email":
-            return "email_agent"
-        else:
-            return None
+        return route_for(classification.get("format"))
 
-    def _detect_invoice_format(self, raw_input: str) -> str:
+    def _detect_invoice_format(self, raw_input: Union[str, Document]) -> str:
         """
         Detects the format of the input, specifically for invoices.
 
         Args:
-            raw_input: The raw input string.
+            raw_input: The raw input string, or a Document.
 
         Returns:
-            The detected format ("json", "email", "plain_invoice", or "unknown").
+            The detected format ("json", "email", "plain_invoice", "pdf" or "unknown").
         """
-        if raw_input.startswith("{") and raw_input.endswith("}"):
+        return self._classify_format(Document.from_text(raw_input))[0]
+
+    def _classify_format(self, document: Document) -> Tuple[str, float, str]:
+        """
+        Runs the classification cascade and returns (format, confidence, tier),
+        where tier is the stage that decided: "rules", "model" or "llm".
+        """
+        format, confidence = self._apply_rules(document)
+        tier = "rules"
+        if confidence < self.confidence_threshold and self.model is not None:
+            predicted, probability = self.model.predict(document.head)
+            # Only the rules can vouch for JSON: they have tried to parse it.
+            if predicted == "json" and document.parsed is None:
+                predicted = None
+            if predicted is not None and probability > confidence:
+                format, confidence, tier = predicted, probability, "model"
+        if confidence < self.confidence_threshold and self.llm is not None:
+            intent = self._classify_invoice_intent_with_llm(document.head, format)
+            if intent in _INTENT_FORMATS:
+                format, confidence, tier = _INTENT_FORMATS[intent], self.confidence_threshold, "llm"
+        return format, confidence, tier
+
+    def _apply_rules(self, document: Document) -> Tuple[str, float]:
+        """
+        The cheap first tier. The email and plain-text rules only look at the
+        document's sniffed prefix; the JSON rule parses the document once and
+        leaves the result on it for JSONAgent.
+        """
+        sniff = document.sniff
+        if sniff["is_pdf"]:
+            # PDFs are recognised by their magic bytes and never decoded here.
+            return "pdf", 1.0
+        if sniff["first_char"] in ("{", "["):
             try:
-                json.loads(raw_input)
+                document.json()
                 # Add more specific checks for invoice-related fields in JSON if needed
-                return "json"
+                return "json", 1.0
             except json.JSONDecodeError:
-                pass
-        elif "From:" in raw_input and "Invoice Number:" in raw_input:
-            return "email"
-        elif "Invoice Number:" in raw_input :
-            return "plain_invoice"
-        return "unknown"
-
-    def read_file_content(file_path: str) -> str or None:
-        """Helper method to read content from a file."""
-        try:
-            with open(file_path, 'r') as f:
-                return f.read()
-        except FileNotFoundError:
-            print(f"Error: File not found at {file_path}")
-            return None
-        except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
+                # Looked like JSON but is not; let the later tiers decide.
+                return "unknown", 0.0
+        if sniff["has_invoice_number"]:
+            if sniff["has_from_header"]:
+                # A From: line in the header block is an email; one further
+                # down may just be quoted text in a plain invoice.
+                header_block = document.head.lstrip().split("\n\n", 1)[0]
+                if _EMAIL_HEADER.search(header_block):
+                    return "email", 0.95
+                return "email", 0.6
+            return "plain_invoice", 0.9
+        return "unknown", 0.0
+
+    def read_file_content(file_path: str, encoding: str = None) -> Optional[str]:
+        """Helper method to read content from a file. See read_document for
+        reading it as a Document instead."""
+        document = read_document(file_path, encoding=encoding)
+        if document is None:
             return None
+        with document:
+            return document.text
 
-    # def _classify_invoice_intent_with_llm(self, raw_input: str, format: str) -> str:
-    #     """
-    #     Classifies the specific invoice processing intent of the input using an LLM.
-    #
-    #     Args:
-    #         raw_input: The raw input string.
-    #         format: The detected format of the input.
-    #
-    #     Returns:
-    #         The predicted specific invoice processing intent as a string.
-    #     """
-    #     if not self.llm:
-    #         return f"process_{format}_invoice"
-    #
-    #     prompt = f"""You are an expert at classifying the specific processing intent for invoice data.
-    #     The input is in '{format}' format. Analyze the content and determine the specific action to take
-    #     related to invoice processing.
-    #
-    #     Possible intents: process_plain_invoice, process_json_invoice, process_email_invoice, extract_details.
-    #
-    #     Input:
-    #     ```
-    #     {raw_input}
-    #     ```
-    #
-    #     Specific Invoice Processing Intent: """
-    #
-    #     try:
-    #         llm_response = self.llm.generate_response(prompt)
-    #         predicted_intent = llm_response.strip().lower().replace(" ", "_")
-    #         return predicted_intent
-    #     except Exception as e:
-    #         print(f"Error during LLM invoice intent classification: {e}")
-    #         return f"process_{format}_invoice_failed"
+    def _classify_invoice_intent_with_llm(self, raw_input: str, format: str) -> str:
+        """
+        Classifies the specific invoice processing intent of the input using an LLM.
+        Answers are cached by content, in process and in `self.cache` if set.
 
-# Example of LLM integration (assuming you have a class for this)
-from dotenv import load_dotenv
-import os
-import google.generativeai as genai
+        Args:
+            raw_input: The raw input string (the document's leading text is enough).
+            format: The detected format of the input.
+
+        Returns:
+            The predicted specific invoice processing intent as a string.
+        """
+        if not self.llm:
+            return f"process_{format}_invoice"
+
+        model_name = getattr(self.llm, "model_name", type(self.llm).__name__)
+        key = hashlib.sha256(f"{self.PROMPT_VERSION}\0{model_name}\0{raw_input}".encode("utf-8")).hexdigest()
+        with self._llm_answers_lock:
+            predicted_intent = self._llm_answers.get(key)
+        if predicted_intent is None and self.cache is not None:
+            predicted_intent = self.cache.get(key)
+        if predicted_intent is not None:
+            metrics.incr("classifier_llm_cache", result="hit")
+            self._remember_intent(key, predicted_intent)
+            return predicted_intent
+        metrics.incr("classifier_llm_cache", result="miss")
+
+        prompt = f"""You are an expert at classifying the specific processing intent for invoice data.
+        The input is in '{format}' format. Analyze the content and determine the specific action to take
+        related to invoice processing.
 
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+        Possible intents: process_plain_invoice, process_json_invoice, process_email_invoice, extract_details.
 
+        Input:
+        ```
+        {raw_input}
+        ```
+
+        Specific Invoice Processing Intent: """
+
+        try:
+            generate = getattr(self.llm, "generate", None) or self.llm.generate_response
+            llm_response = generate(prompt)
+            predicted_intent = llm_response.strip().lower().replace(" ", "_")
+        except Exception as e:
+            logger.error("Error during LLM invoice intent classification: %s", e)
+            metrics.incr("errors", kind="llm_classify", agent="classifier_agent")
+            return f"process_{format}_invoice_failed"
+
+        if predicted_intent:
+            self._remember_intent(key, predicted_intent)
+            if self.cache is not None:
+                self.cache.put(key, predicted_intent)
+        return predicted_intent
+
+    def _remember_intent(self, key: str, intent: str):
+        with self._llm_answers_lock:
+            self._llm_answers[key] = intent
+            self._llm_answers.move_to_end(key)
+            if len(self._llm_answers) > self.cache_size:
+                self._llm_answers.popitem(last=False)
+
+# Example of LLM integration (assuming you have a class for this)
 class LLM:
-    def __init__(self, api_key=GEMINI_API_KEY, model_name="gemini-pro"):
+    def __init__(self, api_key=None, model_name="gemini-pro"):
+        # The SDK and .env are only loaded once an LLM is actually wanted.
+        import os
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        api_key = api_key or os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable not set.")
         genai.configure(api_key=api_key)
@@ -165,7 +258,7 @@ class LLM:
             # Gemini returns a response object, the text is in response.text
             return response.text
         except Exception as e:
-            print(f"Error generating response from Gemini: {e}")
+            logger.error("Error generating response from Gemini: %s", e)
             return ""
 
 # shared_memory_instance = SharedMemory()  # Create an instance
@@ -1,194 +1,152 @@
 # agents/invoice_email_agent.py
 import re
-from typing import Dict, Any
+import uuid
+from email.header import decode_header, make_header
+from email.message import Message
+from email.utils import parseaddr
+from typing import Dict, Any, BinaryIO, Iterator, Optional, Tuple, Union
 from datetime import datetime
 import json
+from agents.invoicetemplate import extract_invoice_details, parse_date
+from document import Document, as_text
+from invoicerecord import InvoiceRecord, to_jsonable, to_plain
+from mailreader import email_body, iter_messages, iter_invoice_texts
+from metrics import metrics
+
+_SENDER = re.compile(r"(From:|Sender:)\s*([^\n<>]+(?:<[^>]+>)?[^\n]*)", re.IGNORECASE)
+_ANGLE_ADDRESS = re.compile(r"<([^>]+)>")
+_SUBJECT = re.compile(r"Subject:\s*(.+)", re.IGNORECASE)
+
 class EmailAgent:
     def __init__(self, memory):
         self.memory = memory
-    def process_email(self, email_content: str, interaction_id: str) -> Dict[str, Any]:
+    def process_email(self, email_content: Union[str, Document], interaction_id: str) -> Dict[str, Any]:
         """
         Accepts full email content (including headers), extracts sender, subject,
         invoice details from the body, and formats it for CRM-style usage.
         """
-        sender = self._extract_sender(email_content)
-        subject = self._extract_subject(email_content)
-        invoice_details = self._extract_invoice_details(self._extract_email_body(email_content))
+        email_content = as_text(email_content)
+        with metrics.span("extract", interaction_id, "email_agent"):
+            sender = self._extract_sender(email_content)
+            subject = self._extract_subject(email_content)
+            invoice_details = self._extract_invoice_details(self._extract_email_body(email_content))
+        return self._build_results(sender, subject, invoice_details, email_content, interaction_id)
+
+    def process_message(self, message: Message, interaction_id: str, body: str = None) -> Dict[str, Any]:
+        """
+        Processes an already-parsed email message (see mailreader.iter_messages).
+        Sender and subject come from the parsed headers, and the invoice is read
+        from `body` or else the first text part that carries one. raw_content
+        is None, since the message was never held as a single string.
+        """
+        with metrics.span("extract", interaction_id, "email_agent"):
+            sender = parseaddr(str(message.get("From", "")))[1] or None
+            subject = message.get("Subject")
+            if subject is not None:
+                subject = str(make_header(decode_header(subject)))
+            if body is None:
+                body = next(iter_invoice_texts(message), "")
+            invoice_details = self._extract_invoice_details(body)
+        return self._build_results(sender, subject, invoice_details, None, interaction_id)
+
+    def process_mailbox(self, source: Union[str, BinaryIO]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Streams an mbox file (or a single message file) and processes each
+        message that carries an invoice, one at a time.
+
+        Args:
+            source: A path, or a file object opened in binary mode.
 
+        Yields:
+            (interaction_id, processing_results) for each invoice message.
+        """
+        for message in iter_messages(source):
+            body = next(iter_invoice_texts(message), None)
+            if body is None:
+                metrics.incr("emails_skipped", reason="no_invoice_part")
+                continue
+            interaction_id = str(uuid.uuid4())
+            self.memory.initialize_context(interaction_id)
+            yield interaction_id, self.process_message(message, interaction_id, body)
+
+    def _build_results(self, sender: Optional[str], subject: Optional[str], invoice_details: Dict[str, Any],
+                       raw_content: Optional[str], interaction_id: str) -> Dict[str, Any]:
+        # The details become one slotted record with columnar line items;
+        # shared memory keeps the record, callers get plain dicts and lists.
         extracted_data = {
             "sender": sender,
             "subject": subject,
-            "invoice_details": invoice_details,
-            "raw_content": email_content,  # Keep the full content if needed
+            "invoice_details": InvoiceRecord.from_details(invoice_details),
+            "raw_content": raw_content,
         }
 
-        crm_formatted_data = self._format_for_crm(extracted_data)
+        with metrics.span("format", interaction_id, "email_agent"):
+            crm_formatted_data = self._format_for_crm(extracted_data)
 
-        processing_results = {
+
+        # Shared memory keeps a compact record: the caller already holds the
+        # email, so the raw_content copy is left out of the stored results.
+        self.memory.store_data(interaction_id, 'invoice_email_processing_results', {
+            "extracted_data": {k: v for k, v in extracted_data.items() if k != "raw_content"},
+            "crm_formatted_data": crm_formatted_data
+        })
+        return to_plain({
             "extracted_data": extracted_data,
             "crm_formatted_data": crm_formatted_data
-        }
-
-        self.memory.store_data(interaction_id, 'invoice_email_processing_results', processing_results)
-        return processing_results
+        })
 
-    def _extract_sender(self, email_content: str) -> str or None:
+    def _extract_sender(self, email_content: str) -> Optional[str]:
         """Extracts the sender's email address or name from the content."""
-        sender_match = re.search(r"(From:|Sender:)\s*([^\n<>]+(?:<[^>]+>)?[^\n]*)", email_content, re.IGNORECASE)
+        sender_match = _SENDER.search(email_content)
         if sender_match:
             sender_info = sender_match.group(2).strip()
-            email_match = re.search(r"<([^>]+)>", sender_info)
+            email_match = _ANGLE_ADDRESS.search(sender_info)
             if email_match:
                 return email_match.group(1)
             return sender_info.split()[0] if sender_info.split() else sender_info
         return None
 
-    def _extract_subject(self, email_content: str) -> str or None:
+    def _extract_subject(self, email_content: str) -> Optional[str]:
         """Extracts the subject line from the email content."""
-        subject_match = re.search(r"Subject:\s*(.+)", email_content, re.IGNORECASE)
+        subject_match = _SUBJECT.search(email_content)
         return subject_match.group(1).strip() if subject_match else None
 
     def _extract_email_body(self, email_content: str) -> str:
-        """Simple extraction of the email body after the headers.
-        This might need more sophisticated handling for different email formats."""
-        body_parts = email_content.split("\n\n", 1)  # Split at the first double newline
-        return body_parts[1] if len(body_parts) > 1 else email_content
+        """Extracts the email body after the headers. For MIME multipart
+        messages this is the first text part that carries an invoice."""
+        return email_body(email_content)
 
     def _extract_invoice_details(self, email_body: str) -> Dict[str, Any]:
         """Extracts invoice details from the specifically formatted email body."""
-        details = {
-            "items": []  # CRITICAL FIX: Initialize items list here
-        }
+        return extract_invoice_details(email_body)
 
-        # Extract Invoice Number
-        invoice_number_match = re.search(r"Invoice Number:\s*(.+)", email_body)
-        details["invoice_number"] = invoice_number_match.group(1).strip() if invoice_number_match else None
-
-        # Extract Invoice Date
-        invoice_date_match = re.search(r"Invoice Date:\s*(.+)", email_body)
-        details["invoice_date"] = self._parse_date(invoice_date_match.group(1).strip()) if invoice_date_match else None
-
-        # Extract Seller/Vendor Details
-        seller_match = re.search(
-            r"Seller/Vendor:\s*Name:\s*(.+)\s*Address:\s*(.+)\s*Tax ID:\s*(.+)",
-            email_body,
-            re.DOTALL
-        )
-        if seller_match:
-            details["vendor"] = {
-                "name": seller_match.group(1).strip(),
-                "address": seller_match.group(2).strip(),
-                "tax_id": seller_match.group(3).strip(),
-            }
-        else:
-            details["vendor"] = {}  # Ensure vendor is always a dict
-
-        # Extract Buyer/Customer Details
-        buyer_match = re.search(
-            r"Buyer/Customer:\s*Name:\s*(.+)\s*Address:\s*(.+)\s*Tax ID:\s*(.+)",
-            email_body,
-            re.DOTALL
-        )
-        if buyer_match:
-            details["customer"] = {
-                "name": buyer_match.group(1).strip(),
-                "address": buyer_match.group(2).strip(),
-                "tax_id": buyer_match.group(3).strip(),
-            }
-        else:
-            details["customer"] = {}  # Ensure customer is always a dict
-
-        # Extract Line Items
-        if "-------------------- LINE ITEMS -------------------" in email_body:
-            line_items_parts = email_body.split("-------------------- LINE ITEMS -------------------")
-            if len(line_items_parts) > 1:
-                item_table_part = line_items_parts[1].split("--------------------------------------------------")
-                if len(item_table_part) > 0:
-                    raw_items_text = item_table_part[0]
-                    # Refined regex for line items to handle potential extra spaces and ensure correct capture
-                    # This regex is still sensitive to column alignment
-                    line_item_matches = re.findall(
-                        r"^\s*(.+?)\s+(\d+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s*$",  # Added ^ $ to match whole line
-                        raw_items_text, re.MULTILINE  # Use MULTILINE to match ^ $ on each line
-                    )
-                    for item in line_item_matches:
-                        try:
-                            line_item_data = {
-                                "description": item[0].strip(),
-                                "quantity": int(item[1]),
-                                "unit_price": float(item[2]),
-                                "amount": float(item[3]),
-                                "tax": float(item[4]),
-                            }
-                            details["items"].append(line_item_data)
-                        except ValueError as e:
-                            print(f"Error parsing line item numerical data: {e} for item: {item}")
-                            # You might want to log this item as an anomaly instead of skipping
-                else:
-                    print("Warning: End of line items separator not found.")
-            else:
-                print("Warning: Start of line items separator found but no content after.")
-        else:
-            print("Warning: Line items section not found in email body.")
-
-        # Extract Totals
-        totals_match = re.search(
-            r"---------------------- TOTALS ----------------------\s*"
-            r"Subtotal:\s*([\d\.]+)\s*"
-            r"Discount:\s*([\d\.]+)\s*"
-            r"Total Tax Amount:\s*([\d\.]+)\s*"
-            r"Shipping/Handling:\s*([\d\.]+)\s*"
-            r"--------------------------------------------------\s*"
-            r"Total Amount Due:\s*([\d\.]+)\s*"
-            r"Currency:\s*(\w+)",
-            email_body,
-            re.DOTALL
-        )
-        if totals_match:
-            try:
-                details["subtotal"] = float(totals_match.group(1))
-                details["discount"] = float(totals_match.group(2))
-                details["total_tax_amount"] = float(totals_match.group(3))
-                details["shipping_handling"] = float(totals_match.group(4))
-                details["total_amount_due"] = float(totals_match.group(5))
-                details["currency"] = totals_match.group(6).strip()
-            except ValueError as e:
-                print(f"Error parsing total numerical data: {e} for totals match: {totals_match.groups()}")
-                # You might want to log this as an anomaly
-        # No 'else: details["totals"] = {}' needed here, as fields will be None if not found/parsed
-
-        return details
-
-    def _parse_date(self, date_str: str) -> str or None:
+    def _parse_date(self, date_str: str) -> Optional[str]:
         """Attempts to parse a date string into YYYY-MM-DD format."""
-        formats = ["%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y"]
-        for fmt in formats:
-            try:
-                return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
-            except ValueError:
-                continue
-        return None
+        return parse_date(date_str)
 
     def _format_for_crm(self, extracted_data: Dict[str, Any]) -> Dict[str, Any]:
         """Formats the extracted invoice data into a CRM-friendly structure."""
+        details = extracted_data.get("invoice_details") or {}
+        vendor = details.get("vendor") or {}
+        customer = details.get("customer") or {}
         crm_data = {
             "email_sender": extracted_data.get("sender"),
             "email_subject": extracted_data.get("subject"),
-            "invoice_number": extracted_data.get("invoice_details", {}).get("invoice_number"),
-            "invoice_date": extracted_data.get("invoice_details", {}).get("invoice_date"),
-            "vendor_name": extracted_data.get("invoice_details", {}).get("vendor", {}).get("name"),
-            "vendor_address": extracted_data.get("invoice_details", {}).get("vendor", {}).get("address"),
-            "vendor_tax_id": extracted_data.get("invoice_details", {}).get("vendor", {}).get("tax_id"),
-            "customer_name": extracted_data.get("invoice_details", {}).get("customer", {}).get("name"),
-            "customer_address": extracted_data.get("invoice_details", {}).get("customer", {}).get("address"),
-            "customer_tax_id": extracted_data.get("invoice_details", {}).get("customer", {}).get("tax_id"),
-            "line_items": extracted_data.get("invoice_details", {}).get("items"),
-            "subtotal": extracted_data.get("invoice_details", {}).get("subtotal"),
-            "discount": extracted_data.get("invoice_details", {}).get("discount"),
-            "total_tax_amount": extracted_data.get("invoice_details", {}).get("total_tax_amount"),
-            "shipping_handling": extracted_data.get("invoice_details", {}).get("shipping_handling"),
-            "total_amount_due": extracted_data.get("invoice_details", {}).get("total_amount_due"),
-            "currency": extracted_data.get("invoice_details", {}).get("currency"),
+            "invoice_number": details.get("invoice_number"),
+            "invoice_date": details.get("invoice_date"),
+            "vendor_name": vendor.get("name"),
+            "vendor_address": vendor.get("address"),
+            "vendor_tax_id": vendor.get("tax_id"),
+            "customer_name": customer.get("name"),
+            "customer_address": customer.get("address"),
+            "customer_tax_id": customer.get("tax_id"),
+            "line_items": details.get("items"),
+            "subtotal": details.get("subtotal"),
+            "discount": details.get("discount"),
+            "total_tax_amount": details.get("total_tax_amount"),
+            "shipping_handling": details.get("shipping_handling"),
+            "total_amount_due": details.get("total_amount_due"),
+            "currency": details.get("currency"),
             "email_received_at": datetime.now().isoformat(),
             "status": "New", # Default status
             "assigned_to": None,
@@ -243,5 +201,5 @@ Currency:              USD
  """
 #
     results = invoice_email_agent.process_email(dummy_full_invoice_email, interaction_id)
-    print(json.dumps(results, indent=2, default=str))
+    print(json.dumps(results, indent=2, default=to_jsonable))
     memory.print_all_memory()
\ No newline at end of file
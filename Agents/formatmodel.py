@@ -0,0 +1,211 @@
+# agents/formatmodel.py
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import zlib
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Features are hashed into this many buckets, so the model's size does not
+# grow with the vocabulary of the training data.
+FEATURE_BUCKETS = 1 << 18
+
+# Only this many leading characters are looked at.
+MAX_CHARS = 4096
+
+# Words, numbers and runs of punctuation; numbers are reduced to their shape.
+_TOKEN = re.compile(r"[a-z]+|\d+|[^\sa-z\d]+")
+_DIGITS = re.compile(r"\d+")
+_HEADER_LINE = re.compile(r"^([a-z][a-z-]*):", re.IGNORECASE | re.MULTILINE)
+
+
+@lru_cache(maxsize=1 << 16)
+def _token_hash(token: str) -> int:
+    # crc32 rather than hash() so the buckets are the same in every process.
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def _bucket(feature: str) -> int:
+    return _token_hash(feature) % FEATURE_BUCKETS
+
+
+def extract_features(text: str) -> Dict[int, float]:
+    """
+    Maps the first MAX_CHARS characters of `text` to a sparse feature
+    vector: hashed token unigrams and bigrams scaled to unit length, plus
+    unscaled structural features (the "Label:" lines of the leading block
+    and the first non-blank character) that separate the formats best.
+    """
+    head = text[:MAX_CHARS]
+    tokens = _TOKEN.findall(_DIGITS.sub("0", head.lower()))
+    features = {}
+    previous = 0
+    for token in tokens:
+        current = _token_hash(token)
+        # Bigrams combine the two token hashes instead of hashing a new string.
+        for index in (current % FEATURE_BUCKETS, ((previous * 1000003) ^ current) % FEATURE_BUCKETS):
+            features[index] = features.get(index, 0.0) + 1.0
+        previous = current
+    if features:
+        norm = math.sqrt(sum(v * v for v in features.values()))
+        features = {k: v / norm for k, v in features.items()}
+
+    stripped = head.lstrip()
+    features[_bucket("first:" + stripped[:1])] = 1.0
+    leading_block = stripped.split("\n\n", 1)[0]
+    for label in set(_HEADER_LINE.findall(leading_block)):
+        features[_bucket("h:" + label.lower())] = 1.0
+    return features
+
+
+class FormatModel:
+    def __init__(self, labels: List[str] = None, weights: Dict[str, Dict[int, float]] = None,
+                 bias: Dict[str, float] = None):
+        """
+        A multinomial logistic regression over hashed n-gram features,
+        small enough to score a document in microseconds.
+
+        Args:
+            labels: The formats the model can predict.
+            weights: Sparse per-label weights, keyed by feature bucket.
+            bias: Per-label bias terms.
+        """
+        self.labels = list(labels or [])
+        self.weights = weights or {label: {} for label in self.labels}
+        self.bias = bias or {label: 0.0 for label in self.labels}
+
+    def _scores(self, features: Dict[int, float]) -> Dict[str, float]:
+        scores = {}
+        for label in self.labels:
+            weights = self.weights[label]
+            score = self.bias[label]
+            for index, value in features.items():
+                weight = weights.get(index)
+                if weight is not None:
+                    score += weight * value
+            scores[label] = score
+        return scores
+
+    @staticmethod
+    def _softmax(scores: Dict[str, float]) -> Dict[str, float]:
+        top = max(scores.values())
+        exps = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exps.values())
+        return {label: value / total for label, value in exps.items()}
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """Returns (format, probability) for `text`, or (None, 0.0) for an untrained model."""
+        if not self.labels:
+            return None, 0.0
+        probabilities = self._softmax(self._scores(extract_features(text)))
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def train(self, samples: Iterable[Tuple[str, str]], epochs: int = 10, learning_rate: float = 0.5,
+              seed: int = 0) -> "FormatModel":
+        """
+        Fits the model with stochastic gradient descent.
+
+        Args:
+            samples: (text, format) pairs.
+            epochs: Passes over the samples.
+            learning_rate: Step size, decayed linearly over the epochs.
+            seed: Seed for the shuffle between epochs.
+        """
+        data = [(extract_features(text), label) for text, label in samples]
+        for _, label in data:
+            if label not in self.weights:
+                self.labels.append(label)
+                self.weights[label] = {}
+                self.bias[label] = 0.0
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate * (1 - epoch / epochs)
+            for features, target in data:
+                probabilities = self._softmax(self._scores(features))
+                for label in self.labels:
+                    gradient = probabilities[label] - (1.0 if label == target else 0.0)
+                    if abs(gradient) < 1e-6:
+                        continue
+                    step = rate * gradient
+                    weights = self.weights[label]
+                    for index, value in features.items():
+                        weights[index] = weights.get(index, 0.0) - step * value
+                    self.bias[label] -= step
+        return self
+
+    def accuracy(self, samples: Iterable[Tuple[str, str]]) -> float:
+        results = [self.predict(text)[0] == label for text, label in samples]
+        return sum(results) / len(results) if results else 0.0
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({
+                "buckets": FEATURE_BUCKETS,
+                "labels": self.labels,
+                "bias": self.bias,
+                "weights": {label: {str(k): round(v, 6) for k, v in weights.items() if abs(v) > 1e-6}
+                            for label, weights in self.weights.items()},
+            }, f)
+
+    @classmethod
+    def load(cls, path: str) -> "FormatModel":
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("buckets") != FEATURE_BUCKETS:
+            raise ValueError(f"Model {path} was trained with {data.get('buckets')} feature buckets, "
+                             f"expected {FEATURE_BUCKETS}.")
+        weights = {label: {int(k): v for k, v in w.items()} for label, w in data["weights"].items()}
+        return cls(data["labels"], weights, data["bias"])
+
+
+def load_labelled_samples(directory: str) -> List[Tuple[str, str]]:
+    """
+    Reads training samples laid out as <directory>/<format>/<file>, e.g.
+    samples/email/e1.txt, samples/json/j1.json.
+    """
+    from document import read_document
+
+    samples = []
+    for label in sorted(os.listdir(directory)):
+        label_dir = os.path.join(directory, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for name in sorted(os.listdir(label_dir)):
+            document = read_document(os.path.join(label_dir, name))
+            if document is not None:
+                with document:
+                    samples.append((document.text[:MAX_CHARS], label))
+    return samples
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Train the local invoice format model.")
+    parser.add_argument("samples", help="Directory with one sub-directory of example files per format.")
+    parser.add_argument("-o", "--output", default="format_model.json", help="Where to write the model.")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--holdout", type=float, default=0.2,
+                        help="Fraction of the samples kept back to report accuracy.")
+    args = parser.parse_args(argv)
+
+    samples = load_labelled_samples(args.samples)
+    if not samples:
+        print(f"No samples found under {args.samples}", file=sys.stderr)
+        return 1
+    random.Random(0).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train, test = samples[:split], samples[split:]
+    model = FormatModel().train(train, epochs=args.epochs)
+    model.save(args.output)
+    print(f"Trained on {len(train)} samples ({', '.join(model.labels)}); "
+          f"held-out accuracy {model.accuracy(test):.3f} on {len(test)}.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
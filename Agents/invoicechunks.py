@@ -0,0 +1,101 @@
+# agents/invoicechunks.py
+import re
+from collections import Counter
+from typing import Dict, Any, List, Tuple
+
+# A line made only of rule characters, e.g. the dashed separators in dummy.txt.
+_RULE_LINE = re.compile(r"^[\s\-=_*~#.]+$")
+# Rule characters framing a section title: "------ LINE ITEMS ------".
+_RULE_EDGES = re.compile(r"^[\-=_*~#]{3,}\s*|\s*[\-=_*~#]{3,}$")
+_WHITESPACE = re.compile(r"[ \t\u00a0]+")
+
+
+def compact_invoice_text(text: str) -> str:
+    """
+    Shrinks invoice text before it goes into a prompt: separator rules are
+    dropped (section titles framed by rules keep just the title), runs of
+    spaces and tabs become one space and blank lines are removed. Nothing
+    the extraction reads is lost, only layout.
+    """
+    lines = []
+    for line in text.splitlines():
+        if not line.strip() or _RULE_LINE.match(line):
+            continue
+        line = _RULE_EDGES.sub("", line.strip())
+        line = _WHITESPACE.sub(" ", line).strip()
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def split_into_chunks(text: str, max_chars: int, overlap_lines: int = 2) -> List[Tuple[str, str]]:
+    """
+    Splits compacted text into chunks of at most about `max_chars`, on line
+    boundaries. Each chunk repeats the last `overlap_lines` lines of the one
+    before it, so a line item wrapped across a boundary is still seen whole.
+
+    Returns:
+        (chunk_text, overlap_text) pairs, where overlap_text is the part of
+        the chunk repeated from the previous one ("" for the first).
+    """
+    chunks = []
+    current = []
+    size = 0
+    overlap = []
+    for line in text.split("\n"):
+        if current and size + len(line) + 1 > max_chars and len(current) > len(overlap):
+            chunks.append(("\n".join(current), "\n".join(overlap)))
+            overlap = current[-overlap_lines:] if overlap_lines else []
+            current = list(overlap)
+            size = sum(len(l) + 1 for l in current)
+        current.append(line)
+        size += len(line) + 1
+    if len(current) > len(overlap) or not chunks:
+        chunks.append(("\n".join(current), "\n".join(overlap)))
+    return chunks
+
+
+def _item_key(item: Dict[str, Any]) -> tuple:
+    def norm(value):
+        if isinstance(value, str):
+            value = _WHITESPACE.sub(" ", value).strip().lower()
+            try:
+                return float(value.replace(",", ""))
+            except ValueError:
+                return value
+        if isinstance(value, (int, float)):
+            return float(value)
+        return value
+
+    return tuple(norm(item.get(field)) for field in ("description", "quantity", "unit_price", "amount"))
+
+
+def merge_line_items(chunk_items: List[List[Dict[str, Any]]], overlaps: List[str]) -> List[Dict[str, Any]]:
+    """
+    Concatenates the line items extracted from consecutive chunks, dropping
+    an item from a chunk when the previous chunk already reported it and its
+    description lies in the lines the two chunks share.
+
+    Args:
+        chunk_items: The line items of each chunk, in chunk order.
+        overlaps: The overlap_text of each chunk, from split_into_chunks.
+    """
+    merged = []
+    previous = Counter()
+    for items, overlap in zip(chunk_items, overlaps):
+        overlap = overlap.lower()
+        seen_before = Counter(previous)
+        current = Counter()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            key = _item_key(item)
+            description = key[0] if isinstance(key[0], str) else None
+            if seen_before[key] and description and description in overlap:
+                seen_before[key] -= 1
+                current[key] += 1
+                continue
+            current[key] += 1
+            merged.append(item)
+        previous = current
+    return merged
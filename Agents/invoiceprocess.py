@@ -1,14 +1,66 @@
 # agents/invoice_processing_agent.py
-import google.generativeai as genai
-import os
+import asyncio
+import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
+from document import Document, as_text
 from documentextract import extract_text_from_pdf
-from typing import Dict, List
-genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-model = genai.GenerativeModel("models/gemini-1.5-flash-latest")
+from llmclient import LLMClient, GeminiClient
+from llmresilience import LLMUnavailable, ResilientClient, is_transient
+from llmcache import ExtractionCache
+from metrics import metrics
+from invoicerecord import InvoiceRecord
+from agents.invoicetemplate import extract_invoice_details, LINE_ITEMS_HEADER
+from agents.invoicechunks import compact_invoice_text, split_into_chunks, merge_line_items
+from typing import Dict, List, Optional, Tuple, Union
+logger = logging.getLogger(__name__)
+
+# The field instructions shared by the extraction prompts.
+_HEADER_FIELDS = """Invoice Number: Look for a phrase like "Invoice Number:", "Invoice #:", or "Bill Number:".
+Invoice Date: Look for a date associated with the invoice, often near the invoice number or header. Use YYYY-MM-DD format if possible.
+Seller Name: Identify the name of the company issuing the invoice.(It can also be labelled as Seller or Vendor)
+Buyer Name: Identify the name of the company or person being billed.(It can also be labelled as Buyer or Customer)
+Subtotal: Find the amount before taxes and discounts.
+Total Tax Amount: Find the total amount of tax.
+Discount: Find any discount applied.
+Shipping Handling: Find any shipping or handling fees.
+Total Amount Due: Find the final amount the buyer owes, often labeled "Total", "Amount Due", etc.
+Currency: Identify the currency used (e.g., USD, EUR)."""
+_LINE_ITEMS_FIELD = """Line Items: Extract the details of each itemized charge. For each item, identify the "description", "quantity", "unit price", "amount", and "tax" (if applicable). Return these as a JSON array of objects."""
+
 class InvoiceProcessingAgent:
-    def __init__(self, memory):
+    # Bump whenever _build_text_prompt changes so cached responses from the
+    # old prompt are not reused.
+    PROMPT_VERSION = "text-v2"
+
+    def __init__(self, memory, llm_client: LLMClient = None, max_concurrency: int = 8,
+                 cache: ExtractionCache = None, use_fast_path: bool = True, pdf_workers: int = None,
+                 chunk_chars: int = 8000):
+        """
+        Args:
+            memory: An instance of the SharedMemory class.
+            llm_client: The LLM client used for text extraction; defaults to
+                Gemini, initialised on the first request that needs it and
+                wrapped in a ResilientClient (rate limit, retries, deadline,
+                circuit breaker) shared with every other agent in the process.
+            max_concurrency: Maximum LLM requests kept in flight by the async path.
+            cache: Optional ExtractionCache consulted before calling the LLM.
+            use_fast_path: Try the rule-based parser for templated invoices
+                before calling the LLM.
+            pdf_workers: Processes used to extract long PDFs; defaults to the
+                CPU count.
+            chunk_chars: Compacted invoices longer than this are extracted in
+                page-sized chunks of about this size, concurrently.
+        """
         self.memory = memory
+        self.llm_client = llm_client or ResilientClient(GeminiClient())
+        self.cache = cache
+        self.use_fast_path = use_fast_path
+        self.pdf_workers = pdf_workers
+        self.chunk_chars = chunk_chars
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._semaphore_loop = None
 
     def process_json_invoice(self, invoice_data: Dict, interaction_id: str) -> Dict:
         """Processes invoice data provided in JSON format."""
@@ -27,24 +79,268 @@ class InvoiceProcessingAgent:
 
     def process_text_invoice(self, invoice_text: str, interaction_id: str) -> Dict:
         """Processes invoice data provided as plain text."""
-        extracted_data = {}
+        extracted_data, invoice_text, cache_key = self._prepare_text(invoice_text, interaction_id)
+        if extracted_data is not None:
+            return extracted_data
+        return self._extract_single(invoice_text, cache_key, interaction_id)
+
+    async def aprocess_text_invoice(self, invoice_text: str, interaction_id: str) -> Dict:
+        """Awaitable variant of process_text_invoice; the LLM call does not block the event loop."""
+        extracted_data, invoice_text, cache_key = self._prepare_text(invoice_text, interaction_id)
+        if extracted_data is not None:
+            return extracted_data
+        return await self._aextract_single(invoice_text, cache_key, interaction_id)
+
+    def process_text_invoices(self, invoices: List[Tuple[str, str]], pack_size: int = 8) -> List[Dict]:
+        """
+        Processes many plain text invoices, packing up to `pack_size` of them
+        into each LLM request so the fixed instruction block is paid once per
+        pack rather than once per invoice. Packs are sent concurrently.
+
+        Invoices the fast path or the cache can answer never reach the LLM;
+        long ones are extracted on their own. An invoice missing from a pack's
+        response, or whose entry does not parse, is retried on its own.
+
+        Args:
+            invoices: (invoice_text, interaction_id) pairs.
+            pack_size: The most invoices put in one request.
+
+        Returns:
+            The extracted data, in the same order as `invoices`.
+        """
+        results, singles, packs = self._plan_packs(invoices, pack_size)
+        jobs = [(self._run_pack, (pack,)) for pack in packs]
+        jobs += [(self._extract_single, entry[1:]) for entry in singles]
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(jobs))) as pool:
+                outcomes = list(pool.map(lambda job: job[0](*job[1]), jobs))
+            retries = []
+            for pack, outcome in zip(packs, outcomes):
+                retries.extend(self._collect_pack(pack, outcome, results))
+            for entry, extracted_data in zip(singles, outcomes[len(packs):]):
+                results[entry[0]] = extracted_data
+            if retries:
+                with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(retries))) as pool:
+                    retried = list(pool.map(lambda entry: self._extract_single(*entry[1:]), retries))
+                for entry, extracted_data in zip(retries, retried):
+                    results[entry[0]] = extracted_data
+        return results
+
+    async def aprocess_text_invoices(self, invoices: List[Tuple[str, str]], pack_size: int = 8) -> List[Dict]:
+        """Awaitable variant of process_text_invoices."""
+        results, singles, packs = self._plan_packs(invoices, pack_size)
+        outcomes = await asyncio.gather(
+            *(self._arun_pack(pack) for pack in packs),
+            *(self._aextract_single(*entry[1:]) for entry in singles),
+        )
+        retries = []
+        for pack, outcome in zip(packs, outcomes):
+            retries.extend(self._collect_pack(pack, outcome, results))
+        for entry, extracted_data in zip(singles, outcomes[len(packs):]):
+            results[entry[0]] = extracted_data
+        retried = await asyncio.gather(*(self._aextract_single(*entry[1:]) for entry in retries))
+        for entry, extracted_data in zip(retries, retried):
+            results[entry[0]] = extracted_data
+        return results
+
+    def _prepare_text(self, invoice_text: str, interaction_id: str) -> Tuple[Optional[Dict], str, Optional[str]]:
+        """
+        Runs the steps before the LLM: the template fast path, compaction and
+        the cache lookup. Returns (extracted_data, compacted_text, cache_key),
+        where extracted_data is set when no LLM call is needed.
+        """
+        extracted_data = self._fast_path_extract(invoice_text)
+        metrics.incr("fast_path", outcome="hit" if extracted_data is not None else "miss")
+        if extracted_data is not None:
+            self.memory.store_data(interaction_id, 'extracted_invoice_data_text', extracted_data)
+            self.memory.store_data(interaction_id, 'extraction_method', 'template')
+            return extracted_data, invoice_text, None
+
         # This is where you would use an LLM to extract information from the unstructured text.
-        # You'll need to design effective prompts.
+        invoice_text = compact_invoice_text(invoice_text)
+        cache_key = self._cache_key(invoice_text)
+        llm_response = self.cache.get(cache_key) if cache_key else None
+        if llm_response is not None:
+            return self._store_text_extraction(llm_response, interaction_id), invoice_text, cache_key
+        return None, invoice_text, cache_key
 
-        prompt =  prompt = f"""You are an expert at extracting information from invoices.Extract the following details from the text below and return them as a JSON object. If a piece of information is not found, use null.
+    def _extract_single(self, invoice_text: str, cache_key: Optional[str], interaction_id: str) -> Dict:
+        """Extracts one compacted invoice with its own LLM request (or chunked requests if long)."""
+        try:
+            if len(invoice_text) > self.chunk_chars:
+                llm_response = self._extract_chunked(invoice_text, interaction_id)
+            else:
+                prompt = self._build_text_prompt(invoice_text)
+                llm_response = self._call_llm(prompt, interaction_id)
+        except Exception as e:
+            return self._store_llm_failure(e, interaction_id)
+        extracted_data = self._store_text_extraction(llm_response, interaction_id)
+        self._cache_response(cache_key, llm_response, extracted_data)
+        return extracted_data
 
-Invoice Number: Look for a phrase like "Invoice Number:", "Invoice #:", or "Bill Number:".
-Invoice Date: Look for a date associated with the invoice, often near the invoice number or header. Use YYYY-MM-DD format if possible.
-Seller Name: Identify the name of the company issuing the invoice.(It can also be labelled as Seller or Vendor)
-Buyer Name: Identify the name of the company or person being billed.(It can also be labelled as Buyer or Customer)
-Subtotal: Find the amount before taxes and discounts.
-Total Tax Amount: Find the total amount of tax.
-Discount: Find any discount applied.
-Shipping Handling: Find any shipping or handling fees.
-Total Amount Due: Find the final amount the buyer owes, often labeled "Total", "Amount Due", etc.
-Currency: Identify the currency used (e.g., USD, EUR).
+    async def _aextract_single(self, invoice_text: str, cache_key: Optional[str], interaction_id: str) -> Dict:
+        try:
+            if len(invoice_text) > self.chunk_chars:
+                llm_response = await self._aextract_chunked(invoice_text, interaction_id)
+            else:
+                prompt = self._build_text_prompt(invoice_text)
+                llm_response = await self._acall_llm(prompt, interaction_id)
+        except Exception as e:
+            return self._store_llm_failure(e, interaction_id)
+        extracted_data = self._store_text_extraction(llm_response, interaction_id)
+        self._cache_response(cache_key, llm_response, extracted_data)
+        return extracted_data
+
+    def _plan_packs(self, invoices: List[Tuple[str, str]], pack_size: int):
+        """
+        Resolves what it can without the LLM and groups the rest. Returns
+        (results, singles, packs): results holds the answers found so far by
+        position, singles the invoices too long to pack and packs lists of
+        invoices sharing a request, each entry being
+        (position, compacted_text, cache_key, interaction_id).
+        """
+        results = [None] * len(invoices)
+        singles = []
+        packs = []
+        pack = []
+        pack_chars = 0
+        for position, (invoice_text, interaction_id) in enumerate(invoices):
+            extracted_data, invoice_text, cache_key = self._prepare_text(invoice_text, interaction_id)
+            if extracted_data is not None:
+                results[position] = extracted_data
+                continue
+            entry = (position, invoice_text, cache_key, interaction_id)
+            if pack_size <= 1 or len(invoice_text) > self.chunk_chars:
+                singles.append(entry)
+                continue
+            # A pack is closed when it is full or the next invoice would take
+            # it past the length of one chunk.
+            if pack and (len(pack) >= pack_size or pack_chars + len(invoice_text) > self.chunk_chars):
+                packs.append(pack)
+                pack, pack_chars = [], 0
+            pack.append(entry)
+            pack_chars += len(invoice_text)
+        if pack:
+            packs.append(pack)
+        # A pack of one gains nothing from the packed prompt.
+        singles.extend(pack[0] for pack in packs if len(pack) == 1)
+        packs = [pack for pack in packs if len(pack) > 1]
+        return results, singles, packs
+
+    def _run_pack(self, pack: List[tuple]) -> Optional[str]:
+        """Sends a pack's request; None if it failed, in which case each invoice is retried alone."""
+        metrics.incr("llm_packed_requests", agent="invoice_agent")
+        metrics.incr("llm_packed_invoices", len(pack), agent="invoice_agent")
+        try:
+            return self._call_llm(self._build_packed_prompt(pack), pack[0][3])
+        except Exception:
+            return None
+
+    async def _arun_pack(self, pack: List[tuple]) -> Optional[str]:
+        metrics.incr("llm_packed_requests", agent="invoice_agent")
+        metrics.incr("llm_packed_invoices", len(pack), agent="invoice_agent")
+        try:
+            return await self._acall_llm(self._build_packed_prompt(pack), pack[0][3])
+        except Exception:
+            return None
+
+    def _collect_pack(self, pack: List[tuple], llm_response: Optional[str],
+                      results: List[Optional[Dict]]) -> List[tuple]:
+        """
+        Splits a pack's response into per-invoice results, stores each under
+        its interaction ID and returns the entries that must be retried alone
+        (all of them if the request failed).
+        """
+        by_id = {}
+        try:
+            answers = json.loads(llm_response) if llm_response is not None else []
+            if isinstance(answers, dict):
+                # Tolerate {"invoices": [...]} around the array.
+                answers = next((v for v in answers.values() if isinstance(v, list)), [])
+            for answer in answers if isinstance(answers, list) else []:
+                if isinstance(answer, dict) and answer.get("id") is not None:
+                    by_id.setdefault(str(answer["id"]), answer)
+        except json.JSONDecodeError as e:
+            logger.warning("Could not parse packed LLM response for %d invoices: %s", len(pack), e)
+            metrics.incr("errors", kind="llm_parse", agent="invoice_agent")
 
-Line Items: Extract the details of each itemized charge. For each item, identify the "description", "quantity", "unit price", "amount", and "tax" (if applicable). Return these as a JSON array of objects.
+        retries = []
+        for pack_id, entry in enumerate(pack, 1):
+            position, _, cache_key, interaction_id = entry
+            answer = by_id.get(str(pack_id))
+            if answer is None:
+                retries.append(entry)
+                continue
+            llm_response = json.dumps({k: v for k, v in answer.items() if k != "id"})
+            extracted_data = self._store_text_extraction(llm_response, interaction_id)
+            self._cache_response(cache_key, llm_response, extracted_data)
+            results[position] = extracted_data
+        if retries:
+            metrics.incr("llm_pack_retries", len(retries), agent="invoice_agent")
+        return retries
+
+    def _fast_path_extract(self, invoice_text: str) -> Optional[Dict]:
+        """
+        Extracts invoices that follow the standard template (see dummy.txt)
+        without calling the LLM.
+
+        Returns:
+            The extracted data in the same schema the LLM path produces, or
+            None if the text is not templated or the parse is incomplete or
+            inconsistent, in which case the caller falls back to the LLM.
+        """
+        if not self.use_fast_path or "Invoice Number:" not in invoice_text or LINE_ITEMS_HEADER not in invoice_text:
+            return None
+
+        details = extract_invoice_details(invoice_text)
+        extracted_data = {
+            'invoice_number': details.get('invoice_number'),
+            'invoice_date': details.get('invoice_date'),
+            'seller': details.get('vendor') or None,
+            'buyer': details.get('customer') or None,
+            'line_items': details.get('items'),
+            'subtotal': details.get('subtotal'),
+            'discount': details.get('discount'),
+            'total_tax_amount': details.get('total_tax_amount'),
+            'shipping_handling': details.get('shipping_handling'),
+            'total_amount': details.get('total_amount_due'),
+            'currency': details.get('currency'),
+        }
+
+        if self.validate_extracted_data(extracted_data):
+            return None
+        if not extracted_data['seller'] or not extracted_data['buyer'] or not extracted_data['currency']:
+            return None
+        # A row the item pattern failed to match would otherwise silently
+        # drop out of the invoice; the totals must add up for the parse to be
+        # trusted.
+        if extracted_data['subtotal'] is None:
+            return None
+        items_total = sum(item['amount'] for item in extracted_data['line_items'])
+        expected_total = (extracted_data['subtotal'] - (extracted_data['discount'] or 0)
+                          + (extracted_data['total_tax_amount'] or 0) + (extracted_data['shipping_handling'] or 0))
+        if abs(items_total - extracted_data['subtotal']) > 0.01 or abs(expected_total - extracted_data['total_amount']) > 0.01:
+            return None
+        return extracted_data
+
+    def _cache_key(self, invoice_text: str) -> Optional[str]:
+        """Returns the cache key for this text, or None when caching is off."""
+        if self.cache is None or not self.cache.enabled:
+            return None
+        return self.cache.make_key(invoice_text, self.PROMPT_VERSION, self.llm_client.model_name)
+
+    def _cache_response(self, cache_key: Optional[str], llm_response: str, extracted_data: Dict):
+        """Caches a response only if it parsed, so failures are retried next time."""
+        if cache_key and 'parsing_error' not in extracted_data:
+            self.cache.put(cache_key, llm_response)
+
+    def _build_text_prompt(self, invoice_text: str) -> str:
+        """Builds the extraction prompt for a plain text invoice."""
+        return f"""You are an expert at extracting information from invoices.Extract the following details from the text below and return them as a JSON object. If a piece of information is not found, use null.
+
+{_HEADER_FIELDS}
+
+{_LINE_ITEMS_FIELD}
 
 
         Invoice Text:
@@ -53,50 +349,196 @@ Line Items: Extract the details of each itemized charge. For each item, identify
         ```
         txt Output:
         """
-        # Assuming you have a method to interact with your LLM
-        llm_response = self._call_llm(prompt)
-        print(llm_response)
-                # Implement logic to parse the LLM response and extract the structured data
+
+    def _build_packed_prompt(self, pack: List[tuple]) -> str:
+        """Builds one extraction prompt covering every invoice in `pack`, each under its own ID."""
+        invoices_text = "\n".join(
+            f"=== INVOICE {pack_id} ===\n{invoice_text}\n=== END INVOICE {pack_id} ==="
+            for pack_id, (_, invoice_text, _, _) in enumerate(pack, 1)
+        )
+        return f"""You are an expert at extracting information from invoices. The text below contains {len(pack)} separate invoices, each between "=== INVOICE <id> ===" and "=== END INVOICE <id> ===". Extract the following details from each invoice on its own and return a JSON array with one object per invoice, each with an "id" field holding that invoice's id. If a piece of information is not found, use null.
+
+{_HEADER_FIELDS}
+
+{_LINE_ITEMS_FIELD}
+
+
+        Invoices:
+        ```
+        {invoices_text}
+        ```
+        txt Output:
+        """
+
+    def _chunk_prompts(self, invoice_text: str) -> Tuple[str, List[str], List[str]]:
+        """Splits a long invoice into one header prompt and a line-item prompt per chunk."""
+        chunks = split_into_chunks(invoice_text, self.chunk_chars)
+        metrics.incr("text_chunks", len(chunks), agent="invoice_agent")
+        # Header fields sit on the first page and the totals on the last.
+        summary_text = chunks[0][0] if len(chunks) == 1 else chunks[0][0] + "\n[...]\n" + chunks[-1][0]
+        header_prompt = self._build_header_prompt(summary_text)
+        item_prompts = [self._build_items_prompt(chunk) for chunk, _ in chunks]
+        return header_prompt, item_prompts, [overlap for _, overlap in chunks]
+
+    def _extract_chunked(self, invoice_text: str, interaction_id: str) -> str:
+        """
+        Extracts a long invoice map-reduce style: header fields and line items
+        are requested in separate, concurrent calls, then merged into one
+        response in the schema of the single-prompt path.
+        """
+        header_prompt, item_prompts, overlaps = self._chunk_prompts(invoice_text)
+        prompts = [header_prompt] + item_prompts
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(prompts))) as pool:
+            responses = list(pool.map(lambda prompt: self._call_llm(prompt, interaction_id), prompts))
+        return self._merge_chunk_responses(responses[0], responses[1:], overlaps, interaction_id)
+
+    async def _aextract_chunked(self, invoice_text: str, interaction_id: str) -> str:
+        """Awaitable variant of _extract_chunked; concurrency is bounded by the shared semaphore."""
+        header_prompt, item_prompts, overlaps = self._chunk_prompts(invoice_text)
+        responses = await asyncio.gather(
+            *(self._acall_llm(prompt, interaction_id) for prompt in [header_prompt] + item_prompts)
+        )
+        return self._merge_chunk_responses(responses[0], list(responses[1:]), overlaps, interaction_id)
+
+    def _merge_chunk_responses(self, header_response: str, item_responses: List[str], overlaps: List[str],
+                               interaction_id: str) -> str:
+        """Combines the chunk responses into one JSON response; any part that failed to
+        parse is reported as a parsing_error so the result is not cached."""
+        errors = []
+        try:
+            merged = json.loads(header_response)
+            if not isinstance(merged, dict):
+                raise ValueError("header response is not a JSON object")
+        except ValueError as e:
+            errors.append(f"header: {e}")
+            merged = {}
+        chunk_items = []
+        for number, response in enumerate(item_responses, 1):
+            try:
+                parsed = json.loads(response)
+                items = parsed.get("line_items") if isinstance(parsed, dict) else parsed
+                chunk_items.append(items if isinstance(items, list) else [])
+            except ValueError as e:
+                errors.append(f"chunk {number}: {e}")
+                chunk_items.append([])
+        merged["line_items"] = merge_line_items(chunk_items, overlaps)
+        if errors:
+            logger.warning("Chunked extraction for %s had unparseable parts: %s", interaction_id, errors)
+            merged["parsing_error"] = "; ".join(errors)
+        return json.dumps(merged)
+
+    def _build_header_prompt(self, invoice_text: str) -> str:
+        """Builds the prompt for the non-item fields of a long invoice, given its first and last chunks."""
+        return f"""You are an expert at extracting information from invoices.Extract the following details from the text below and return them as a JSON object. If a piece of information is not found, use null. The text is the beginning and the end of a longer invoice; "[...]" marks the omitted middle. Do not extract line items.
+
+{_HEADER_FIELDS}
+
+
+        Invoice Text:
+        ```
+        {invoice_text}
+        ```
+        txt Output:
+        """
+
+    def _build_items_prompt(self, chunk_text: str) -> str:
+        """Builds the prompt for the line items in one chunk of a long invoice."""
+        return f"""You are an expert at extracting information from invoices. The text below is one part of a longer invoice. Extract every line item it contains and return them as a JSON object of the form {{"line_items": [...]}}. For each item, identify the "description", "quantity", "unit price", "amount", and "tax" (if applicable). Ignore headers and totals. If the text contains no line items, return {{"line_items": []}}.
+
+
+        Invoice Text:
+        ```
+        {chunk_text}
+        ```
+        txt Output:
+        """
+
+    def _store_text_extraction(self, llm_response: str, interaction_id: str) -> Dict:
+        """Parses the LLM's JSON response and stores the extracted data."""
+        extracted_data = {}
+        logger.debug("LLM response for %s: %s", interaction_id, llm_response)
         try:
             # Attempt to parse the LLM's response as JSON
             llm_extracted_data = json.loads(llm_response)
             extracted_data.update(llm_extracted_data)
         except json.JSONDecodeError as e:
-            print(f"Error parsing LLM response as JSON: {e}")
-            print(f"LLM Raw Response: {llm_response}")
+            logger.warning("Error parsing LLM response as JSON for %s: %s. Raw response: %r",
+                           interaction_id, e, llm_response)
+            metrics.incr("errors", kind="llm_parse", agent="invoice_agent")
             extracted_data['parsing_error'] = str(e)
             extracted_data['raw_llm_output'] = llm_response  # Store raw output for debugging
 
         self.memory.store_data(interaction_id, 'extracted_invoice_data_text', extracted_data)
         return extracted_data
 
-    # Optional: If you want the agent to handle raw PDFs (more complex)
-    # def process_pdf_invoice(self, pdf_path: str, interaction_id: str) -> Dict:
-    #     """Processes invoice data from a PDF file."""
-    #     invoice_text = extract_text_from_pdf(pdf_path)
-    #     return self.process_text_invoice(invoice_text, interaction_id)
+    def _store_llm_failure(self, error: Exception, interaction_id: str) -> Dict:
+        """
+        Records an invoice the LLM could not be reached for. Unlike a
+        parsing_error this says the backend failed, not the invoice, and
+        whether trying again later may succeed; nothing is cached.
+        """
+        extracted_data = {
+            'llm_error': f"{type(error).__name__}: {error}",
+            'retryable': is_transient(error) or isinstance(error, LLMUnavailable),
+        }
+        self.memory.store_data(interaction_id, 'extracted_invoice_data_text', extracted_data)
+        return extracted_data
 
-    def _call_llm(self, prompt: str) -> str:
-        try:
-            response = model.generate_content(prompt)
-            if hasattr(response, 'candidates') and response.candidates and \
-                    hasattr(response.candidates[0], 'content') and \
-                    hasattr(response.candidates[0].content, 'parts') and \
-                    response.candidates[0].content.parts:
-                llm_text = response.candidates[0].content.parts[0].text.strip()
-                # Remove potential ```json and ``` delimiters
-                llm_text = llm_text.removeprefix("```json").removesuffix("```").strip()
-                return llm_text
-            else:
-                print("Warning: Could not extract text from LLM response.")
-                return ""
-        except Exception as e:
-            print(f"Error calling Gemini: {e}")
-            return ""
-        # """Placeholder for your LLM interaction."""
-        # # Replace this with your actual LLM API call (e.g., OpenAI, Hugging Face Transformers)
-        # print(f"Calling LLM with prompt: {prompt}")
-        # return "LLM Response Placeholder - Implement actual LLM call here"
+    def process_pdf_invoice(self, pdf: Union[str, bytes, Document], interaction_id: str) -> Dict:
+        """Processes invoice data from a PDF file (a path, its bytes or a Document),
+        by extracting its text and handing that to the text pipeline."""
+        invoice_text = self._pdf_text(pdf, interaction_id)
+        return self.process_text_invoice(invoice_text, interaction_id)
+
+    def _pdf_text(self, pdf: Union[str, bytes, Document], interaction_id: str) -> str:
+        if isinstance(pdf, Document):
+            # Let extraction workers open the file themselves rather than
+            # shipping the bytes to each of them.
+            pdf = pdf.path if pdf.path is not None else pdf.raw
+        with metrics.span("pdf_extract", interaction_id, "invoice_agent"):
+            invoice_text = extract_text_from_pdf(pdf, workers=self.pdf_workers, cache=self.cache)
+        self.memory.store_data(interaction_id, 'pdf_text_length', len(invoice_text))
+        return invoice_text
+
+    def _call_llm(self, prompt: str, interaction_id: str = None) -> str:
+        """Sends one prompt. Errors are raised, not turned into an empty answer; the
+        client (a ResilientClient by default) has already retried what it could."""
+        with metrics.span("llm_call", interaction_id, "invoice_agent"):
+            self._count_llm_request(prompt)
+            try:
+                llm_response = self.llm_client.generate(prompt)
+            except Exception as e:
+                logger.error("Error calling LLM for %s: %s", interaction_id, e)
+                metrics.incr("errors", kind="llm_call", agent="invoice_agent")
+                raise
+        metrics.incr("llm_response_bytes", len(llm_response.encode("utf-8")) if metrics.enabled else 0)
+        return llm_response
+
+    async def _acall_llm(self, prompt: str, interaction_id: str = None) -> str:
+        async with self._get_semaphore():
+            with metrics.span("llm_call", interaction_id, "invoice_agent"):
+                self._count_llm_request(prompt)
+                try:
+                    llm_response = await self.llm_client.agenerate(prompt)
+                except Exception as e:
+                    logger.error("Error calling LLM for %s: %s", interaction_id, e)
+                    metrics.incr("errors", kind="llm_call", agent="invoice_agent")
+                    raise
+        metrics.incr("llm_response_bytes", len(llm_response.encode("utf-8")) if metrics.enabled else 0)
+        return llm_response
+
+    def _count_llm_request(self, prompt: str):
+        if metrics.enabled:
+            metrics.incr("llm_requests", model=self.llm_client.model_name)
+            metrics.incr("llm_prompt_bytes", len(prompt.encode("utf-8")))
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Returns the concurrency limiter for the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
 
     def validate_extracted_data(self, extracted_data: Dict) -> List[str]:
         """Performs basic validation on the extracted data."""
@@ -126,35 +568,124 @@ Line Items: Extract the details of each itemized charge. For each item, identify
         }
         return formatted_data
 
-    def process_invoice(self, input_data: str, format: str, interaction_id: str) -> Dict:
-        """Main entry point for processing invoices, handles different formats."""
+    def process_invoice(self, input_data: Union[str, Document], format: str, interaction_id: str) -> Dict:
+        """Main entry point for processing invoices, handles different formats.
+        `input_data` may be a Document, whose decoded text or parsed JSON is reused."""
         self.memory.initialize_context(interaction_id)
         extracted_data = {}
         if format == 'json':
             try:
-                invoice_json = json.loads(input_data)
+                if isinstance(input_data, Document):
+                    invoice_json = input_data.json()
+                else:
+                    invoice_json = json.loads(input_data)
                 extracted_data = self.process_json_invoice(invoice_json, interaction_id)
             except json.JSONDecodeError:
-                print(f"Error decoding JSON for interaction ID: {interaction_id}")
+                logger.warning("Error decoding JSON for interaction ID: %s", interaction_id)
                 # Handle the error appropriately
                 return {'error': 'Invalid JSON format'}
         elif format == 'text':
-            extracted_data = self.process_text_invoice(input_data, interaction_id)
+            with metrics.span("extract", interaction_id, "invoice_agent"):
+                extracted_data = self.process_text_invoice(as_text(input_data), interaction_id)
         elif format == 'pdf':
-            # Ideally, the Classifier would have extracted text already
-            print("Warning: Received raw PDF in InvoiceProcessingAgent. Consider text extraction before routing.")
-            # You might add PDF text extraction here as a fallback
-            # extracted_data = self.process_pdf_invoice(input_data, interaction_id)
-            return {'error': 'Raw PDF processing not fully implemented in this agent.'}
+            try:
+                with metrics.span("extract", interaction_id, "invoice_agent"):
+                    extracted_data = self.process_pdf_invoice(input_data, interaction_id)
+            except (ImportError, ValueError) as e:
+                logger.warning("Could not extract text from PDF for interaction ID %s: %s", interaction_id, e)
+                metrics.incr("errors", kind="pdf_extract", agent="invoice_agent")
+                return {'error': f'PDF text extraction failed: {e}'}
         else:
             return {'error': f'Unsupported format: {format}'}
 
-        validation_errors = self.validate_extracted_data(extracted_data)
+        return self._finalize(extracted_data, interaction_id)
+
+    async def aprocess_invoice(self, input_data: Union[str, Document], format: str, interaction_id: str) -> Dict:
+        """Awaitable variant of process_invoice. Only the text and PDF paths wait
+        on the LLM; PDF text is extracted off the event loop."""
+        if format not in ('text', 'pdf'):
+            return self.process_invoice(input_data, format, interaction_id)
+        self.memory.initialize_context(interaction_id)
+        with metrics.span("extract", interaction_id, "invoice_agent"):
+            if format == 'pdf':
+                try:
+                    invoice_text = await asyncio.to_thread(self._pdf_text, input_data, interaction_id)
+                except (ImportError, ValueError) as e:
+                    logger.warning("Could not extract text from PDF for interaction ID %s: %s", interaction_id, e)
+                    metrics.incr("errors", kind="pdf_extract", agent="invoice_agent")
+                    return {'error': f'PDF text extraction failed: {e}'}
+            else:
+                invoice_text = as_text(input_data)
+            extracted_data = await self.aprocess_text_invoice(invoice_text, interaction_id)
+        return self._finalize(extracted_data, interaction_id)
+
+    def process_invoices(self, invoices: List[Tuple[str, str]], format: str = 'text', pack_size: int = 8) -> List[Dict]:
+        """
+        Processes many invoices, packing text invoices `pack_size` to an LLM
+        request (see process_text_invoices).
+
+        Args:
+            invoices: (input_data, interaction_id) pairs.
+            format: The format shared by all inputs.
+            pack_size: The most text invoices put in one request; 1 sends
+                each on its own.
+
+        Returns:
+            The formatted results, in the same order as `invoices`.
+        """
+        if format != 'text' or pack_size <= 1:
+            return [self.process_invoice(input_data, format, interaction_id) for input_data, interaction_id in invoices]
+        for _, interaction_id in invoices:
+            self.memory.initialize_context(interaction_id)
+        with metrics.span("extract", None, "invoice_agent"):
+            extracted = self.process_text_invoices(
+                [(as_text(input_data), interaction_id) for input_data, interaction_id in invoices], pack_size)
+        return [self._finalize(extracted_data, interaction_id)
+                for extracted_data, (_, interaction_id) in zip(extracted, invoices)]
+
+    async def aprocess_invoices(self, invoices: List[Tuple[str, str]], format: str = 'text',
+                                pack_size: int = 1) -> List[Dict]:
+        """
+        Processes many invoices concurrently, keeping up to `max_concurrency`
+        LLM requests in flight.
+
+        Args:
+            invoices: (input_data, interaction_id) pairs.
+            format: The format shared by all inputs.
+            pack_size: When above 1, text invoices are packed this many to an
+                LLM request (see process_text_invoices).
+
+        Returns:
+            The formatted results, in the same order as `invoices`.
+        """
+        if format == 'text' and pack_size > 1:
+            for _, interaction_id in invoices:
+                self.memory.initialize_context(interaction_id)
+            with metrics.span("extract", None, "invoice_agent"):
+                extracted = await self.aprocess_text_invoices(
+                    [(as_text(input_data), interaction_id) for input_data, interaction_id in invoices], pack_size)
+            return [self._finalize(extracted_data, interaction_id)
+                    for extracted_data, (_, interaction_id) in zip(extracted, invoices)]
+        return await asyncio.gather(
+            *(self.aprocess_invoice(input_data, format, interaction_id) for input_data, interaction_id in invoices)
+        )
+
+    def _finalize(self, extracted_data: Dict, interaction_id: str) -> Dict:
+        """Validates extracted data and stores the downstream-formatted result."""
+        if 'llm_error' in extracted_data:
+            # Nothing was extracted: report the failure, and whether it is
+            # worth retrying, rather than an invoice with every field empty.
+            return {'error': extracted_data['llm_error'], 'retryable': extracted_data['retryable']}
+        with metrics.span("validate", interaction_id, "invoice_agent"):
+            validation_errors = self.validate_extracted_data(extracted_data)
         if validation_errors:
-            print(f"Validation errors for interaction ID {interaction_id}: {validation_errors}")
+            logger.info("Validation errors for interaction ID %s: %s", interaction_id, validation_errors)
+            metrics.incr("validation_failures", agent="invoice_agent")
             self.memory.store_data(interaction_id, 'invoice_validation_errors', validation_errors)
 
-        formatted_data = self.format_for_downstream(extracted_data)
-        self.memory.store_data(interaction_id, 'formatted_invoice_data', formatted_data)
+        with metrics.span("format", interaction_id, "invoice_agent"):
+            formatted_data = self.format_for_downstream(extracted_data)
+        # Memory keeps the compact record (see invoicerecord); callers get the plain dict.
+        self.memory.store_data(interaction_id, 'formatted_invoice_data', InvoiceRecord.from_extraction(extracted_data))
 
-        return formatted_data
\ No newline at end of file
+        return formatted_data
@@ -0,0 +1,166 @@
+# agents/invoicetemplate.py
+import logging
+import re
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+LINE_ITEMS_HEADER = "-------------------- LINE ITEMS -------------------"
+TOTALS_HEADER = "---------------------- TOTALS ----------------------"
+
+logger = logging.getLogger(__name__)
+
+_QUANTITY = re.compile(r"\d+")
+_AMOUNT = re.compile(r"[\d.]+")
+_CURRENCY = re.compile(r"\w+")
+
+# Party block labels -> keys in the party dict, in the order they must appear.
+_PARTY_FIELDS = (("Name:", "name"), ("Address:", "address"), ("Tax ID:", "tax_id"))
+_PARTY_HEADERS = {"Seller/Vendor:": "vendor", "Buyer/Customer:": "customer"}
+
+# TOTALS section labels -> keys in the details dict.
+_TOTAL_FIELDS = {
+    "Subtotal:": "subtotal",
+    "Discount:": "discount",
+    "Total Tax Amount:": "total_tax_amount",
+    "Shipping/Handling:": "shipping_handling",
+    "Total Amount Due:": "total_amount_due",
+    "Currency:": "currency",
+}
+
+# Scanner states
+_HEADER, _PARTY, _ITEMS, _TOTALS = range(4)
+
+
+def parse_date(date_str: str) -> Optional[str]:
+    """Attempts to parse a date string into YYYY-MM-DD format."""
+    formats = ["%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y"]
+    for fmt in formats:
+        try:
+            return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_line_item(line: str) -> Optional[Dict[str, Any]]:
+    """Parses "<description> <qty> <unit price> <amount> <tax>", or returns None."""
+    parts = line.rsplit(None, 4)
+    if len(parts) != 5:
+        return None
+    description, quantity, unit_price, amount, tax = parts
+    if not _QUANTITY.fullmatch(quantity) or not all(
+            _AMOUNT.fullmatch(value) for value in (unit_price, amount, tax)):
+        return None
+    try:
+        return {
+            "description": description.strip(),
+            "quantity": int(quantity),
+            "unit_price": float(unit_price),
+            "amount": float(amount),
+            "tax": float(tax),
+        }
+    except ValueError as e:
+        logger.warning("Error parsing line item numerical data: %s for item: %s", e, line)
+        return None
+
+
+def extract_invoice_details(text: str) -> Dict[str, Any]:
+    """
+    Extracts invoice details from text laid out like dummy.txt: an
+    "Invoice Number:" header, Seller/Vendor and Buyer/Customer blocks, then
+    LINE ITEMS and TOTALS sections.
+
+    The text is scanned once, line by line, with a small state machine, so
+    the cost stays linear in the input however many line items or quoted
+    lines it holds.
+
+    Args:
+        text: The invoice text (a plain invoice or an email body).
+
+    Returns:
+        A dictionary with invoice_number, invoice_date, vendor, customer and
+        items, plus the totals fields when the TOTALS section is complete.
+    """
+    details = {
+        "items": [],
+        "invoice_number": None,
+        "invoice_date": None,
+        "vendor": {},
+        "customer": {},
+    }
+    items = details["items"]
+    totals = {}
+    state = _HEADER
+    party = None        # dict being filled while in a party block
+    party_key = None    # "vendor" or "customer"
+    party_field = 0     # index into _PARTY_FIELDS of the next expected label
+    seen_line_items = False
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if stripped[0] == "-":
+            # Only the two named headers change state; plain dashed rules are
+            # separators inside the current section.
+            if stripped == LINE_ITEMS_HEADER:
+                state = _ITEMS
+                seen_line_items = True
+            elif stripped == TOTALS_HEADER:
+                state = _TOTALS
+            continue
+
+        if state == _ITEMS:
+            item = _parse_line_item(stripped)
+            if item is not None:
+                items.append(item)
+            continue
+
+        if state == _TOTALS:
+            for label, key in _TOTAL_FIELDS.items():
+                if key not in totals and stripped.startswith(label):
+                    totals[key] = stripped[len(label):].strip()
+                    break
+            continue
+
+        if state == _PARTY:
+            label, key = _PARTY_FIELDS[party_field]
+            if stripped.startswith(label):
+                party[key] = stripped[len(label):].strip()
+                party_field += 1
+                if party_field == len(_PARTY_FIELDS):
+                    # Only complete blocks count, and only the first of each kind.
+                    if not details[party_key]:
+                        details[party_key] = party
+                    state = _HEADER
+                continue
+            # Anything else ends the block early; read the line as a header line.
+            state = _HEADER
+
+        if stripped in _PARTY_HEADERS:
+            state = _PARTY
+            party = {}
+            party_key = _PARTY_HEADERS[stripped]
+            party_field = 0
+        elif details["invoice_number"] is None and stripped.startswith("Invoice Number:"):
+            details["invoice_number"] = stripped[len("Invoice Number:"):].strip() or None
+        elif details["invoice_date"] is None and stripped.startswith("Invoice Date:"):
+            details["invoice_date"] = parse_date(stripped[len("Invoice Date:"):].strip())
+
+    if not seen_line_items:
+        logger.debug("Line items section not found in invoice text.")
+
+    if len(totals) == len(_TOTAL_FIELDS):
+        try:
+            details["subtotal"] = float(totals["subtotal"])
+            details["discount"] = float(totals["discount"])
+            details["total_tax_amount"] = float(totals["total_tax_amount"])
+            details["shipping_handling"] = float(totals["shipping_handling"])
+            details["total_amount_due"] = float(totals["total_amount_due"])
+            currency = _CURRENCY.match(totals["currency"])
+            details["currency"] = currency.group(0) if currency else None
+        except ValueError as e:
+            logger.warning("Error parsing total numerical data: %s for totals: %s", e, totals)
+
+    return details
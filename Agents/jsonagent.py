@@ -1,6 +1,132 @@
 # agents/json_agent.py
 import json
-from typing import Dict, Any, List
+from collections import deque
+from itertools import islice
+from typing import Dict, Any, List, Iterator, Optional, Tuple, Union
+from document import Document
+from jsonstream import InvalidRecord, iter_json_documents
+from metrics import metrics
+
+# Keys that may hold the list of line items, case-folded.
+ITEMS_KEY_OPTIONS = ("lineitems", "items", "products", "details")
+
+_MISSING = object()
+
+
+def _folded_get(obj: Dict[str, Any], key: str, folded: str, indexes: Dict[int, Dict[str, Any]]) -> Any:
+    """
+    Looks up `key` in `obj`. An exact match wins; otherwise the first key
+    that matches case-insensitively. The case-folded index of a dict is
+    built on its first miss and reused through `indexes` for the rest of the
+    payload.
+    """
+    value = obj.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    index = indexes.get(id(obj))
+    if index is None:
+        index = indexes[id(obj)] = {}
+        for k, v in obj.items():
+            if isinstance(k, str):
+                index.setdefault(k.casefold(), v)
+    return index.get(folded, _MISSING)
+
+
+def _resolve(obj: Any, path: tuple, indexes: Dict[int, Dict[str, Any]]) -> Any:
+    """Follows a compiled path of (key, folded_key) pairs through nested dicts."""
+    for key, folded in path:
+        if not isinstance(obj, dict) or not obj:
+            return None
+        obj = _folded_get(obj, key, folded, indexes)
+        if obj is _MISSING:
+            return None
+    return obj
+
+
+def _compile_path(source_path: str) -> tuple:
+    return tuple((key, key.casefold()) for key in source_path.split('.'))
+
+
+class SchemaPlan:
+    """A target schema compiled once into precomputed accessor paths."""
+    __slots__ = ("fields", "item_fields")
+
+    def __init__(self, schema: Dict[str, Any]):
+        # (target_field, compiled path), in schema order; the items entry has
+        # a path of None and is filled from item_fields.
+        self.fields = []
+        self.item_fields = ()
+        for target_field, source_path in schema.items():
+            if isinstance(source_path, str):
+                self.fields.append((target_field, _compile_path(source_path)))
+            elif isinstance(source_path, list) and target_field == 'items':
+                self.fields.append((target_field, None))
+                self.item_fields = tuple(
+                    (item_target_field, _compile_path(item_source_path))
+                    for item_target_field, item_source_path in source_path[0].items()
+                )
+
+    def extract(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        extracted = {}
+        indexes = {}
+        if not isinstance(data, dict):
+            data = {}
+        for target_field, path in self.fields:
+            if path is None:
+                extracted[target_field] = self._extract_items(data, indexes)
+                continue
+            value = _resolve(data, path, indexes)
+            if value is not None:
+                extracted[target_field] = value
+        return extracted
+
+    def _extract_items(self, data: Dict[str, Any], indexes: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        items = []
+        found_items = None
+        for key, value in data.items():
+            if isinstance(key, str) and key.casefold() in ITEMS_KEY_OPTIONS:
+                found_items = value
+                break
+        if not isinstance(found_items, list):
+            return items
+
+        item_fields = self.item_fields
+        for item in found_items:
+            if not isinstance(item, dict):
+                continue
+            item_data = {}
+            for item_target_field, path in item_fields:
+                if len(path) == 1:
+                    # Flat item fields are the common case; skip the generic walk.
+                    key, folded = path[0]
+                    item_value = item.get(key, _MISSING)
+                    if item_value is _MISSING:
+                        item_value = _folded_get(item, key, folded, indexes)
+                        if item_value is _MISSING:
+                            continue
+                else:
+                    item_value = _resolve(item, path, indexes)
+                if item_value is not None:
+                    item_data[item_target_field] = item_value
+            if item_data:
+                items.append(item_data)
+        return items
+
+
+# Per-process agent used by process_json_stream's worker pool.
+_stream_agent = None
+
+
+def _init_stream_worker(target_schema: Dict[str, Any]):
+    global _stream_agent
+    _stream_agent = JSONAgent(memory=None)
+    _stream_agent.target_schema = target_schema
+    _stream_agent.compile_schema()
+
+
+def _map_documents(documents: List[Any]) -> List[Dict[str, Any]]:
+    return [_stream_agent._map_document(data) for data in documents]
+
 
 class JSONAgent:
     def __init__(self, memory):
@@ -26,74 +152,122 @@ class JSONAgent:
             "currency": "currency"
             # Add more fields as needed in your target schema
         }
+        self.compile_schema()
 
+    def compile_schema(self):
+        """Compiles target_schema into the accessor plan used for every payload.
+        Call again after changing target_schema."""
+        self._plan = SchemaPlan(self.target_schema)
+        self._plan_schema = self.target_schema
 
-    def process_json(self, json_payload: str, interaction_id: str) -> Dict[str, Any]:
+
+    def process_json(self, json_payload: Union[str, Document], interaction_id: str) -> Dict[str, Any]:
         """
         Processes a JSON payload, extracts data based on the target schema,
-        and flags anomalies or missing fields.
+        and flags anomalies or missing fields. A Document the classifier
+        already parsed is not parsed again.
         """
         self.memory.initialize_context(interaction_id)
         extracted_data = {}
         anomalies = []
 
         try:
-            data = json.loads(json_payload)
+            if isinstance(json_payload, Document):
+                data = json_payload.json()
+            else:
+                data = json.loads(json_payload)
         except json.JSONDecodeError as e:
             error_message = f"Error decoding JSON payload: {e}"
+            metrics.incr("errors", kind="json_decode", agent="json_agent")
             self.memory.store_data(interaction_id, 'json_processing_error', error_message)
             return {"error": error_message}
 
-        extracted_data = self._extract_data(data, self.target_schema)
-        anomalies = self._flag_anomalies(data, self.target_schema, extracted_data)
+        processing_results = self._map_document(data, interaction_id)
+        self.memory.store_data(interaction_id, 'json_processing_results', processing_results)
+        return processing_results
+
+    def process_json_stream(self, source, interaction_prefix: str = "json", workers: int = None,
+                            batch_size: int = 64) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Processes a file holding many invoices -- NDJSON or one large top-level
+        array -- decoding and mapping one invoice at a time, so memory stays
+        bounded by the largest single invoice rather than the whole file.
+
+        Yields (interaction_id, processing_results) in input order, where the
+        ID is "<interaction_prefix>-<n>" and processing_results has the same
+        shape as process_json's. Each result is also stored in shared memory.
+        An NDJSON line that is not valid JSON gets a result with an "error",
+        like process_json's, and the lines after it are processed as usual.
+
+        Args:
+            source: A path, or a file object opened in binary or text mode.
+            interaction_prefix: Prefix for the per-invoice interaction IDs.
+            workers: When set, mapping is spread over this many processes;
+                only a few batches are in flight at a time.
+            batch_size: Invoices sent to a worker per task.
+        """
+        documents = iter_json_documents(source, invalid_records=True)
+        if workers:
+            results = self._map_in_pool(documents, workers, batch_size)
+        else:
+            results = (self._map_document(data) for data in documents)
+
+        for n, processing_results in enumerate(results, 1):
+            interaction_id = f"{interaction_prefix}-{n}"
+            self.memory.initialize_context(interaction_id)
+            if "error" in processing_results:
+                self.memory.store_data(interaction_id, 'json_processing_error', processing_results["error"])
+            else:
+                self.memory.store_data(interaction_id, 'json_processing_results', processing_results)
+            metrics.incr("json_stream_documents", agent="json_agent")
+            yield interaction_id, processing_results
+
+    def _map_in_pool(self, documents: Iterator[Any], workers: int, batch_size: int) -> Iterator[Dict[str, Any]]:
+        # Imported here so runs that never use a pool skip loading multiprocessing.
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Executor.map would drain the whole input up front; keep a bounded
+        # window of batches in flight instead.
+        window = deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_stream_worker,
+                                 initargs=(self.target_schema,)) as pool:
+            while True:
+                while len(window) < workers * 2:
+                    batch = list(islice(documents, batch_size))
+                    if not batch:
+                        break
+                    window.append(pool.submit(_map_documents, batch))
+                if not window:
+                    return
+                yield from window.popleft().result()
+
+    def _map_document(self, data: Any, interaction_id: str = None) -> Dict[str, Any]:
+        """Maps one decoded invoice onto the target schema and flags anomalies."""
+        if isinstance(data, InvalidRecord):
+            metrics.incr("errors", kind="json_decode", agent="json_agent")
+            return {"error": f"Error decoding JSON payload: {data.error} in {data.text!r}"}
+        with metrics.span("extract", interaction_id, "json_agent"):
+            extracted_data = self._extract_data(data, self.target_schema)
+        with metrics.span("validate", interaction_id, "json_agent"):
+            anomalies = self._flag_anomalies(data, self.target_schema, extracted_data)
 
-        processing_results = {
+        return {
             "extracted_data": extracted_data,
             "anomalies": anomalies
         }
 
-        self.memory.store_data(interaction_id, 'json_processing_results', processing_results)
-        return processing_results
-
     def _get_nested_value(self, data: Dict[str, Any], keys: List[str]) -> Any:
+        """Gets a value from a nested dictionary by a list of keys, matching
+        each key exactly or else case-insensitively."""
         if not data or not keys:
             return None
-        key_to_find = keys[0].lower()
-        for k, v in data.items():
-            if k.lower() == key_to_find:
-                if len(keys) == 1:
-                    return v
-                elif isinstance(v, dict):
-                    return self._get_nested_value(v, keys[1:])
-        return None
+        return _resolve(data, tuple((key, key.casefold()) for key in keys), {})
 
     def _extract_data(self, data: Dict[str, Any], schema: Dict[str, Any]) -> Dict[str, Any]:
-        extracted = {}
-        for target_field, source_path in schema.items():
-            if isinstance(source_path, str):
-                value = self._get_nested_value(data, source_path.split('.'))
-                if value is not None:
-                    extracted[target_field] = value
-            elif isinstance(source_path, list) and target_field == 'items':
-                extracted['items'] = []
-                items_key_options = ["lineitems", "items", "products", "details"]  # Lowercase options
-                found_items_key = None
-                for key in data:
-                    if key.lower() in items_key_options:
-                        found_items_key = key
-                        break
+        plan = self._plan if schema is self._plan_schema else SchemaPlan(schema)
+        return plan.extract(data)
 
-                if found_items_key and isinstance(data.get(found_items_key), list):
-                    for item in data[found_items_key]:
-                        item_data = {}
-                        for item_target_field, item_source_path in source_path[0].items():
-                            item_value = self._get_nested_value(item, item_source_path.split('.'))
-                            if item_value is not None:
-                                item_data[item_target_field] = item_value
-                        if item_data:
-                            extracted['items'].append(item_data)
-        return extracted
-    def _find_list_path(self, schema: Dict[str, Any], data: Dict[str, Any]) -> str or None:
+    def _find_list_path(self, schema: Dict[str, Any], data: Dict[str, Any]) -> Optional[str]:
         """Helper to find the path to the list of items in the source JSON."""
         for key in ["lineItems", "items", "products", "details"]:
             if key in data:
@@ -116,18 +290,6 @@ class JSONAgent:
                 items.append((new_key, v))
         return dict(items)
 
-    def _get_nested_value(self, data: Dict[str, Any], keys: List[str]) -> Any:
-        """Recursively gets a value from a nested dictionary based on a list of keys."""
-        if not data or not keys:
-            return None
-        key = keys[0]
-        if key in data:
-            if len(keys) == 1:
-                return data[key]
-            elif isinstance(data[key], dict):
-                return self._get_nested_value(data[key], keys[1:])
-        return None
-
     def _flag_anomalies(self, data: Dict[str, Any], schema: Dict[str, Any], extracted: Dict[str, Any]) -> List[str]:
         """
         Flags missing fields and potentially type mismatches or unexpected values
@@ -0,0 +1,142 @@
+# agents/registry.py
+import importlib
+import threading
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Optional
+
+from metrics import metrics
+
+# Agent name -> (module, class). Modules are imported only when the agent is
+# first asked for, so a JSON-only run never imports the LLM-backed agents.
+DEFAULT_AGENTS = {
+    "classifier_agent": ("agents.classifier", "InvoiceClassifierAgent"),
+    "invoice_agent": ("agents.invoiceprocess", "InvoiceProcessingAgent"),
+    "json_agent": ("agents.jsonagent", "JSONAgent"),
+    "email_agent": ("agents.emailagent", "EmailAgent"),
+}
+
+# Document format -> the agent that processes it. The only place formats are
+# mapped to agents: route_invoice, the entry points and the pipeline use it.
+ROUTES = {
+    "plain_invoice": "invoice_agent",
+    "pdf": "invoice_agent",
+    "json": "json_agent",
+    "email": "email_agent",
+}
+
+# How each agent is called: (agent, document, format, interaction_id) -> results.
+HANDLERS = {
+    "invoice_agent": lambda agent, document, format, interaction_id: agent.process_invoice(
+        document, "pdf" if format == "pdf" else "text", interaction_id),
+    "json_agent": lambda agent, document, format, interaction_id: agent.process_json(document, interaction_id),
+    "email_agent": lambda agent, document, format, interaction_id: agent.process_email(document, interaction_id),
+}
+
+
+def route_for(format: str) -> Optional[str]:
+    """The name of the agent that processes `format`, or None if there is none."""
+    return ROUTES.get(format)
+
+
+class AgentRegistry:
+    def __init__(self, memory, options: Dict[str, Dict[str, Any]] = None, duplicates=None):
+        """
+        Looks agents up by name and creates each on first use.
+
+        Args:
+            memory: The SharedMemory every agent is constructed with.
+            options: Extra constructor arguments per agent name, e.g.
+                {"invoice_agent": {"cache": cache}}.
+            duplicates: A DuplicateIndex (see dedup.py) that dispatch
+                consults before, and records to after, each extraction.
+        """
+        self.memory = memory
+        self.options = dict(options or {})
+        self.duplicates = duplicates
+        self._factories = {}
+        self._agents = {}
+        self._lock = threading.Lock()
+        for name, (module, class_name) in DEFAULT_AGENTS.items():
+            self.register(name, _lazy_factory(module, class_name))
+
+    def register(self, name: str, factory: Callable[..., Any]):
+        """
+        Registers (or replaces) the factory for `name`. It is called as
+        factory(memory, **options[name]) the first time the agent is needed.
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._agents.pop(name, None)
+
+    def get(self, name: str):
+        """Returns the agent called `name`, creating it on first use."""
+        agent = self._agents.get(name)
+        if agent is not None:
+            return agent
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is None:
+                factory = self._factories.get(name)
+                if factory is None:
+                    raise KeyError(f"No agent registered as {name!r}")
+                with metrics.span("agent_init", None, name):
+                    agent = factory(self.memory, **self.options.get(name, {}))
+                self._agents[name] = agent
+        return agent
+
+    def dispatch(self, document, format: str, interaction_id: str) -> Dict[str, Any]:
+        """
+        Processes `document` with the agent its format routes to.
+
+        Args:
+            document: The document, as a Document or a string.
+            format: Its classified format ("plain_invoice", "pdf", "json", "email").
+            interaction_id: The interaction the results belong to.
+
+        Returns:
+            The agent's results. With a duplicate index, a document seen
+            before is not processed: the results are {"duplicate": {"kind",
+            "of", "similarity"}}, naming the interaction that processed the
+            earlier copy. Results found to repeat an earlier invoice only
+            once extracted carry the same "duplicate" entry.
+
+        Raises:
+            LookupError: If no agent handles `format`.
+        """
+        name = route_for(format)
+        if name is None:
+            raise LookupError(f"No suitable agent found for the format {format!r}.")
+        if self.duplicates is None:
+            return HANDLERS[name](self.get(name), document, format, interaction_id)
+
+        fingerprint, duplicate = self.duplicates.screen(document, format)
+        if duplicate is not None:
+            self._record_duplicate(duplicate, interaction_id, name)
+            return {"duplicate": duplicate}
+        results = HANDLERS[name](self.get(name), document, format, interaction_id)
+        if isinstance(results, Mapping) and "error" not in results:
+            duplicate = self.duplicates.add(fingerprint, interaction_id, results)
+            if duplicate is not None:
+                self._record_duplicate(duplicate, interaction_id, name)
+                results = {**results, "duplicate": duplicate}
+        return results
+
+    def _record_duplicate(self, duplicate: Dict[str, Any], interaction_id: str, name: str):
+        metrics.incr("duplicates", kind=duplicate["kind"], agent=name)
+        self.memory.store_data(interaction_id, "duplicate_of", duplicate)
+
+    def __getitem__(self, name: str):
+        return self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._factories
+
+    def created(self) -> Dict[str, Any]:
+        """The agents created so far, by name."""
+        return dict(self._agents)
+
+
+def _lazy_factory(module: str, class_name: str) -> Callable[..., Any]:
+    def factory(memory, **kwargs):
+        return getattr(importlib.import_module(module), class_name)(memory, **kwargs)
+    return factory
@@ -0,0 +1,460 @@
+# batch.py
+import argparse
+import glob
+import os
+import signal
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+from dedup import DuplicateIndex
+from document import read_document
+from memory import SharedMemory, SQLiteMemoryBackend
+from llmcache import ExtractionCache
+from llmresilience import set_process_count, set_rate
+from manifest import FileState, ProcessingManifest, record_error
+from metrics import metrics
+from agents.formatmodel import FormatModel
+from agents.registry import AgentRegistry
+from pipeline import Pipeline
+from sinks import JSONLSink, open_sink
+
+# Per-worker agents. Each pool process sets up a registry once in
+# _init_worker; an agent is built the first time the worker is handed a file
+# that needs it and reused for every file after that.
+_worker = {}
+
+
+def _init_worker(cache_path: str = None, memory_db: str = None, metrics_enabled: bool = False,
+                 in_pool: bool = False, format_model: str = None, dedup_index: str = None, processes: int = 1,
+                 llm_rate: Optional[float] = None):
+    _close_worker()
+    metrics.enabled = metrics.enabled or metrics_enabled
+    _worker["in_pool"] = in_pool
+    if in_pool:
+        # Ctrl-C is for the parent, which shuts the pool down.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The pool's workers split the LLM rate between them.
+    if llm_rate is not None:
+        set_rate(llm_rate)
+    set_process_count(processes)
+    if memory_db:
+        shared_memory = SharedMemory(backend=SQLiteMemoryBackend(memory_db))
+    else:
+        shared_memory = SharedMemory()
+    _worker["persistent"] = bool(memory_db)
+    cache = _worker["cache"] = ExtractionCache(cache_path) if cache_path else None
+    duplicates = _worker["duplicates"] = DuplicateIndex(dedup_index) if dedup_index else None
+    _worker["memory"] = shared_memory
+    model = FormatModel.load(format_model) if format_model else None
+    _worker["agents"] = AgentRegistry(shared_memory, options={
+        "classifier_agent": {"model": model},
+        # Pool workers already run in parallel, so they extract PDF pages serially.
+        "invoice_agent": {"cache": cache, "pdf_workers": 1 if in_pool else None},
+    }, duplicates=duplicates)
+
+
+def _close_worker():
+    """Closes the memory, cache and duplicate index _init_worker opened in this process."""
+    if not _worker:
+        return
+    _worker["memory"].close()
+    for resource in (_worker["cache"], _worker["duplicates"]):
+        if resource is not None:
+            resource.close()
+    _worker.clear()
+
+
+def _process_file(file_path: str) -> Dict[str, Any]:
+    """Runs classify -> route -> process for one file inside a worker."""
+    if not _worker:
+        _init_worker()
+    shared_memory = _worker["memory"]
+    agents = _worker["agents"]
+    classifier_agent = agents.get("classifier_agent")
+
+    started = time.perf_counter()
+    record = {"file": file_path, "interaction_id": None, "format": None, "agent": None}
+
+    with metrics.span("read", None, "batch"):
+        document = read_document(file_path)
+    if document is None:
+        record["error"] = "Could not read invoice data from the file."
+        metrics.incr("errors", kind="read", agent="batch")
+    else:
+        interaction_id = str(uuid.uuid4())
+        record["interaction_id"] = interaction_id
+        shared_memory.initialize_context(interaction_id)
+        try:
+            # The classifier leaves what it decoded and parsed on the
+            # document, so the agents below work from it without re-parsing.
+            classification = classifier_agent.classify_invoice(document, interaction_id)
+            record["format"] = classification.get("format")
+            target_agent = classifier_agent.route_invoice(document, classification, interaction_id)
+            record["agent"] = target_agent
+
+            if target_agent is not None:
+                record["results"] = agents.dispatch(document, record["format"], interaction_id)
+            else:
+                record["error"] = "No suitable agent found for the given format."
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            metrics.incr("errors", kind="unhandled", agent=record["agent"])
+        finally:
+            document.close()
+            if _worker["persistent"]:
+                # Commit this document's context before reporting it done.
+                shared_memory.flush()
+            else:
+                # The result is written out by the parent; nothing else
+                # reads this context, so don't let it accumulate.
+                shared_memory.release(interaction_id)
+
+    record["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    if metrics.enabled and _worker["in_pool"]:
+        # Worker totals ride back with each record; the parent merges them.
+        record["_metrics"] = metrics.drain()
+    return record
+
+
+def expand_inputs(inputs: Iterable[str]) -> List[str]:
+    """
+    Expands a mix of directories, glob patterns and file paths into a sorted,
+    de-duplicated list of files.
+
+    Args:
+        inputs: Directory paths, glob patterns or plain file paths.
+
+    Returns:
+        The list of file paths to process.
+    """
+    files = []
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(item)
+                for name in names
+            )
+        elif glob.has_magic(item):
+            candidates = sorted(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+        else:
+            candidates = [item]
+        for path in candidates:
+            if path not in seen:
+                seen.add(path)
+                files.append(path)
+    return files
+
+
+def run_batch(file_paths: List[str], workers: int = None, chunksize: int = None,
+              cache_path: str = None, memory_db: str = None,
+              format_model: str = None, dedup_index: str = None) -> Iterator[Dict[str, Any]]:
+    """
+    Processes files over a process pool, yielding one result record per file
+    in input order.
+
+    Args:
+        file_paths: The files to process.
+        workers: Pool size; defaults to the number of CPU cores.
+        chunksize: Files handed to a worker per task; defaults to a value that
+            keeps every worker busy without flooding the result queue.
+        cache_path: Optional SQLite file shared by all workers to cache LLM
+            extraction results across runs.
+        memory_db: Optional SQLite file holding shared memory, so every
+            worker's interaction context is persisted and visible to the others.
+        format_model: Optional FormatModel file (see agents/formatmodel.py)
+            consulted for documents the classifier's rules are unsure of.
+        dedup_index: Optional DuplicateIndex file (see dedup.py) shared by
+            all workers; documents seen before, in this run or an earlier
+            one, are reported as duplicates instead of being processed.
+    """
+    with BatchRunner(workers, chunksize, cache_path, memory_db, format_model, dedup_index) as runner:
+        yield from runner.run(file_paths)
+
+
+def run_pipeline(file_paths: Iterable[str], cpu_workers: int = 1, io_workers: int = 8, queue_size: int = 64,
+                 cache_path: str = None, memory_db: str = None,
+                 format_model: str = None, dedup_index: str = None) -> Iterator[Dict[str, Any]]:
+    """
+    Processes files through a staged Pipeline in this process, yielding one
+    result record per file in the order they complete. Suits batches where
+    LLM-backed invoices would otherwise hold up the cheap email and JSON
+    documents.
+
+    Args:
+        file_paths: The files to process.
+        cpu_workers: Threads for each CPU stage (classification, email and
+            JSON extraction).
+        io_workers: Threads for each IO stage (reading, LLM-backed extraction).
+        queue_size: Documents that may wait in front of each stage.
+        cache_path, memory_db, format_model, dedup_index: As for run_batch.
+    """
+    with BatchRunner(cpu_workers, None, cache_path, memory_db, format_model, dedup_index,
+                     pipeline=True, io_workers=io_workers, queue_size=queue_size) as runner:
+        yield from runner.run(file_paths)
+
+
+class BatchRunner:
+    def __init__(self, workers: int = None, chunksize: int = None, cache_path: str = None, memory_db: str = None,
+                 format_model: str = None, dedup_index: str = None, pipeline: bool = False,
+                 io_workers: int = 8, queue_size: int = 64, llm_rate: Optional[float] = None):
+        """
+        The agents behind run_batch and run_pipeline, set up once and kept
+        warm for any number of runs, as a watched folder needs: the process
+        pool, or the agents with their cache and database connections in
+        this process. close() releases them.
+
+        Args:
+            workers: Pool size (default: CPU count); with `pipeline`,
+                threads for each CPU stage (default: 1).
+            chunksize: Files handed to a pool worker per task; by default
+                chosen per run from its number of files.
+            cache_path, memory_db, format_model, dedup_index: As for run_batch.
+            pipeline: Run the files through a staged Pipeline in this
+                process (see run_pipeline) instead of a process pool.
+            io_workers, queue_size: With `pipeline`, as for run_pipeline.
+            llm_rate: LLM requests per second for the whole run, 0 for no
+                limit (default: FLOW_LLM_RATE, or no limit).
+        """
+        self.chunksize = chunksize
+        self._pool = None
+        self._pipeline = None
+        if pipeline:
+            self.workers = workers or 1
+            _init_worker(cache_path, memory_db, metrics.enabled, format_model=format_model, dedup_index=dedup_index,
+                         llm_rate=llm_rate)
+            self._pipeline = Pipeline(_worker["agents"], self.workers, io_workers, queue_size,
+                                      persistent=_worker["persistent"])
+        else:
+            self.workers = workers or os.cpu_count() or 1
+            if self.workers == 1:
+                _init_worker(cache_path, memory_db, metrics.enabled, format_model=format_model,
+                             dedup_index=dedup_index, llm_rate=llm_rate)
+            else:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker,
+                    initargs=(cache_path, memory_db, metrics.enabled, True, format_model, dedup_index, self.workers,
+                              llm_rate),
+                )
+
+    def run(self, file_paths: List[str]) -> Iterator[Dict[str, Any]]:
+        """Processes the files, yielding records as run_batch (or, with a pipeline, run_pipeline) does."""
+        if self._pipeline is not None:
+            yield from self._pipeline.run(file_paths)
+        elif self._pool is not None:
+            chunksize = self.chunksize or max(1, min(64, len(file_paths) // (self.workers * 4) or 1))
+            yield from self._pool.map(_process_file, file_paths, chunksize=chunksize)
+        else:
+            for path in file_paths:
+                yield _process_file(path)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+        else:
+            _close_worker()
+
+    def __enter__(self) -> "BatchRunner":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _commit(sinks: List[Any], manifest: ProcessingManifest, done: List[Tuple[FileState, Dict[str, Any]]]):
+    # Results are written out before the manifest records them, so a file is
+    # never marked done without its results; after a crash between the two
+    # it is processed again.
+    for sink in sinks:
+        sink.flush()
+    manifest.complete(done)
+
+
+def _own_paths(args) -> List[str]:
+    """The files (and sink directories) this run writes to, as absolute paths."""
+    paths = [args.output, args.manifest, args.llm_cache, args.memory_db, args.dedup_index]
+    for spec in args.sink:
+        target = spec.partition(":")[2]
+        if target != "-":
+            paths.append(target)
+    return [os.path.abspath(path) for path in paths if path]
+
+
+def _is_own_file(path: str, own_paths: List[str]) -> bool:
+    path = os.path.abspath(path)
+    for own in own_paths:
+        # SQLite keeps its journal next to the database.
+        if path in (own, own + "-wal", own + "-shm", own + "-journal") or path.startswith(own + os.sep):
+            return True
+    return False
+
+
+def _run_pass(runner: BatchRunner, file_paths: List[str], args, sinks: List[Any],
+              manifest: ProcessingManifest = None, states: Dict[str, FileState] = None):
+    """Processes `file_paths`, writes each record to every sink and prints a summary."""
+    counts = {}
+    errors = 0
+    done = []
+    started = time.perf_counter()
+    try:
+        for record in runner.run(file_paths):
+            worker_metrics = record.pop("_metrics", None)
+            if worker_metrics:
+                metrics.merge(worker_metrics)
+            for sink in sinks:
+                sink.write(record)
+            counts[record.get("format")] = counts.get(record.get("format"), 0) + 1
+            if record_error(record)[0] is not None:
+                errors += 1
+            if manifest is not None:
+                done.append((states[record["file"]], record))
+                if len(done) >= args.flush_records:
+                    _commit(sinks, manifest, done)
+                    done = []
+    finally:
+        # Also on Ctrl-C: what finished is recorded, so a restart skips it.
+        if done:
+            _commit(sinks, manifest, done)
+    elapsed = time.perf_counter() - started
+
+    total = len(file_paths)
+    print("\n--- Batch Summary ---", file=sys.stderr)
+    print(f"Files processed: {total} ({errors} with errors)", file=sys.stderr)
+    for format, count in sorted(counts.items(), key=lambda kv: str(kv[0])):
+        print(f"  {format}: {count}", file=sys.stderr)
+    print(f"Elapsed: {elapsed:.2f}s", file=sys.stderr)
+    print(f"Throughput: {total / elapsed if elapsed else float('inf'):.1f} files/s", file=sys.stderr)
+    print("---------------------", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Classify and process a batch of invoice files, one JSONL record per file."
+    )
+    parser.add_argument("inputs", nargs="+", help="Files, directories or glob patterns to process.")
+    parser.add_argument("-o", "--output", help="Write JSONL results here instead of stdout.")
+    parser.add_argument("--sink", action="append", default=[], metavar="KIND:PATH",
+                        help="Also write results to a sink: sqlite:results.db, csv:DIR, parquet:DIR or "
+                             "jsonl:PATH. May be repeated. Without -o, results then go only to the sinks.")
+    parser.add_argument("--flush-records", type=int, default=500,
+                        help="Results buffered before a sink writes them out.")
+    parser.add_argument("--flush-seconds", type=float, default=5.0,
+                        help="Seconds a buffered result may wait before its sink writes it out.")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Worker processes (default: CPU count); with --pipeline, threads per CPU stage.")
+    parser.add_argument("--chunksize", type=int, default=None, help="Files per worker task.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run the stages concurrently in one process instead of a process per file "
+                             "(results are written as they complete).")
+    parser.add_argument("--io-workers", type=int, default=8,
+                        help="With --pipeline: threads for reading files and LLM-backed extraction.")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="With --pipeline: documents that may wait in front of each stage.")
+    parser.add_argument("--llm-cache", metavar="PATH", default=None,
+                        help="SQLite file caching LLM extractions, so re-runs skip already-extracted invoices.")
+    parser.add_argument("--llm-rate", type=float, default=None, metavar="PER_SECOND",
+                        help="LLM requests per second for the whole run, split between the workers; 0 for no "
+                             "limit (default: $FLOW_LLM_RATE, or no limit).")
+    parser.add_argument("--memory-db", metavar="PATH", default=None,
+                        help="Persist shared memory to this SQLite file instead of discarding it per file.")
+    parser.add_argument("--format-model", metavar="PATH", default=None,
+                        help="Trained format model for documents the classification rules are unsure of.")
+    parser.add_argument("--dedup-index", metavar="PATH", default=None,
+                        help="SQLite index of documents already processed; exact, near and same-invoice copies "
+                             "are reported as duplicates instead of being extracted again.")
+    parser.add_argument("--manifest", metavar="PATH", default=None,
+                        help="Record processed files (size, mtime, SHA-256) here and skip those unchanged since; "
+                             "an interrupted run resumes where it stopped. -o then appends.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep scanning the inputs and process new or changed files as they arrive "
+                             "(uses --manifest, flow_manifest.sqlite3 by default).")
+    parser.add_argument("--interval", type=float, default=5.0, help="With --watch: seconds between scans.")
+    parser.add_argument("--settle-seconds", type=float, default=1.0,
+                        help="With a manifest: leave files modified this recently for the next scan.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="With a manifest: process unchanged files that failed last time again "
+                             "(files that failed because the LLM was unavailable always are).")
+    parser.add_argument("--metrics", metavar="PATH", default=None,
+                        help="Record per-stage timings and counters and write them here "
+                             "(.prom for Prometheus text format, otherwise JSON).")
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enabled = True
+
+    if args.watch and not args.manifest:
+        args.manifest = "flow_manifest.sqlite3"
+    # Outputs may live in a scanned folder; they are never inputs, or a
+    # watched folder would feed on its own results.
+    own_paths = _own_paths(args)
+    file_paths = [path for path in expand_inputs(args.inputs) if not _is_own_file(path, own_paths)]
+    if not file_paths and not args.watch:
+        print("No input files found.", file=sys.stderr)
+        return 1
+
+    options = {"batch_size": args.flush_records, "flush_interval": args.flush_seconds}
+    sinks = []
+    try:
+        for spec in args.sink:
+            sinks.append(open_sink(spec, **options))
+    except (ValueError, ImportError, OSError) as e:
+        for sink in sinks:
+            sink.close()
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    if args.output:
+        if not args.manifest:
+            # -o starts the file afresh each run, as it always has; with a
+            # manifest the results of earlier runs stay in it.
+            open(args.output, "w").close()
+        sinks.append(JSONLSink(args.output, **options))
+    elif not sinks:
+        sinks.append(JSONLSink(sys.stdout, **options))
+
+    manifest = ProcessingManifest(args.manifest) if args.manifest else None
+    runner = None
+    try:
+        # Built once, so a watch keeps its agents (or pool) warm between scans.
+        if args.pipeline:
+            runner = BatchRunner(args.workers, None, args.llm_cache, args.memory_db, args.format_model,
+                                 args.dedup_index, pipeline=True, io_workers=args.io_workers,
+                                 queue_size=args.queue_size, llm_rate=args.llm_rate)
+        else:
+            runner = BatchRunner(args.workers, args.chunksize, args.llm_cache, args.memory_db, args.format_model,
+                                 args.dedup_index, llm_rate=args.llm_rate)
+        while True:
+            if manifest is None:
+                _run_pass(runner, file_paths, args, sinks)
+                break
+            states = {state.path: state
+                      for state in manifest.pending(file_paths, args.settle_seconds, args.retry_failed)}
+            if states:
+                _run_pass(runner, [path for path in file_paths if path in states], args, sinks, manifest, states)
+            elif not args.watch:
+                print("No new or changed files.", file=sys.stderr)
+            if not args.watch:
+                break
+            time.sleep(args.interval)
+            file_paths = [path for path in expand_inputs(args.inputs) if not _is_own_file(path, own_paths)]
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+    finally:
+        if runner is not None:
+            runner.close()
+        for sink in sinks:
+            sink.close()
+        if manifest is not None:
+            manifest.close()
+
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.export_prometheus() if args.metrics.endswith(".prom") else metrics.export_json())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
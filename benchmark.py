@@ -0,0 +1,235 @@
+# benchmark.py
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, Any, Callable, List, Tuple
+
+from invoicegen import generate_documents, parse_item_range
+from llmclient import FakeLLMClient
+from memory import SharedMemory
+from agents.classifier import InvoiceClassifierAgent
+from agents.emailagent import EmailAgent
+from agents.jsonagent import JSONAgent
+from agents.invoiceprocess import InvoiceProcessingAgent
+
+# A benchmark is (setup, operation): setup(documents_per_kind) returns the
+# list of inputs, and operation is called once per input and timed.
+Benchmark = Tuple[Callable[[Dict[str, List[str]]], List[Any]], Callable[[Any], Any]]
+
+# Returned by the stub LLM for the text path: a typical extraction.
+_STUB_RESPONSE = json.dumps({
+    "invoice_number": "INV-2025-000001", "invoice_date": "2025-05-29",
+    "seller": "Acme Corp", "buyer": "Beta Industries",
+    "line_items": [{"description": "Widget A", "quantity": 10, "unit_price": 10.0, "amount": 100.0, "tax": 8.0}],
+    "subtotal": 100.0, "total_tax_amount": 8.0, "total_amount": 108.0, "currency": "USD",
+})
+
+
+def _benchmarks() -> Dict[str, Benchmark]:
+    classifier_agent = InvoiceClassifierAgent(SharedMemory())
+    email_agent = EmailAgent(memory=None)
+    json_agent = JSONAgent(memory=None)
+    text_memory = SharedMemory()
+    # No fast path, so every invoice goes through compaction, the prompt
+    # and response parsing; the stub answers at once.
+    text_agent = InvoiceProcessingAgent(text_memory, FakeLLMClient(_STUB_RESPONSE), use_fast_path=False)
+    template_agent = InvoiceProcessingAgent(SharedMemory(), FakeLLMClient(_STUB_RESPONSE))
+    shared_memory = SharedMemory()
+
+    def mixed(docs):
+        return [doc for group in zip(docs["plain"], docs["email"], docs["json"]) for doc in group]
+
+    def text_invoice(item):
+        interaction_id, text = item
+        text_memory.initialize_context(interaction_id)
+        result = text_agent.process_text_invoice(text, interaction_id)
+        text_memory.release(interaction_id)
+        return result
+
+    def memory_round_trip(item):
+        interaction_id, details = item
+        shared_memory.initialize_context(interaction_id)
+        shared_memory.store_data(interaction_id, "invoice_format", "email")
+        shared_memory.store_data(interaction_id, "extracted_data", details)
+        shared_memory.retrieve_data(interaction_id, "extracted_data")
+        shared_memory.release(interaction_id)
+
+    return {
+        "detect_invoice_format": (mixed, classifier_agent._detect_invoice_format),
+        "email_extract_invoice_details": (
+            lambda docs: [email_agent._extract_email_body(doc) for doc in docs["email"]],
+            email_agent._extract_invoice_details,
+        ),
+        "json_extract_data": (
+            lambda docs: [json.loads(doc) for doc in docs["json"]],
+            lambda data: json_agent._extract_data(data, json_agent.target_schema),
+        ),
+        "shared_memory_round_trip": (
+            lambda docs: [(f"bench-{n}", email_agent._extract_invoice_details(email_agent._extract_email_body(doc)))
+                          for n, doc in enumerate(docs["email"])],
+            memory_round_trip,
+        ),
+        "text_invoice_stub_llm": (
+            lambda docs: [(f"bench-{n}", doc) for n, doc in enumerate(docs["plain"])],
+            text_invoice,
+        ),
+        "text_invoice_fast_path": (
+            lambda docs: docs["plain"],
+            template_agent._fast_path_extract,
+        ),
+    }
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(inputs: List[Any], operation: Callable[[Any], Any], repeat: int = 3) -> Dict[str, float]:
+    """
+    Times `operation` over every input, `repeat` times after one warm-up
+    pass, and measures peak memory in a separate traced pass so tracing does
+    not skew the timings.
+
+    Returns:
+        ops_per_sec (best pass), p50_us, p95_us and p99_us (over all
+        passes), and peak_kib, the most memory allocated at once above what
+        was in use before the traced pass.
+    """
+    for item in inputs:
+        operation(item)
+    latencies = []
+    best = 0.0
+    clock = time.perf_counter_ns
+    for _ in range(repeat):
+        gc.collect()
+        started = clock()
+        for item in inputs:
+            before = clock()
+            operation(item)
+            latencies.append(clock() - before)
+        elapsed = (clock() - started) / 1e9
+        best = max(best, len(inputs) / elapsed if elapsed else float("inf"))
+    latencies.sort()
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for item in inputs:
+        operation(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": round(best, 1),
+        "p50_us": round(_percentile(latencies, 0.50) / 1000, 2),
+        "p95_us": round(_percentile(latencies, 0.95) / 1000, 2),
+        "p99_us": round(_percentile(latencies, 0.99) / 1000, 2),
+        "peak_kib": round((peak - baseline) / 1024, 1),
+    }
+
+
+def run_benchmarks(count: int = 300, items: Tuple[int, int] = (3, 30), description_words: int = 2,
+                   repeat: int = 3, only: List[str] = None, seed: int = 0) -> Dict[str, Any]:
+    """
+    Runs the suite on freshly generated invoices.
+
+    Args:
+        count: Invoices generated per kind (plain, email, JSON).
+        items: The (least, most) line items per invoice.
+        description_words: Extra words per line item description.
+        repeat: Timed passes per benchmark.
+        only: Names of the benchmarks to run; all by default.
+        seed: Seed for the invoice generator.
+
+    Returns:
+        {"params": ..., "results": {name: measurements}}, the format
+        saved as a baseline.
+    """
+    docs = {kind: generate_documents(count, kind, seed, items, description_words)
+            for kind in ("plain", "email", "json")}
+    results = {}
+    for name, (setup, operation) in _benchmarks().items():
+        if only and name not in only:
+            continue
+        results[name] = measure(setup(docs), operation, repeat)
+    return {
+        "params": {"count": count, "items": list(items), "description_words": description_words, "seed": seed,
+                   "python": platform.python_version(), "machine": platform.machine()},
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+    """
+    Lists the regressions of `current` against `baseline`: throughput down,
+    or p95 latency or peak memory up, by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    for name, now in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        if now["ops_per_sec"] < before["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['ops_per_sec']} -> {now['ops_per_sec']} ops/s")
+        if now["p95_us"] > before["p95_us"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 latency {before['p95_us']} -> {now['p95_us']} us")
+        # Small absolute changes in memory are noise, whatever the ratio.
+        if now["peak_kib"] > before["peak_kib"] * (1 + tolerance) and now["peak_kib"] - before["peak_kib"] > 64:
+            regressions.append(f"{name}: peak memory {before['peak_kib']} -> {now['peak_kib']} KiB")
+    return regressions
+
+
+def _print_report(report: Dict[str, Any], baseline: Dict[str, Any] = None):
+    print(f"{'benchmark':<32}{'ops/s':>12}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'peak KiB':>11}"
+          + ("   vs baseline" if baseline else ""))
+    for name, result in report["results"].items():
+        line = (f"{name:<32}{result['ops_per_sec']:>12,.1f}{result['p50_us']:>10.2f}{result['p95_us']:>10.2f}"
+                f"{result['p99_us']:>10.2f}{result['peak_kib']:>11.1f}")
+        before = (baseline or {}).get("results", {}).get(name)
+        if before and before["ops_per_sec"]:
+            line += f"   {(result['ops_per_sec'] / before['ops_per_sec'] - 1) * 100:+.1f}% ops/s"
+        print(line)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the classifier, agents and shared memory.")
+    parser.add_argument("--count", type=int, default=300, help="Invoices generated per format.")
+    parser.add_argument("--items", type=parse_item_range, default=(3, 30), metavar="MIN-MAX",
+                        help="Line items per invoice, e.g. 10 or 5-200.")
+    parser.add_argument("--description-words", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes per benchmark.")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="Run only these benchmarks.")
+    parser.add_argument("--save", metavar="PATH", help="Write the results here, for use as a baseline.")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="Compare with a saved run; exits with 1 if anything regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed change against the baseline, as a fraction (default 0.2).")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.count, args.items, args.description_words, args.repeat, args.only)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("params", {}).get("count") != args.count or \
+                baseline.get("params", {}).get("items") != list(args.items):
+            print("Warning: the baseline was run with different --count/--items.", file=sys.stderr)
+    _print_report(report, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+# dedup.py
+import hashlib
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from document import Document
+from invoicerecord import invoice_fields
+from mailreader import email_body
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"\w+")
+_DIGIT = re.compile(r"\d")
+# Company-form words ignored when vendors are compared ("Acme Corp" = "ACME Corporation").
+_COMPANY_FORMS = {"inc", "incorporated", "corp", "corporation", "co", "company", "ltd", "limited", "llc", "plc",
+                  "gmbh", "sa", "ag", "bv"}
+# MinHash permutations are taken modulo this prime (2**61 - 1).
+_PRIME = (1 << 61) - 1
+# Candidates read per lookup; buckets holding more are mostly boilerplate.
+_MAX_CANDIDATES = 100
+
+
+class Fingerprint:
+    """What the index knows about one document before it is extracted."""
+    __slots__ = ("content_hash", "numbers_hash", "signature")
+
+    def __init__(self, content_hash: str, numbers_hash: Optional[str], signature: Optional[array]):
+        self.content_hash = content_hash
+        self.numbers_hash = numbers_hash
+        self.signature = signature
+
+
+def semantic_key(results: Any) -> Optional[str]:
+    """
+    The key two extractions of the same invoice share, whatever format it
+    arrived in: the invoice number (letters and digits only), the vendor
+    (without company forms like "Inc.") and the total to the cent. None
+    when the results lack the invoice number or total.
+    """
+    fields = invoice_fields(results)
+    number = fields.get("invoice_number")
+    total = fields.get("total_amount")
+    vendor = fields.get("vendor")
+    if hasattr(vendor, "get"):
+        vendor = vendor.get("name") or vendor.get("Name")
+    if not number or total is None:
+        return None
+    try:
+        total = f"{float(total):.2f}"
+    except (TypeError, ValueError):
+        return None
+    number = "".join(_TOKEN.findall(str(number))).upper()
+    vendor = " ".join(t for t in _TOKEN.findall(str(vendor or "").lower()) if t not in _COMPANY_FORMS)
+    return f"{number}|{vendor}|{total}"
+
+
+class DuplicateIndex:
+    def __init__(self, path: str = "duplicates.sqlite3", threshold: float = 0.7, num_perm: int = 64,
+                 bands: int = 16, shingle_size: int = 5):
+        """
+        A persistent index of the documents seen so far, consulted before a
+        document is extracted so resent invoices skip the agents (and the
+        LLM). Three keys find a duplicate:
+
+        * exact: the SHA-256 of the text with whitespace collapsed (of the
+          bytes, for PDFs);
+        * near: MinHash signatures over word shingles, bucketed by LSH, for
+          copies that differ in a few lines (an email wrapped around a text
+          invoice, a re-export with another footer). Near copies must also
+          hold exactly the same numbers: a revised invoice that changes one
+          quantity is as similar as an email wrapper, but is a new invoice;
+        * semantic: invoice number + vendor + total from the extracted
+          results, for the same invoice in another format. It is only known
+          after extraction, so these are flagged rather than skipped.
+
+        Lookups touch a few indexed SQLite rows whatever the index size, so
+        it holds millions of documents. Several processes may share the file.
+
+        Args:
+            path: The SQLite file (":memory:" for an index local to the process).
+            threshold: Estimated Jaccard similarity from which two documents
+                are near-duplicates.
+            num_perm: MinHash values per signature.
+            bands: LSH bands the signature is cut into; more bands find
+                less similar candidates. Must divide num_perm.
+            shingle_size: Words per shingle.
+        """
+        if num_perm % bands:
+            raise ValueError("bands must divide num_perm")
+        self.path = path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # Fixed seeds: signatures must compare across runs and processes.
+        rng = random.Random(20250529)
+        self._permutations = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not cross a fork; workers reopen the database.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " id INTEGER PRIMARY KEY,"
+                " interaction_id TEXT,"
+                " content_hash TEXT NOT NULL UNIQUE,"
+                " semantic_key TEXT,"
+                " numbers_hash TEXT,"
+                " signature BLOB,"
+                " created_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS documents_semantic ON documents (semantic_key);"
+                "CREATE TABLE IF NOT EXISTS lsh_buckets ("
+                " band INTEGER NOT NULL,"
+                " bucket INTEGER NOT NULL,"
+                " document_id INTEGER NOT NULL,"
+                " PRIMARY KEY (band, bucket, document_id)) WITHOUT ROWID;"
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def fingerprint(self, document: Union[str, Document], format: str = None) -> Fingerprint:
+        """
+        Hashes and signs a document. PDFs are hashed by their bytes and get
+        no signature. The signature and numbers of an email are taken from
+        its body, so headers (dates, message IDs) do not tell a wrapped copy
+        of an invoice from the invoice itself.
+        """
+        if format == "pdf":
+            data = document.raw if isinstance(document, Document) and document.raw is not None else document
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            return Fingerprint(hashlib.sha256(data).hexdigest(), None, None)
+        text = document.text if isinstance(document, Document) else document
+        content_hash = hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+        if format == "email":
+            text = email_body(text)
+        tokens = _TOKEN.findall(text.lower())
+        numbers = sorted({token for token in tokens if _DIGIT.search(token)})
+        numbers_hash = hashlib.sha256(" ".join(numbers).encode("utf-8")).hexdigest()
+        return Fingerprint(content_hash, numbers_hash, self._signature(tokens))
+
+    def _signature(self, tokens: List[str]) -> Optional[array]:
+        size = self.shingle_size
+        if len(tokens) < size:
+            return None
+        hashes = {
+            int.from_bytes(hashlib.blake2b(" ".join(tokens[i:i + size]).encode("utf-8"), digest_size=8).digest(),
+                           "little")
+            for i in range(len(tokens) - size + 1)
+        }
+        return array("Q", [min([(a * h + b) % _PRIME for h in hashes]) for a, b in self._permutations])
+
+    def _buckets(self, signature: array) -> List[Tuple[int, int]]:
+        rows = self.rows
+        buckets = []
+        for band in range(self.bands):
+            digest = hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest()
+            buckets.append((band, int.from_bytes(digest, "little", signed=True)))
+        return buckets
+
+    def check(self, fingerprint: Fingerprint) -> Optional[Dict[str, Any]]:
+        """
+        Looks a document up before extraction.
+
+        Returns:
+            None for a new document, else {"kind": "exact" or "near", "of":
+            the interaction ID of the earlier copy, "similarity": estimated
+            Jaccard similarity (1.0 for exact)}.
+        """
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT interaction_id FROM documents WHERE content_hash = ?",
+                               (fingerprint.content_hash,)).fetchone()
+            if row is not None:
+                return {"kind": "exact", "of": row[0], "similarity": 1.0}
+            if fingerprint.signature is None:
+                return None
+            buckets = self._buckets(fingerprint.signature)
+            candidates = conn.execute(
+                "SELECT interaction_id, signature FROM documents WHERE numbers_hash = ? AND id IN ("
+                " SELECT document_id FROM lsh_buckets WHERE (band, bucket) IN"
+                f" (VALUES {', '.join(['(?, ?)'] * len(buckets))}) LIMIT {_MAX_CANDIDATES})",
+                [fingerprint.numbers_hash] + [value for bucket in buckets for value in bucket],
+            ).fetchall()
+        best = None
+        for interaction_id, blob in candidates:
+            other = array("Q")
+            other.frombytes(blob)
+            similarity = sum(x == y for x, y in zip(fingerprint.signature, other)) / self.num_perm
+            if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                best = {"kind": "near", "of": interaction_id, "similarity": round(similarity, 3)}
+        return best
+
+    def add(self, fingerprint: Fingerprint, interaction_id: str, results: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        Records a processed document. Results without a semantic key
+        (a failed LLM call, a partial extraction) are not recorded, so the
+        document is processed again when it comes back.
+
+        Returns:
+            {"kind": "exact", ...} if another process added the same content
+            meanwhile, {"kind": "semantic", ...} if an earlier document had
+            the same semantic key, else None.
+        """
+        key = semantic_key(results)
+        if key is None:
+            return None
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                earlier = conn.execute("SELECT interaction_id FROM documents WHERE semantic_key = ? LIMIT 1",
+                                       (key,)).fetchone()
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO documents"
+                    " (interaction_id, content_hash, semantic_key, numbers_hash, signature, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (interaction_id, fingerprint.content_hash, key, fingerprint.numbers_hash,
+                     fingerprint.signature.tobytes() if fingerprint.signature is not None else None, time.time()),
+                )
+                if not cursor.rowcount:
+                    row = conn.execute("SELECT interaction_id FROM documents WHERE content_hash = ?",
+                                       (fingerprint.content_hash,)).fetchone()
+                    conn.execute("COMMIT")
+                    return {"kind": "exact", "of": row[0], "similarity": 1.0}
+                if fingerprint.signature is not None:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO lsh_buckets (band, bucket, document_id) VALUES (?, ?, ?)",
+                        [(band, bucket, cursor.lastrowid) for band, bucket in self._buckets(fingerprint.signature)],
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if earlier is not None:
+            return {"kind": "semantic", "of": earlier[0], "similarity": None}
+        return None
+
+    def screen(self, document: Union[str, Document], format: str) -> Tuple[Fingerprint, Optional[Dict[str, Any]]]:
+        """Fingerprints and checks a document: (fingerprint, duplicate or None)."""
+        with metrics.span("dedup", None, "dedup"):
+            fingerprint = self.fingerprint(document, format)
+            return fingerprint, self.check(fingerprint)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count = self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {"documents": count, "threshold": self.threshold, "num_perm": self.num_perm, "bands": self.bands}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,175 @@
+# document.py
+import codecs
+import json
+import logging
+import mmap
+import os
+from typing import Dict, Any, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Files at least this large are memory-mapped instead of read into a bytes object.
+MMAP_THRESHOLD = 1 << 20
+
+# Format sniffing only ever looks at this many leading bytes.
+SNIFF_BYTES = 16 * 1024
+
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+_UNSET = object()
+
+
+class Document:
+    """
+    The envelope a document travels in from the reader through the
+    classifier to an agent: the raw bytes, the decoded text, any structure
+    parsed along the way and what was sniffed from its first bytes. Every
+    representation is produced at most once and then shared, so no agent
+    re-reads, re-decodes or re-parses what an earlier stage already did.
+    """
+    __slots__ = ("path", "raw", "encoding", "errors", "format", "head", "sniff", "_text", "_parsed", "_mmap")
+
+    def __init__(self, raw: Union[bytes, memoryview] = None, text: str = None, path: str = None,
+                 encoding: str = None, errors: str = "replace"):
+        if raw is None and text is None:
+            raise ValueError("A Document needs raw bytes or text.")
+        self.path = path
+        self.raw = raw
+        self.errors = errors
+        self.format = None
+        self._text = text
+        self._parsed = _UNSET
+        self._mmap = None
+        self.encoding = encoding or (self._detect_encoding() if raw is not None else None)
+        self.head = None
+        self.sniff = self._sniff()
+
+    @classmethod
+    def from_text(cls, text: str) -> "Document":
+        return text if isinstance(text, cls) else cls(text=text)
+
+    @property
+    def text(self) -> str:
+        """The decoded text, decoded on first access. Line endings are
+        translated to "\\n", as when a file is read in text mode."""
+        if self._text is None:
+            text = str(self.raw, self.encoding, self.errors)
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            self._text = text
+        return self._text
+
+    def json(self) -> Any:
+        """
+        The document parsed as JSON, parsed on first call. Raises
+        json.JSONDecodeError if the text is not valid JSON (and again on
+        later calls, without re-parsing).
+        """
+        if self._parsed is _UNSET:
+            try:
+                self._parsed = json.loads(self.text)
+            except json.JSONDecodeError as e:
+                self._parsed = e
+        if isinstance(self._parsed, json.JSONDecodeError):
+            raise self._parsed
+        return self._parsed
+
+    @property
+    def parsed(self) -> Any:
+        """Whatever structure has been parsed so far, or None."""
+        if self._parsed is _UNSET or isinstance(self._parsed, json.JSONDecodeError):
+            return None
+        return self._parsed
+
+    def _detect_encoding(self) -> str:
+        head = bytes(self.raw[:4])
+        for bom, encoding in _BOMS:
+            if head.startswith(bom):
+                return encoding
+        return "utf-8"
+
+    def _sniff(self) -> Dict[str, Any]:
+        """Records cheap facts about the first SNIFF_BYTES of the document."""
+        if self.raw is not None:
+            head_bytes = bytes(self.raw[:SNIFF_BYTES])
+            # A multi-byte character cut at the end of the prefix is dropped.
+            head = head_bytes.decode(self.encoding, "ignore")
+            if "\r" in head:
+                head = head.replace("\r\n", "\n").replace("\r", "\n")
+            truncated = len(self.raw) > SNIFF_BYTES
+        else:
+            head_bytes = None
+            head = self._text[:SNIFF_BYTES]
+            truncated = len(self._text) > SNIFF_BYTES
+        # Kept for classifiers that need more than the recorded facts.
+        self.head = head
+        stripped = head.lstrip()
+        return {
+            "first_char": stripped[:1],
+            "leading_whitespace": len(head) - len(stripped),
+            "is_pdf": head_bytes.startswith(b"%PDF-") if head_bytes is not None else head.startswith("%PDF-"),
+            "has_from_header": "From:" in head,
+            "has_invoice_number": "Invoice Number:" in head,
+            "truncated": truncated,
+        }
+
+    def __len__(self) -> int:
+        return len(self.raw) if self.raw is not None else len(self._text)
+
+    def close(self):
+        """Releases a memory-mapped file. Text already decoded stays available."""
+        if self._mmap is not None:
+            self.raw.release()
+            self.raw = None
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def read_document(file_path: str, encoding: str = None, errors: str = "replace",
+                  mmap_threshold: int = MMAP_THRESHOLD) -> Optional[Document]:
+    """
+    Reads a file in binary into a Document. Files of `mmap_threshold` bytes
+    or more are memory-mapped rather than copied into memory.
+
+    Args:
+        file_path: The file to read.
+        encoding: The text encoding; by default a BOM decides, else UTF-8.
+        errors: How undecodable bytes are handled when the text is decoded.
+        mmap_threshold: Size from which the file is memory-mapped.
+
+    Returns:
+        The Document, or None if the file could not be read.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size and size >= mmap_threshold:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                document = Document(raw=memoryview(mapped), path=file_path, encoding=encoding, errors=errors)
+                document._mmap = mapped
+                return document
+            return Document(raw=f.read(), path=file_path, encoding=encoding, errors=errors)
+    except FileNotFoundError:
+        logger.error("File not found at %s", file_path)
+        return None
+    except Exception as e:
+        logger.error("Error reading file %s: %s", file_path, e)
+        return None
+
+
+def as_text(document: Union[str, Document]) -> str:
+    """The text of a Document, or a plain string unchanged."""
+    return document.text if isinstance(document, Document) else document
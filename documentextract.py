@@ -1 +1,166 @@
+# documentextract.py
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union
 
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PDF_MAGIC = b"%PDF-"
+
+# Documents with at least this many pages are split across processes.
+PARALLEL_PAGE_THRESHOLD = 16
+
+# Bump when the extraction changes, so cached text from the old one is not reused.
+EXTRACTOR_VERSION = "pypdf-v1"
+
+# Recently extracted texts, by content hash.
+_TEXT_CACHE_SIZE = 64
+_text_cache = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+# The reader a pool worker built for the document it is currently handed
+# page ranges of, so each worker parses the file's structure only once.
+_worker_reader = {}
+
+
+def is_pdf(data: Union[bytes, memoryview]) -> bool:
+    return bytes(data[:len(PDF_MAGIC)]) == PDF_MAGIC
+
+
+def _open_reader(data: bytes):
+    # pypdf is optional, and imported only once a PDF actually arrives.
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ImportError("PDF extraction needs the pypdf package: pip install pypdf") from None
+    return PdfReader(io.BytesIO(data))
+
+
+def _read_errors() -> tuple:
+    """What pypdf raises for a damaged or encrypted file (nothing, without pypdf)."""
+    try:
+        from pypdf.errors import PyPdfError
+    except ImportError:
+        return ()
+    return (PyPdfError,)
+
+
+def _page_text(page) -> str:
+    try:
+        return page.extract_text() or ""
+    except Exception as e:  # one damaged page should not lose the rest
+        logger.warning("Could not extract text from a PDF page: %s", e)
+        metrics.incr("errors", kind="pdf_page", agent="documentextract")
+        return ""
+
+
+def _extract_page_range(source: Union[str, bytes], digest: str, start: int, stop: int) -> List[str]:
+    """Pool task: extracts pages [start, stop) of the PDF at `source` (a path or the bytes)."""
+    reader = _worker_reader.get(digest)
+    if reader is None:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                source = f.read()
+        _worker_reader.clear()
+        reader = _worker_reader[digest] = _open_reader(source)
+    return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+
+def _cache_key(digest: str) -> str:
+    return f"{EXTRACTOR_VERSION}:{digest}"
+
+
+def extract_text_from_pdf(pdf: Union[str, bytes, memoryview], workers: int = None, cache=None,
+                          parallel_threshold: int = PARALLEL_PAGE_THRESHOLD) -> str:
+    """
+    Extracts the text of a PDF, one page after another separated by blank
+    lines.
+
+    Long documents are split into page ranges extracted in parallel
+    processes. The text is cached by the SHA-256 of the file's bytes, in
+    process and, if given, in `cache`, so a PDF seen before is not
+    extracted again.
+
+    A file pypdf cannot read (damaged, or encrypted) raises ValueError,
+    like one that is not a PDF at all.
+
+    Args:
+        pdf: A file path, or the PDF's bytes.
+        workers: Processes for long documents; defaults to the CPU count.
+            1 extracts serially.
+        cache: An ExtractionCache to keep texts across runs, apart from its
+            LLM responses (optional).
+        parallel_threshold: Page count from which pages are extracted in parallel.
+
+    Returns:
+        The extracted text.
+    """
+    path = pdf if isinstance(pdf, str) else None
+    if path is not None:
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        data = bytes(pdf)
+    if not is_pdf(data):
+        raise ValueError("Not a PDF document.")
+
+    digest = hashlib.sha256(data).hexdigest()
+    key = _cache_key(digest)
+    with _text_cache_lock:
+        text = _text_cache.get(key)
+        if text is not None:
+            _text_cache.move_to_end(key)
+    if text is None and cache is not None:
+        text = cache.get_text(key)
+    if text is not None:
+        metrics.incr("pdf_text_cache", result="hit")
+        _remember_text(key, text)
+        return text
+    metrics.incr("pdf_text_cache", result="miss")
+
+    with metrics.span("pdf_extract", None, "documentextract"):
+        try:
+            reader = _open_reader(data)
+            page_count = len(reader.pages)
+            workers = workers or os.cpu_count() or 1
+            metrics.incr("pdf_pages", page_count)
+            if workers == 1 or page_count < parallel_threshold:
+                pages = [_page_text(page) for page in reader.pages]
+            else:
+                pages = _extract_in_parallel(path if path is not None else data, digest, page_count, workers)
+        except _read_errors() as e:
+            raise ValueError(f"Unreadable PDF: {e}") from e
+    text = "\n\n".join(page.strip("\n") for page in pages)
+
+    _remember_text(key, text)
+    if cache is not None:
+        cache.put_text(key, text)
+    return text
+
+
+def _extract_in_parallel(source: Union[str, bytes], digest: str, page_count: int, workers: int) -> List[str]:
+    # A few ranges per worker so one slow range does not hold up the rest.
+    workers = min(workers, page_count)
+    range_size = max(1, -(-page_count // (workers * 4)))
+    ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_extract_page_range, source, digest, start, stop) for start, stop in ranges]
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+    return pages
+
+
+def _remember_text(key: str, text: str):
+    with _text_cache_lock:
+        _text_cache[key] = text
+        _text_cache.move_to_end(key)
+        while len(_text_cache) > _TEXT_CACHE_SIZE:
+            _text_cache.popitem(last=False)
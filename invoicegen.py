@@ -0,0 +1,190 @@
+# invoicegen.py
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+from typing import Dict, Any, List, Tuple
+
+_COMPANIES = [
+    "Acme Corp", "Beta Industries", "Tech Solutions Inc.", "Global Corp", "Northwind Traders",
+    "Contoso Ltd", "Initech", "Umbrella Supplies", "Stark Logistics", "Wayne Components",
+    "Blue Harbor Foods", "Summit Office Supply", "Redwood Analytics", "Orion Freight",
+]
+_STREETS = ["Main Street", "Oak Avenue", "Innovation Plaza", "Market Road", "Harbor Way", "Elm Drive"]
+_TOWNS = ["Anytown", "Someville", "Riverton", "Lakeside", "Fairview", "Springfield"]
+_PRODUCTS = [
+    "Widget", "Gadget", "Laptop", "Mouse", "Monitor", "Cable", "Service", "Consulting", "License",
+    "Support Plan", "Toner", "Paper Ream", "Desk Chair", "Headset", "Router", "Installation",
+]
+_WORDS = ["premium", "standard", "blue", "large", "small", "annual", "monthly", "express", "bulk", "pro"]
+_CURRENCIES = ["USD", "EUR", "GBP"]
+
+_RULE = "-" * 50
+
+
+def generate_invoice(rng: random.Random, items: Tuple[int, int] = (3, 10), description_words: int = 2,
+                     number: int = 1) -> Dict[str, Any]:
+    """
+    Builds the data of one synthetic invoice, with totals that add up.
+
+    Args:
+        rng: The random source, seeded for reproducible output.
+        items: The (least, most) line items to generate.
+        description_words: Extra words added to each item's description,
+            to make line items longer.
+        number: Used in the invoice number.
+    """
+    seller, buyer = rng.sample(_COMPANIES, 2)
+    line_items = []
+    for _ in range(rng.randint(*items)):
+        quantity = rng.randint(1, 50)
+        unit_price = round(rng.uniform(1, 500), 2)
+        amount = round(quantity * unit_price, 2)
+        words = [rng.choice(_WORDS) for _ in range(description_words)]
+        line_items.append({
+            "description": " ".join([rng.choice(_PRODUCTS)] + words + [chr(ord("A") + rng.randrange(26))]),
+            "quantity": quantity,
+            "unit_price": unit_price,
+            "amount": amount,
+            "tax": round(amount * rng.choice((0, 0.05, 0.08, 0.2)), 2),
+        })
+    subtotal = round(sum(item["amount"] for item in line_items), 2)
+    discount = round(subtotal * rng.choice((0, 0, 0.05, 0.1)), 2)
+    tax = round(sum(item["tax"] for item in line_items), 2)
+    shipping = round(rng.choice((0, 5, 12.5, 25)), 2)
+    date = datetime.date(2025, 1, 1) + datetime.timedelta(days=rng.randrange(365))
+    return {
+        "invoice_number": f"INV-{date.year}-{number:06d}",
+        "invoice_date": date.isoformat(),
+        "seller": _party(rng, seller),
+        "buyer": _party(rng, buyer),
+        "line_items": line_items,
+        "subtotal": subtotal,
+        "discount": discount,
+        "total_tax_amount": tax,
+        "shipping_handling": shipping,
+        "total_amount": round(subtotal - discount + tax + shipping, 2),
+        "currency": rng.choice(_CURRENCIES),
+    }
+
+
+def _party(rng: random.Random, name: str) -> Dict[str, str]:
+    return {
+        "name": name,
+        "address": f"{rng.randint(1, 999)} {rng.choice(_STREETS)}, {rng.choice(_TOWNS)}, USA {rng.randint(10000, 99999)}",
+        "tax_id": f"US{rng.randint(100000000, 999999999)}",
+    }
+
+
+def render_plain(invoice: Dict[str, Any]) -> str:
+    """Lays the invoice out like dummy.txt."""
+    lines = [
+        _RULE, "                       INVOICE", _RULE, "",
+        f"Invoice Number: {invoice['invoice_number']}",
+        f"Invoice Date: {invoice['invoice_date']}", "",
+    ]
+    for label, party in (("Seller/Vendor:", invoice["seller"]), ("Buyer/Customer:", invoice["buyer"])):
+        lines += [label, f"  Name: {party['name']}", f"  Address: {party['address']}",
+                  f"  Tax ID: {party['tax_id']}", ""]
+    lines += [
+        "-------------------- LINE ITEMS -------------------",
+        "Description             Quantity    Unit Price    Amount      Tax",
+        _RULE,
+    ]
+    for item in invoice["line_items"]:
+        lines.append(f"{item['description']:<23} {item['quantity']:<11} {item['unit_price']:<13.2f} "
+                     f"{item['amount']:<11.2f} {item['tax']:.2f}")
+    lines += [
+        _RULE, "",
+        "---------------------- TOTALS ----------------------",
+        f"Subtotal:              {invoice['subtotal']:.2f}",
+        f"Discount:              {invoice['discount']:.2f}",
+        f"Total Tax Amount:      {invoice['total_tax_amount']:.2f}",
+        f"Shipping/Handling:     {invoice['shipping_handling']:.2f}",
+        _RULE,
+        f"Total Amount Due:      {invoice['total_amount']:.2f}",
+        f"Currency:              {invoice['currency']}",
+        _RULE,
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_email(invoice: Dict[str, Any]) -> str:
+    """Wraps the plain layout in an email from the seller's billing department, like dummyemail.txt."""
+    domain = invoice["seller"]["name"].split()[0].lower().strip(".") + ".com"
+    headers = [
+        f"From: Billing Department <billing@{domain}>",
+        f"To: accounts@{invoice['buyer']['name'].split()[0].lower().strip('.')}.com",
+        f"Subject: Invoice {invoice['invoice_number']}",
+        f"Date: {invoice['invoice_date']}",
+    ]
+    greeting = f"Hello,\n\nPlease find invoice {invoice['invoice_number']} below.\n"
+    return "\n".join(headers) + "\n\n" + greeting + "\n" + render_plain(invoice)
+
+
+def render_json(invoice: Dict[str, Any]) -> str:
+    """Renders the invoice in the camelCase schema of dummyjson.txt."""
+    return json.dumps({
+        "invoiceNumber": invoice["invoice_number"],
+        "invoiceDate": invoice["invoice_date"],
+        "seller": {"Name": invoice["seller"]["name"], "Address": invoice["seller"]["address"]},
+        "buyer": {"Name": invoice["buyer"]["name"], "Address": invoice["buyer"]["address"]},
+        "lineItems": [
+            {"description": item["description"], "quantity": item["quantity"], "unitPrice": item["unit_price"],
+             "amount": item["amount"], "tax": item["tax"]}
+            for item in invoice["line_items"]
+        ],
+        "totalAmount": invoice["total_amount"],
+        "currency": invoice["currency"],
+    }, indent=2)
+
+
+RENDERERS = {"plain": render_plain, "email": render_email, "json": render_json}
+
+
+def generate_documents(count: int, kind: str, seed: int = 0, items: Tuple[int, int] = (3, 10),
+                       description_words: int = 2) -> List[str]:
+    """
+    Generates `count` invoice documents of one kind ("plain", "email" or
+    "json"). The same seed always gives the same documents.
+    """
+    rng = random.Random(f"{seed}:{kind}")
+    render = RENDERERS[kind]
+    return [render(generate_invoice(rng, items, description_words, n)) for n in range(1, count + 1)]
+
+
+def parse_item_range(value: str) -> Tuple[int, int]:
+    """Parses an --items argument: "5" or "5-200"."""
+    least, _, most = value.partition("-")
+    return int(least), int(most or least)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Write synthetic plain, email and JSON invoices to a directory.")
+    parser.add_argument("output", help="Directory to write the invoices to.")
+    parser.add_argument("--plain", type=int, default=10, help="Plain text invoices to write.")
+    parser.add_argument("--email", type=int, default=10, help="Email invoices to write.")
+    parser.add_argument("--json", type=int, default=10, help="JSON invoices to write.")
+    parser.add_argument("--items", type=parse_item_range, default=(3, 10), metavar="MIN-MAX",
+                        help="Line items per invoice, e.g. 5 or 5-200.")
+    parser.add_argument("--description-words", type=int, default=2,
+                        help="Extra words per line item description, to make items longer.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    written = 0
+    for kind, count in (("plain", args.plain), ("email", args.email), ("json", args.json)):
+        extension = "json" if kind == "json" else "txt"
+        for n, text in enumerate(generate_documents(count, kind, args.seed, args.items, args.description_words), 1):
+            with open(os.path.join(args.output, f"{kind}_{n:05d}.{extension}"), "w", encoding="utf-8") as f:
+                f.write(text)
+            written += 1
+    print(f"Wrote {written} invoices to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
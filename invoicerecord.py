@@ -0,0 +1,318 @@
+# invoicerecord.py
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Dict, Any, Iterable, Iterator, List, Tuple
+
+
+class LineItems(Sequence):
+    """
+    Line items stored column by column instead of as one dict per item:
+    integer and float columns go into typed arrays (8 bytes a value) and
+    other columns into tuples. Indexing or iterating builds each item's dict
+    on demand, so the items read like the list of dicts they replace.
+
+    Use compact_line_items to build one; items that do not all share the
+    same keys stay a plain list.
+    """
+    __slots__ = ("_keys", "_columns", "_length")
+
+    def __init__(self, keys: Tuple[str, ...], columns: Tuple[Any, ...], length: int):
+        self._keys = keys
+        self._columns = columns
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("line item index out of range")
+        return {key: column[index] for key, column in zip(self._keys, self._columns)}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        keys = self._keys
+        for row in zip(*self._columns):
+            yield dict(zip(keys, row))
+
+    def column(self, key: str) -> Sequence:
+        """All values of one field, e.g. column("amount"), without building the items."""
+        return self._columns[self._keys.index(key)]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (LineItems, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"LineItems({self.to_list()!r})"
+
+    def __reduce__(self):
+        return LineItems, (self._keys, self._columns, self._length)
+
+    def __sizeof__(self) -> int:
+        size = object.__sizeof__(self) + sys.getsizeof(self._columns)
+        for column in self._columns:
+            size += sys.getsizeof(column)
+            if isinstance(column, tuple):
+                size += sum(sys.getsizeof(value) for value in column)
+        return size
+
+
+def _column(values: List[Any]) -> Any:
+    # Typed arrays only where they give back exactly the values put in.
+    kinds = {type(value) for value in values}
+    try:
+        if kinds == {int}:
+            return array("q", values)
+        if kinds == {float}:
+            return array("d", values)
+    except OverflowError:
+        pass
+    return tuple(values)
+
+
+def compact_line_items(items: Any) -> Any:
+    """
+    Returns `items` (a list of line item dicts) as LineItems, or unchanged if
+    it is not a non-empty list of dicts that all have the same keys.
+    """
+    if isinstance(items, LineItems) or not isinstance(items, list) or not items:
+        return items
+    first = items[0]
+    if not isinstance(first, dict):
+        return items
+    keys = tuple(first)
+    for item in items:
+        if not isinstance(item, dict) or tuple(item) != keys:
+            return items
+    columns = tuple(_column([item[key] for item in items]) for key in keys)
+    return LineItems(keys, columns, len(items))
+
+
+class Party(Mapping):
+    """A vendor or customer block: name, address and tax ID."""
+    __slots__ = ("name", "address", "tax_id")
+    _KEYS = ("name", "address", "tax_id")
+
+    def __init__(self, name: str = None, address: str = None, tax_id: str = None):
+        self.name = name
+        self.address = address
+        self.tax_id = tax_id
+
+    @classmethod
+    def from_value(cls, value: Any) -> Any:
+        """A Party for a complete {"name", "address", "tax_id"} dict; anything else is returned as is."""
+        if isinstance(value, dict) and tuple(value) == cls._KEYS:
+            return cls(value["name"], value["address"], value["tax_id"])
+        return value
+
+    def __getitem__(self, key: str):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return len(self._KEYS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "address": self.address, "tax_id": self.tax_id}
+
+    def __repr__(self) -> str:
+        return f"Party({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return Party, (self.name, self.address, self.tax_id)
+
+
+# Output key -> InvoiceRecord attribute, for each view of a record. A view
+# lists keys in output order; a record exposes those present in its source.
+DETAILS_VIEW = {
+    "items": "line_items",
+    "invoice_number": "invoice_number",
+    "invoice_date": "invoice_date",
+    "vendor": "vendor",
+    "customer": "customer",
+    "subtotal": "subtotal",
+    "discount": "discount",
+    "total_tax_amount": "total_tax_amount",
+    "shipping_handling": "shipping_handling",
+    "total_amount_due": "total_amount",
+    "currency": "currency",
+}
+DOWNSTREAM_VIEW = {
+    "invoice_id": "invoice_number",
+    "issue_date": "invoice_date",
+    "vendor": "vendor",
+    "customer": "customer",
+    "items": "line_items",
+    "total": "total_amount",
+    "currency": "currency",
+}
+
+# Interned (key, attribute) layouts, so records of the same shape share one.
+_layouts = {}
+
+
+def _layout(view: Dict[str, str], keys: Iterable[str]) -> Tuple[Tuple[str, str], ...]:
+    keys = tuple(keys)
+    layout = _layouts.get(keys)
+    if layout is None:
+        layout = _layouts[keys] = tuple((key, view[key]) for key in keys)
+    return layout
+
+
+class InvoiceRecord(Mapping):
+    """
+    One invoice in a fixed set of slots, with its line items in columns
+    (see LineItems).
+
+    A record reads like the dict it stands for (see from_details and
+    from_extraction): it is a read-only Mapping over that dict's keys, and
+    to_dict() builds the plain dict only when output needs one.
+    """
+    __slots__ = ("invoice_number", "invoice_date", "vendor", "customer", "line_items", "subtotal",
+                 "discount", "total_tax_amount", "shipping_handling", "total_amount", "currency", "_layout")
+    _FIELDS = __slots__[:-1]
+
+    def __init__(self, layout: Tuple[Tuple[str, str], ...] = (), **fields):
+        self._layout = layout
+        for name in self._FIELDS:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_details(cls, details: Dict[str, Any]) -> "InvoiceRecord":
+        """
+        Builds a record from the dict agents.invoicetemplate.extract_invoice_details
+        returns, which it then reads like.
+        """
+        if not set(details) <= DETAILS_VIEW.keys():
+            raise ValueError(f"Unexpected invoice detail keys: {sorted(set(details) - DETAILS_VIEW.keys())}")
+        record = cls(_layout(DETAILS_VIEW, details))
+        for key, name in record._layout:
+            setattr(record, name, details[key])
+        record.line_items = compact_line_items(record.line_items)
+        record.vendor = Party.from_value(record.vendor)
+        record.customer = Party.from_value(record.customer)
+        return record
+
+    @classmethod
+    def from_extraction(cls, extracted_data: Dict[str, Any]) -> "InvoiceRecord":
+        """
+        Builds a record from the LLM's (or the fast path's) extracted_data,
+        read in the downstream schema: invoice_id, issue_date, vendor,
+        customer, items, total and currency.
+        """
+        return cls(
+            _layout(DOWNSTREAM_VIEW, DOWNSTREAM_VIEW),
+            invoice_number=extracted_data.get("invoice_number"),
+            invoice_date=extracted_data.get("invoice_date"),
+            vendor=extracted_data.get("seller"),
+            customer=extracted_data.get("buyer"),
+            line_items=compact_line_items(extracted_data.get("line_items")),
+            subtotal=extracted_data.get("subtotal"),
+            discount=extracted_data.get("discount"),
+            total_tax_amount=extracted_data.get("total_tax_amount"),
+            shipping_handling=extracted_data.get("shipping_handling"),
+            total_amount=extracted_data.get("total_amount"),
+            currency=extracted_data.get("currency"),
+        )
+
+    def __getitem__(self, key: str):
+        for output_key, name in self._layout:
+            if output_key == key:
+                return getattr(self, name)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key, _ in self._layout)
+
+    def __len__(self) -> int:
+        return len(self._layout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The record as plain dicts and lists, as it would be written out."""
+        return {key: to_plain(getattr(self, name)) for key, name in self._layout}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"InvoiceRecord({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return _rebuild_record, (self._layout, tuple(getattr(self, name) for name in self._FIELDS))
+
+
+def _rebuild_record(layout, values) -> InvoiceRecord:
+    record = InvoiceRecord(layout)
+    for name, value in zip(InvoiceRecord._FIELDS, values):
+        setattr(record, name, value)
+    return record
+
+
+
+def invoice_fields(results: Any) -> Dict[str, Any]:
+    """
+    Reads the invoice out of an agent's results, whichever agent produced
+    them: the email agent's invoice_details, the JSON agent's target schema
+    or the invoice agent's downstream schema.
+
+    Returns:
+        invoice_number, invoice_date, vendor, customer, total_amount,
+        currency and items, as found (None where missing); {} for results
+        that are not a mapping.
+    """
+    if not isinstance(results, Mapping):
+        return {}
+    extracted = results.get("extracted_data")
+    if isinstance(extracted, Mapping):
+        details = extracted.get("invoice_details")
+        if isinstance(details, Mapping):
+            return {"invoice_number": details.get("invoice_number"), "invoice_date": details.get("invoice_date"),
+                    "vendor": details.get("vendor"), "customer": details.get("customer"),
+                    "total_amount": details.get("total_amount_due"), "currency": details.get("currency"),
+                    "items": details.get("items")}
+        return {"invoice_number": extracted.get("id"), "invoice_date": extracted.get("date"),
+                "vendor": extracted.get("vendor_name"), "customer": extracted.get("customer_name"),
+                "total_amount": extracted.get("total_amount"), "currency": extracted.get("currency"),
+                "items": extracted.get("items")}
+    return {"invoice_number": results.get("invoice_id"), "invoice_date": results.get("issue_date"),
+            "vendor": results.get("vendor"), "customer": results.get("customer"),
+            "total_amount": results.get("total"), "currency": results.get("currency"),
+            "items": results.get("items")}
+
+
+def to_plain(value: Any) -> Any:
+    """Converts records and line items (also nested in dicts and lists) to plain values."""
+    if isinstance(value, (InvoiceRecord, Party)):
+        return value.to_dict()
+    if isinstance(value, LineItems):
+        return value.to_list()
+    if isinstance(value, dict):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_plain(item) for item in value]
+    return value
+
+
+def to_jsonable(value: Any) -> Any:
+    """
+    A `default` for json.dumps: writes records as the dicts they stand for,
+    and anything else JSON does not know as its str(), like default=str.
+    """
+    if isinstance(value, (InvoiceRecord, Party, LineItems)):
+        return to_plain(value)
+    return str(value)
@@ -0,0 +1,175 @@
+# jsonstream.py
+import codecs
+import json
+import re
+from typing import Any, BinaryIO, Iterator, Optional, TextIO, Union
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+# What may follow the part of a number already read, if the number goes on.
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+# The longest document read ahead for before it is given up as malformed.
+MAX_DOCUMENT_SIZE = 64 << 20
+
+
+class InvalidRecord:
+    """Stands in for a line of a newline-delimited stream that is not valid JSON."""
+    __slots__ = ("error", "text")
+
+    def __init__(self, error: str, text: str):
+        self.error = error
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"InvalidRecord({self.error!r}, {self.text!r})"
+
+
+class _Buffer:
+    """Text read incrementally from a file, consumed from the front."""
+
+    def __init__(self, source: Union[BinaryIO, TextIO], chunk_size: int):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        # Binary sources are decoded incrementally so a multi-byte character
+        # split across two reads is not mangled.
+        self._decoder = None
+        probe = source.read(0)
+        if isinstance(probe, bytes):
+            self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def fill(self, min_size: int = 0) -> bool:
+        """Reads at least one more chunk (or `min_size` characters); returns False at EOF."""
+        if self.eof:
+            return False
+        # Drop the consumed prefix before growing the buffer.
+        if self.pos:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        wanted = max(self.chunk_size, min_size)
+        read = 0
+        while read < wanted:
+            data = self.source.read(self.chunk_size)
+            chunk = data
+            if self._decoder is not None:
+                # Empty, not EOF, when the read ended inside a character.
+                chunk = self._decoder.decode(data, final=not data)
+            self.text += chunk
+            read += len(chunk)
+            if not data:
+                self.eof = True
+                break
+        return read > 0
+
+    def skip(self, chars: str) -> Optional[str]:
+        """Skips any of `chars`; returns the next character, or None at EOF."""
+        while True:
+            text = self.text
+            pos = self.pos
+            while pos < len(text) and text[pos] in chars:
+                pos += 1
+            self.pos = pos
+            if pos < len(text):
+                return text[pos]
+            if not self.fill():
+                return None
+
+    def skip_line(self) -> str:
+        """Consumes the rest of the current line; returns its start, for error messages."""
+        start = self.text[self.pos:self.pos + 80].split("\n", 1)[0]
+        while True:
+            newline = self.text.find("\n", self.pos)
+            if newline != -1:
+                self.pos = newline + 1
+                return start
+            self.pos = len(self.text)
+            if not self.fill():
+                return start
+
+    def decode_value(self, max_size: int = MAX_DOCUMENT_SIZE) -> Any:
+        """
+        Decodes one complete JSON value at the current position. Raises
+        JSONDecodeError, leaving the position where it was, for a malformed
+        value or one longer than `max_size` characters.
+        """
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError as e:
+                # Possibly just truncated, unless a line break follows the
+                # error: no JSON token spans lines, so that value is broken.
+                if self.text.find("\n", e.pos) != -1:
+                    raise
+                pending = len(self.text) - self.pos
+                if pending >= max_size:
+                    raise json.JSONDecodeError(f"Document longer than {max_size} characters",
+                                               self.text, self.pos) from None
+                # Grow the read with the pending value so a huge document is
+                # re-scanned only a logarithmic number of times.
+                if not self.fill(min(pending, max_size - pending)):
+                    raise
+                continue
+            if not self.eof and isinstance(value, (int, float)) and _NUMBER_TAIL.fullmatch(self.text, end):
+                # A top-level number may continue in the next chunk ("12." then "5").
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_documents(source: Union[str, BinaryIO, TextIO], chunk_size: int = 1 << 16,
+                        invalid_records: bool = False,
+                        max_document_size: int = MAX_DOCUMENT_SIZE) -> Iterator[Any]:
+    """
+    Yields the JSON documents in `source` one at a time without loading the
+    whole file.
+
+    Two layouts are understood:
+      * a top-level JSON array, whose elements are yielded one by one;
+      * newline-delimited (or otherwise whitespace-separated) JSON values,
+        including a file holding a single object.
+
+    Memory use is bounded by the largest single document plus one chunk.
+
+    A malformed document raises JSONDecodeError. In a newline-delimited
+    stream, `invalid_records` instead yields an InvalidRecord for the line
+    it starts on and carries on with the next line.
+
+    Args:
+        source: A path, or a file object opened in binary or text mode.
+        chunk_size: Characters read per refill.
+        invalid_records: Yield malformed lines as InvalidRecord rather than raise.
+        max_document_size: Characters a document may take; a longer one is
+            treated as malformed rather than read to the end of the file.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from iter_json_documents(f, chunk_size, invalid_records, max_document_size)
+        return
+
+    buffer = _Buffer(source, chunk_size)
+    first = buffer.skip(_WHITESPACE)
+    if first is None:
+        return
+
+    if first == "[":
+        buffer.pos += 1
+        while True:
+            nxt = buffer.skip(_WHITESPACE + ",")
+            if nxt is None:
+                raise json.JSONDecodeError("Unterminated JSON array", buffer.text, buffer.pos)
+            if nxt == "]":
+                return
+            yield buffer.decode_value(max_document_size)
+    else:
+        while buffer.skip(_WHITESPACE) is not None:
+            try:
+                value = buffer.decode_value(max_document_size)
+            except json.JSONDecodeError as e:
+                if not invalid_records:
+                    raise
+                value = InvalidRecord(e.msg, buffer.skip_line())
+            yield value
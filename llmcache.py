@@ -0,0 +1,200 @@
+# llmcache.py
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from metrics import metrics
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class ExtractionCache:
+    def __init__(self, path: str = "llm_cache.sqlite3", max_entries: int = 100_000,
+                 ttl_seconds: float = 30 * 24 * 3600, enabled: bool = True):
+        """
+        A disk-backed cache of LLM extraction responses, keyed by content.
+
+        Text extracted from documents (see documentextract) is kept in a
+        table of its own, so it neither counts in the hit rate nor evicts
+        responses.
+
+        Args:
+            path: SQLite database file (":memory:" for a process-local cache).
+            max_entries: Entries kept before the least recently used are evicted.
+            ttl_seconds: Age after which an entry is treated as a miss and removed.
+                None disables expiry.
+            enabled: When False every lookup misses and nothing is written,
+                without touching the database.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        self._text_puts_since_evict = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS document_text ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS document_text_accessed ON document_text (accessed_at)")
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Collapses whitespace so re-exported copies of a document share a key."""
+        return _WHITESPACE.sub(" ", text).strip()
+
+    @classmethod
+    def make_key(cls, text: str, prompt_version: str, model_name: str) -> str:
+        """Builds the cache key from the normalized text, prompt version and model."""
+        digest = hashlib.sha256()
+        for part in (prompt_version, model_name, cls.normalize_text(text)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for `key`, or None on a miss."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.incr("llm_cache_lookups", result="miss")
+                return None
+            value, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.evictions += 1
+                self.misses += 1
+                metrics.incr("llm_cache_lookups", result="expired")
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            metrics.incr("llm_cache_lookups", result="hit")
+            return value
+
+    def put(self, key: str, value: str):
+        """Stores a response, evicting old entries once the size limit is passed."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # Counting rows on every put would dominate the cost of a write;
+            # check the limit periodically instead.
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 100:
+                self._puts_since_evict = 0
+                self._evict(now)
+
+    def get_text(self, key: str) -> Optional[str]:
+        """Returns the document text stored under `key`, or None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM document_text WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM document_text WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE document_text SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def put_text(self, key: str, text: str):
+        """Stores a document's extracted text; texts have their own size limit of max_entries."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO document_text (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, text, now, now),
+            )
+            self._text_puts_since_evict += 1
+            if self._text_puts_since_evict >= 100:
+                self._text_puts_since_evict = 0
+                self._evict_table("document_text", now)
+
+    def _evict(self, now: float):
+        self.evictions += self._evict_table("llm_cache", now)
+
+    def _evict_table(self, table: str, now: float) -> int:
+        evicted = 0
+        if self.ttl_seconds is not None:
+            cursor = self._conn.execute(
+                f"DELETE FROM {table} WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+            evicted += cursor.rowcount
+        if self.max_entries is not None:
+            (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                cursor = self._conn.execute(
+                    f"DELETE FROM {table} WHERE key IN"
+                    f" (SELECT key FROM {table} ORDER BY accessed_at LIMIT ?)",
+                    (excess,),
+                )
+                evicted += cursor.rowcount
+        return evicted
+
+    def evict(self):
+        """Applies TTL and size limits now rather than at the next periodic check."""
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            self._evict_table("document_text", now)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.execute("DELETE FROM document_text")
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns hit/miss counters and the current number of entries."""
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,145 @@
+# llmclient.py
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional, Union
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LLMClient:
+    """
+    Minimal interface the agents use to talk to a language model.
+
+    Subclasses implement `generate`; `agenerate` defaults to running the
+    blocking call in a worker thread so any client can be awaited. `timeout`
+    is the most seconds the caller will wait for the answer; clients pass it
+    on to their transport where they can.
+    """
+    model_name = "unknown"
+
+    def generate(self, prompt: str, timeout: float = None) -> str:
+        raise NotImplementedError
+
+    async def agenerate(self, prompt: str, timeout: float = None) -> str:
+        return await asyncio.to_thread(self.generate, prompt, timeout)
+
+
+DEFAULT_GEMINI_MODEL = "models/gemini-1.5-flash-latest"
+
+
+class GeminiClient(LLMClient):
+    def __init__(self, model=None, model_name: str = None, api_key: str = None):
+        """
+        Wraps a `google.generativeai.GenerativeModel`.
+
+        Without a `model`, the SDK is imported, configured and the model
+        built on the first request, so runs that never reach the LLM do not
+        pay for importing it.
+
+        Args:
+            model: A configured GenerativeModel instance (optional).
+            model_name: The model to build, and the name used for logging and
+                cache keys; defaults to the model's own name.
+            api_key: The Gemini API key; defaults to GEMINI_API_KEY from the
+                environment or a .env file.
+        """
+        self._model = model
+        self._api_key = api_key
+        self._lock = threading.Lock()
+        self.model_name = model_name or getattr(model, "model_name", None) or DEFAULT_GEMINI_MODEL
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._build_model()
+        return self._model
+
+    def _build_model(self):
+        import google.generativeai as genai
+
+        api_key = self._api_key
+        if api_key is None:
+            try:
+                from dotenv import load_dotenv
+                load_dotenv()
+            except ImportError:
+                pass
+            api_key = os.environ.get("GEMINI_API_KEY")
+        genai.configure(api_key=api_key)
+        logger.debug("Initialised Gemini model %s", self.model_name)
+        return genai.GenerativeModel(self.model_name)
+
+    def generate(self, prompt: str, timeout: float = None) -> str:
+        response = self.model.generate_content(prompt, request_options=self._request_options(timeout))
+        return self._response_text(response)
+
+    async def agenerate(self, prompt: str, timeout: float = None) -> str:
+        # The SDK's native async call keeps the request on the event loop
+        # instead of tying up a thread per in-flight request.
+        response = await self.model.generate_content_async(prompt, request_options=self._request_options(timeout))
+        return self._response_text(response)
+
+    @staticmethod
+    def _request_options(timeout: Optional[float]):
+        return {"timeout": timeout} if timeout is not None else None
+
+    @staticmethod
+    def _response_text(response) -> str:
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None and metrics.enabled:
+            metrics.incr("llm_tokens", getattr(usage, "prompt_token_count", 0) or 0, kind="prompt")
+            metrics.incr("llm_tokens", getattr(usage, "candidates_token_count", 0) or 0, kind="completion")
+        if hasattr(response, 'candidates') and response.candidates and \
+                hasattr(response.candidates[0], 'content') and \
+                hasattr(response.candidates[0].content, 'parts') and \
+                response.candidates[0].content.parts:
+            llm_text = response.candidates[0].content.parts[0].text.strip()
+            # Remove potential ```json and ``` delimiters
+            return llm_text.removeprefix("```json").removesuffix("```").strip()
+        logger.warning("Could not extract text from LLM response.")
+        return ""
+
+
+class FakeLLMClient(LLMClient):
+    def __init__(self, response: Union[str, Callable[[str], str]] = "{}", latency: float = 0.0,
+                 model_name: str = "fake"):
+        """
+        A local stand-in for a real model, for tests and benchmarks.
+
+        Args:
+            response: The text to return, or a callable that builds it from the
+                prompt (and may raise, to simulate a failing backend).
+            latency: Seconds to wait before answering, to simulate a network round trip.
+            model_name: Name reported to callers.
+        """
+        self.response = response
+        self.latency = latency
+        self.model_name = model_name
+        self.calls = 0
+
+    def _respond(self, prompt: str) -> str:
+        self.calls += 1
+        return self.response(prompt) if callable(self.response) else self.response
+
+    def generate(self, prompt: str, timeout: float = None) -> str:
+        if self.latency:
+            if timeout is not None and timeout < self.latency:
+                time.sleep(timeout)
+                raise TimeoutError("The fake LLM did not answer in time.")
+            time.sleep(self.latency)
+        return self._respond(prompt)
+
+    async def agenerate(self, prompt: str, timeout: float = None) -> str:
+        if self.latency:
+            if timeout is not None and timeout < self.latency:
+                await asyncio.sleep(timeout)
+                raise TimeoutError("The fake LLM did not answer in time.")
+            await asyncio.sleep(self.latency)
+        return self._respond(prompt)
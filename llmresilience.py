@@ -0,0 +1,351 @@
+# llmresilience.py
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional, Tuple
+
+from llmclient import LLMClient
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests per second allowed to one model across the process, unless a
+# limiter is passed in or set_rate says otherwise. 0 (the default) is no limit.
+DEFAULT_RATE = float(os.environ.get("FLOW_LLM_RATE", "0"))
+
+# HTTP statuses, and exception class names (google.api_core and friends),
+# that mean "try again later" rather than "this request is wrong".
+_TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+_TRANSIENT_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+    "InternalServerError", "GatewayTimeout", "BadGateway", "Aborted", "RetryError",
+}
+
+
+class LLMUnavailable(Exception):
+    """The LLM could not answer: retries were exhausted or the backend is unhealthy."""
+
+
+class CircuitOpenError(LLMUnavailable):
+    """Raised instead of calling a backend the circuit breaker has marked unhealthy."""
+
+
+class DeadlineExceeded(LLMUnavailable, TimeoutError):
+    """The request's deadline passed before the LLM answered."""
+
+
+def is_transient(error: BaseException) -> bool:
+    """True for errors worth retrying: rate limits, timeouts and server-side failures."""
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "status_code", None)
+    if isinstance(status, int) and status in _TRANSIENT_STATUS:
+        return True
+    return type(error).__name__ in _TRANSIENT_NAMES
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = None):
+        """
+        A thread-safe token-bucket rate limiter.
+
+        Args:
+            rate: Tokens added per second.
+            burst: Tokens the bucket holds, i.e. requests that may go out at
+                once after a quiet period; defaults to one second's worth.
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float = None) -> Optional[float]:
+        """
+        Takes a token and returns how long to wait before using it, or None
+        (taking nothing) if that would be longer than `max_wait`. Waiters are
+        served in the order they reserve.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Stops calls to a backend after `failure_threshold` consecutive
+        transient failures. After `reset_timeout` seconds one probe call is
+        let through; its success closes the circuit again, its failure
+        re-opens it.
+
+        Args:
+            name: Reported as the model label of the breaker's metrics.
+            failure_threshold: Consecutive failures that open the circuit.
+            reset_timeout: Seconds the circuit stays open before a probe.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def admit(self) -> float:
+        """Returns 0.0 if a call may go ahead now, else the seconds until it is worth asking again."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                self._transition(self.HALF_OPEN)
+            if self._probing:
+                return min(1.0, self.reset_timeout)
+            self._probing = True
+            return 0.0
+
+    def release(self):
+        """Gives back a probe slot from admit() that went unused."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def _transition(self, state: str):
+        logger.warning("Circuit for %s is now %s", self.name, state)
+        self.state = state
+        metrics.incr("llm_circuit_transitions", model=self.name, state=state)
+        metrics.set_gauge("llm_circuit_open", 0 if state == self.CLOSED else 1, model=self.name)
+
+
+# Limiters and breakers by model name, shared by every client in the process
+# so all agents together stay within one quota and see one backend health.
+_shared = {}
+_shared_lock = threading.Lock()
+# Processes splitting that quota between them (see set_process_count).
+_process_count = 1
+_rate = DEFAULT_RATE
+
+
+def set_rate(rate: float):
+    """
+    Sets the requests per second shared_controls allows each model from
+    now on, 0 for no limit; the --llm-rate option of batch.py and
+    server.py, called before the first client is created.
+    """
+    global _rate
+    _rate = max(0.0, rate)
+
+
+def set_process_count(count: int):
+    """
+    Declares that `count` processes (this one among them) call the LLM
+    under one quota, so the limiters shared_controls creates from now on
+    allow each process 1/count of the rate and burst. Pool workers call
+    this before their first client is created.
+    """
+    global _process_count
+    _process_count = max(1, count)
+
+
+def shared_controls(model_name: str, rate: float = None, burst: int = None,
+                    failure_threshold: int = 5,
+                    reset_timeout: float = 30.0) -> Tuple[Optional[TokenBucket], CircuitBreaker]:
+    """
+    Returns the process-wide (limiter, breaker) pair for `model_name`,
+    created with these settings on first use. `rate` defaults to the one
+    set_rate set. The limiter is None when `rate` is 0; otherwise it holds
+    this process's share of `rate` (see set_process_count).
+    """
+    with _shared_lock:
+        controls = _shared.get(model_name)
+        if controls is None:
+            if rate is None:
+                rate = _rate
+            if burst is not None:
+                burst = max(1, burst // _process_count)
+            limiter = TokenBucket(rate / _process_count, burst) if rate else None
+            controls = _shared[model_name] = (limiter, CircuitBreaker(model_name, failure_threshold, reset_timeout))
+        return controls
+
+
+class ResilientClient(LLMClient):
+    def __init__(self, client: LLMClient, limiter: TokenBucket = None, breaker: CircuitBreaker = None,
+                 max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 20.0,
+                 deadline: float = 60.0, on_open: str = "queue"):
+        """
+        Wraps an LLMClient with rate limiting, retries, deadlines and a
+        circuit breaker.
+
+        Transient errors (429s, timeouts, 5xx) are retried with jittered
+        exponential backoff; others are raised at once. Every request has a
+        deadline covering its waits and retries. Once the backend has failed
+        repeatedly, the breaker either sheds requests (on_open="shed", raising
+        CircuitOpenError at once) or queues them until a probe call succeeds
+        or their deadline passes (on_open="queue").
+
+        Args:
+            client: The client to call, e.g. a GeminiClient.
+            limiter: The TokenBucket requests draw from; defaults to the one
+                shared by every client of the same model (see shared_controls).
+            breaker: The CircuitBreaker to consult; shared per model by default.
+            max_retries: Retries after the first attempt.
+            base_delay: Backoff before the first retry, doubled for each next one.
+            max_delay: The most any one backoff may be.
+            deadline: Seconds a request may take in total, unless the call
+                passes its own timeout.
+            on_open: "queue" or "shed", what to do while the circuit is open.
+        """
+        if on_open not in ("queue", "shed"):
+            raise ValueError(f"on_open must be 'queue' or 'shed', not {on_open!r}")
+        shared_limiter, shared_breaker = shared_controls(client.model_name)
+        self.client = client
+        self.limiter = limiter or shared_limiter
+        self.breaker = breaker or shared_breaker
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.on_open = on_open
+        self._random = random.Random()
+
+    @property
+    def model_name(self) -> str:
+        # Cache keys and logs name the wrapped model, not the wrapper.
+        return self.client.model_name
+
+    def generate(self, prompt: str, timeout: float = None) -> str:
+        deadline = time.monotonic() + (timeout or self.deadline)
+        attempt = 0
+        while True:
+            wait, admitted = self._admit(deadline)
+            if not admitted:
+                time.sleep(wait)
+                continue
+            try:
+                time.sleep(wait)
+                response = self.client.generate(prompt, timeout=self._time_left(deadline))
+            except Exception as e:
+                time.sleep(self._after_failure(e, attempt, deadline))
+                attempt += 1
+                continue
+            except BaseException:
+                # Interrupted before the attempt settled (Ctrl-C): give back
+                # the probe slot it may hold, or the circuit never closes.
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return response
+
+    async def agenerate(self, prompt: str, timeout: float = None) -> str:
+        deadline = time.monotonic() + (timeout or self.deadline)
+        attempt = 0
+        while True:
+            wait, admitted = self._admit(deadline)
+            if not admitted:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await asyncio.sleep(wait)
+                time_left = self._time_left(deadline)
+                response = await asyncio.wait_for(self.client.agenerate(prompt, timeout=time_left), time_left)
+            except Exception as e:
+                await asyncio.sleep(self._after_failure(e, attempt, deadline))
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled before the attempt settled (a caller's wait_for,
+                # a cancelled task): give back the probe slot it may hold.
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return response
+
+    @staticmethod
+    def _time_left(deadline: float) -> float:
+        # Never zero: an admitted request always gets its attempt.
+        return max(deadline - time.monotonic(), 0.001)
+
+    def _deadline_exceeded(self, reason: str) -> DeadlineExceeded:
+        metrics.incr("llm_deadline_exceeded", model=self.model_name)
+        return DeadlineExceeded(f"{reason} ({self.model_name}).")
+
+    def _admit(self, deadline: float) -> Tuple[float, bool]:
+        """
+        Asks the breaker, then the limiter, whether a request may be sent.
+        Returns (seconds to sleep, admitted): once admitted, the request is
+        sent after the sleep; otherwise the caller sleeps and asks again.
+        Raises when the request must not be sent at all.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise self._deadline_exceeded("The deadline passed while waiting to call the LLM")
+        wait = self.breaker.admit()
+        if wait:
+            if self.on_open == "shed" or wait >= remaining:
+                metrics.incr("llm_shed", model=self.model_name)
+                raise CircuitOpenError(f"The circuit for {self.model_name} is open; request shed.")
+            metrics.incr("llm_circuit_queued", model=self.model_name)
+            return wait, False
+        if self.limiter is None:
+            return 0.0, True
+        wait = self.limiter.reserve(max_wait=remaining)
+        if wait is None:
+            # Give back the probe slot the breaker may have handed us.
+            self.breaker.release()
+            raise self._deadline_exceeded("The rate limit leaves no room before the deadline")
+        if wait:
+            metrics.incr("llm_rate_limited", model=self.model_name)
+            metrics.incr("llm_rate_limit_wait_seconds", wait, model=self.model_name)
+        return wait, True
+
+    def _after_failure(self, error: Exception, attempt: int, deadline: float) -> float:
+        """Records a failed attempt and returns the backoff before the next, or raises."""
+        if not is_transient(error):
+            # The backend answered; the request itself is at fault.
+            self.breaker.record_success()
+            metrics.incr("llm_failures", model=self.model_name, kind="permanent")
+            raise error
+        self.breaker.record_failure()
+        metrics.incr("llm_failures", model=self.model_name, kind="transient")
+        if attempt >= self.max_retries:
+            raise LLMUnavailable(f"{self.model_name} failed after {attempt + 1} attempts: "
+                                 f"{type(error).__name__}: {error}") from error
+        # Full jitter: spread retries out so clients do not retry in lockstep.
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            raise self._deadline_exceeded(f"No time left to retry after {type(error).__name__}: {error}") from error
+        logger.info("Retrying %s in %.2fs after %s: %s", self.model_name, delay, type(error).__name__, error)
+        metrics.incr("llm_retries", model=self.model_name, reason=type(error).__name__)
+        return delay
+
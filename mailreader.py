@@ -0,0 +1,105 @@
+# mailreader.py
+import re
+from email import message_from_string, policy
+from email.message import Message
+from email.parser import BytesFeedParser
+from typing import BinaryIO, Iterator, Union
+
+# mboxrd escapes body lines that start with "From " as ">From ", ">>From ", ...
+_ESCAPED_FROM = re.compile(rb"^>+From ")
+
+# Text that marks a part as carrying an invoice.
+INVOICE_MARKERS = ("Invoice Number:", "INVOICE")
+
+# Lines are handed to the parser in blocks of roughly this many bytes.
+_FEED_SIZE = 64 * 1024
+
+
+def _new_parser() -> BytesFeedParser:
+    # compat32 leaves headers as plain strings; the structured header objects
+    # of policy.default cost more than the rest of the parse.
+    return BytesFeedParser(policy=policy.compat32)
+
+
+def iter_messages(source: Union[str, BinaryIO]) -> Iterator[Message]:
+    """
+    Yields the messages of an mbox file (or a single RFC 822 message) one at
+    a time.
+
+    The file is read line by line and fed incrementally into the email
+    parser, so only the message currently being parsed is held in memory,
+    however large the mailbox is.
+
+    Args:
+        source: A path, or a file object opened in binary mode.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from iter_messages(f)
+        return
+
+    parser = None
+    pending = []
+    pending_size = 0
+    previous_blank = True
+    for line in source:
+        # A "From " line after a blank line (or at the start of the file)
+        # separates messages in mbox format.
+        if line.startswith(b"From ") and previous_blank:
+            if parser is not None:
+                parser.feed(b"".join(pending))
+                yield parser.close()
+            parser = _new_parser()
+            pending = []
+            pending_size = 0
+            previous_blank = False
+            continue
+        if parser is None:
+            # Not an mbox: the file is a single message.
+            parser = _new_parser()
+        if _ESCAPED_FROM.match(line):
+            line = line[1:]
+        previous_blank = line in (b"\n", b"\r\n")
+        pending.append(line)
+        pending_size += len(line)
+        if pending_size >= _FEED_SIZE:
+            parser.feed(b"".join(pending))
+            pending = []
+            pending_size = 0
+    if parser is not None:
+        parser.feed(b"".join(pending))
+        yield parser.close()
+
+
+def email_body(email_content: str) -> str:
+    """
+    The body of an email held as a string: what follows the headers, or
+    for a MIME multipart message the first text part that carries an invoice.
+    """
+    header_end = email_content.find("\n\n")  # Headers end at the first double newline
+    if header_end == -1:
+        return email_content
+    if "multipart/" in email_content[:header_end].lower():
+        body = next(iter_invoice_texts(message_from_string(email_content)), None)
+        if body is not None:
+            return body
+    return email_content[header_end + 2:]
+
+
+def iter_invoice_texts(message: Message) -> Iterator[str]:
+    """
+    Yields the decoded text of the parts of `message` that carry an invoice.
+
+    Only text/plain parts (inline bodies or attached .txt files) are decoded;
+    binary attachments and HTML alternatives are skipped without decoding.
+    """
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_type() != "text/plain":
+            continue
+        payload = part.get_payload(decode=True) or b""
+        try:
+            text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        except LookupError:
+            text = payload.decode("utf-8", errors="replace")
+        if any(marker in text for marker in INVOICE_MARKERS):
+            yield text
@@ -1,19 +1,18 @@
 # main.py
 import uuid
 from memory import SharedMemory
-from agents.invoiceprocess import InvoiceProcessingAgent
-from agents.jsonagent import JSONAgent
-from agents.emailagent import EmailAgent
-from agents.classifier import InvoiceClassifierAgent
+from invoicerecord import to_jsonable
+from agents.registry import AgentRegistry
 import json
 
 # Optional: Initialize your LLM if you are using it
 # from llm_integration import LLM
 # llm_instance = LLM()
 shared_memory = SharedMemory()
-invoice_agent = InvoiceProcessingAgent(shared_memory)
-json_agent = JSONAgent(shared_memory)
-email_agent = EmailAgent(shared_memory)
+# Agents are created the first time a run needs them.
+agents = AgentRegistry(shared_memory)
+# The invoice types accepted at the prompt, and the format each stands for.
+TYPE_FORMATS = {"plain": "plain_invoice", "json": "json", "email": "email"}
 #invoice_classifier_agent = InvoiceClassifierAgent(shared_memory, llm_instance if 'llm_instance' in locals() else None)
 
 def main(llm_instance=None, type=None, file_path=None):
@@ -34,20 +33,13 @@ def main(llm_instance=None, type=None, file_path=None):
     interaction_id = str(uuid.uuid4())
     shared_memory.initialize_context(interaction_id)
 
-    if type == "plain":
-        results = invoice_agent.process_invoice(input_data, "text", interaction_id)
-        print(json.dumps(results, indent=2, default=str))
-        shared_memory.print_all_memory()
-    elif type == "json":
-        results = json_agent.process_json(input_data, interaction_id)
-        print(json.dumps(results, indent=2, default=str))
-        shared_memory.print_all_memory()
-    elif type == "email":
-        results = email_agent.process_email(input_data, interaction_id)
-        print(json.dumps(results, indent=2, default=str))
-        shared_memory.print_all_memory()
-    else:
+    try:
+        results = agents.dispatch(input_data, TYPE_FORMATS.get(type), interaction_id)
+    except LookupError:
         print("No suitable invoice processing agent found for the given format.")
+    else:
+        print(json.dumps(results, indent=2, default=to_jsonable))
+        shared_memory.print_all_memory()
 
     shared_memory.print_all_memory()
     print("-" * 30)
@@ -1,24 +1,29 @@
 # main.py
 import uuid
 from memory import SharedMemory
-from agents.invoiceprocess import InvoiceProcessingAgent
-from agents.jsonagent import JSONAgent
-from agents.emailagent import EmailAgent
-from agents.classifier import InvoiceClassifierAgent
+from agents.registry import AgentRegistry
+from document import read_document
+from invoicerecord import to_jsonable
 import json
 
+# How each agent's results are headed in the output.
+AGENT_TITLES = {
+    "invoice_agent": "Plain Invoice Agent",
+    "json_agent": "JSON Invoice Agent",
+    "email_agent": "Email Invoice Agent",
+}
+
 def main():
     shared_memory = SharedMemory()
-    invoice_agent = InvoiceProcessingAgent(shared_memory)
-    json_agent = JSONAgent(shared_memory)
-    email_agent = EmailAgent(shared_memory)
-    classifier_agent = InvoiceClassifierAgent(shared_memory)
+    # Only the classifier and the one agent the file is routed to get created.
+    agents = AgentRegistry(shared_memory)
+    classifier_agent = agents.get("classifier_agent")
 
     file_path = input("Enter the path to the invoice file, or 'exit':\n")
     if file_path.lower() == 'exit':
         return
 
-    raw_input = InvoiceClassifierAgent.read_file_content(file_path)
+    raw_input = read_document(file_path)
 
     if raw_input is not None:
         interaction_id = str(uuid.uuid4())
@@ -29,15 +34,9 @@ def main():
 
         target_agent = classifier_agent.route_invoice(raw_input, classification, interaction_id)
 
-        if target_agent == "invoice_agent":
-            results = invoice_agent.process_invoice(raw_input, "text",interaction_id)
-            print(f"\nPlain Invoice Agent Results:\n{json.dumps(results, indent=2, default=str)}")
-        elif target_agent == "json_agent":
-            results = json_agent.process_json(raw_input, interaction_id)
-            print(f"\nJSON Invoice Agent Results:\n{json.dumps(results, indent=2, default=str)}")
-        elif target_agent == "email_agent":
-            results = email_agent.process_email(raw_input, interaction_id)
-            print(f"\nEmail Invoice Agent Results:\n{json.dumps(results, indent=2, default=str)}")
+        if target_agent is not None:
+            results = agents.dispatch(raw_input, classification.get("format"), interaction_id)
+            print(f"\n{AGENT_TITLES[target_agent]} Results:\n{json.dumps(results, indent=2, default=to_jsonable)}")
         else:
             print("No suitable agent found for the given format.")
 
@@ -0,0 +1,158 @@
+# manifest.py
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Files are hashed in blocks of this many bytes.
+_HASH_BLOCK = 1 << 20
+
+
+class FileState:
+    """A file as it was when a scan found it: size, modification time and content hash."""
+    __slots__ = ("path", "size", "mtime_ns", "sha256")
+
+    def __init__(self, path: str, size: int, mtime_ns: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+
+def record_error(record: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+    """
+    The error a result record reports, its own or the one its agent
+    returned, and whether the agent said trying again may succeed.
+    """
+    results = record.get("results")
+    if "error" in record or not isinstance(results, Mapping) or "error" not in results:
+        return record.get("error"), False
+    return results["error"], bool(results.get("retryable"))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ProcessingManifest:
+    def __init__(self, path: str = "flow_manifest.sqlite3"):
+        """
+        Remembers which files have been processed, as they were when
+        processed, so an inbox can be scanned again and again and only new
+        or changed files are handed on. A file counts as changed when its
+        size or modification time differs and its SHA-256 does too; a file
+        that was only touched is not processed again.
+
+        Completion is recorded in SQLite transactions, so after a crash or
+        restart the manifest holds exactly the files whose results were
+        committed, and a new run carries on with the rest.
+
+        Args:
+            path: The SQLite file holding the manifest.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " interaction_id TEXT,"
+            " error TEXT,"
+            " processed_at REAL NOT NULL)"
+        )
+
+    def pending(self, paths: Iterable[str], settle_seconds: float = 1.0,
+                retry_failed: bool = False) -> List[FileState]:
+        """
+        The files among `paths` that still need processing: those not in
+        the manifest and those changed since they were processed.
+
+        Args:
+            paths: The files found by a scan.
+            settle_seconds: Files modified more recently than this are left
+                for a later scan, as they may still be being written.
+            retry_failed: Also return unchanged files whose processing
+                failed last time.
+        """
+        pending = []
+        now_ns = time.time_ns()
+        with self._lock:
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now_ns - stat.st_mtime_ns < settle_seconds * 1e9:
+                    metrics.incr("manifest_files", result="unsettled")
+                    continue
+                row = self._conn.execute(
+                    "SELECT size, mtime_ns, sha256, status FROM files WHERE path = ?", (path,)
+                ).fetchone()
+                # Files that failed for a passing reason (the LLM was down)
+                # are always retried; other failures only when asked to.
+                finished = row is not None and (row[3] == "done" or (row[3] == "failed" and not retry_failed))
+                if finished and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                    metrics.incr("manifest_files", result="unchanged")
+                    continue
+                try:
+                    sha256 = file_sha256(path)
+                except OSError as e:
+                    logger.warning("Could not hash %s: %s", path, e)
+                    continue
+                if finished and row[2] == sha256:
+                    # Touched or copied over with the same content.
+                    self._conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?",
+                                       (stat.st_size, stat.st_mtime_ns, path))
+                    metrics.incr("manifest_files", result="unchanged")
+                    continue
+                metrics.incr("manifest_files", result="changed" if row is not None else "new")
+                pending.append(FileState(path, stat.st_size, stat.st_mtime_ns, sha256))
+        return pending
+
+    def complete(self, entries: List[Tuple[FileState, Dict[str, Any]]]):
+        """
+        Records files as processed, all in one transaction. Each entry is a
+        file's state from pending() and its result record; records with an
+        error (see record_error) are recorded as failed, or as retryable
+        when the agent said so.
+        """
+        now = time.time()
+        rows = []
+        for state, record in entries:
+            error, retryable = record_error(record)
+            status = "done" if error is None else "retryable" if retryable else "failed"
+            rows.append((state.path, state.size, state.mtime_ns, state.sha256, status,
+                         record.get("interaction_id"), error, now))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
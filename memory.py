@@ -1,32 +1,466 @@
 # memory.py
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from invoicerecord import to_jsonable, to_plain
+
+logger = logging.getLogger(__name__)
+
+
+def _approx_size(value, _seen=None) -> int:
+    """Approximate deep size in bytes of a stored value (containers and their contents)."""
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += _approx_size(k, _seen) + _approx_size(v, _seen)
+    elif isinstance(value, Mapping):
+        # Records (see invoicerecord); their keys are shared, not stored.
+        for v in value.values():
+            size += _approx_size(v, _seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += _approx_size(v, _seen)
+    return size
+
+
+class InteractionContext:
+    """The data stored for one interaction, plus the bookkeeping used for eviction."""
+    __slots__ = ("data", "created_at", "accessed_at", "size")
+
+    def __init__(self, now: float):
+        self.data = {}
+        self.created_at = now
+        self.accessed_at = now
+        self.size = 0
+
+
+class MemoryBackend:
+    """
+    Storage behind SharedMemory. Backends hold one key/value context per
+    interaction ID and must be safe to call from several threads.
+    """
+
+    def initialize(self, interaction_id: str):
+        raise NotImplementedError
+
+    def store(self, interaction_id: str, key: str, value) -> bool:
+        """Stores a value; returns False if the interaction is unknown."""
+        raise NotImplementedError
+
+    def get_context(self, interaction_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def release(self, interaction_id: str) -> bool:
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yields (interaction_id, context) pairs."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class InMemoryBackend(MemoryBackend):
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl_seconds: float = None):
+        """
+        Args:
+            max_entries: Maximum number of interactions kept; the least
+                recently used are evicted beyond it. None means unlimited.
+            max_bytes: Approximate limit on the total size of stored values.
+                Sizes are only tracked on store when it is set; otherwise
+                stats() measures them when asked.
+            ttl_seconds: Interactions not touched for this long are dropped.
+        """
+        # interaction_id -> InteractionContext, least recently used first
+        self.memory = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.RLock()
+
+    def initialize(self, interaction_id: str):
+        with self._lock:
+            now = time.monotonic()
+            context = self.memory.get(interaction_id)
+            if context is None:
+                self.memory[interaction_id] = InteractionContext(now)
+            else:
+                self._touch(interaction_id, context, now)
+            self._evict(now, keep=interaction_id)
+
+    def store(self, interaction_id: str, key: str, value) -> bool:
+        with self._lock:
+            context = self.memory.get(interaction_id)
+            if context is None:
+                return False
+            now = time.monotonic()
+            if self.max_bytes is not None:
+                if key in context.data:
+                    old_size = _approx_size(context.data[key])
+                    context.size -= old_size
+                    self.total_bytes -= old_size
+                size = _approx_size(value)
+                context.size += size
+                self.total_bytes += size
+            context.data[key] = value
+            self._touch(interaction_id, context, now)
+            self._evict(now, keep=interaction_id)
+            return True
+
+    def get_context(self, interaction_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            context = self.memory.get(interaction_id)
+            if context is None:
+                return None
+            now = time.monotonic()
+            if self._expired(context, now):
+                self._remove(interaction_id)
+                self.expirations += 1
+                return None
+            self._touch(interaction_id, context, now)
+            return context.data
+
+    def release(self, interaction_id: str) -> bool:
+        with self._lock:
+            if interaction_id not in self.memory:
+                return False
+            self._remove(interaction_id)
+            return True
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            snapshot = [(interaction_id, context.data) for interaction_id, context in self.memory.items()]
+        return iter(snapshot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            if self.max_bytes is not None:
+                approx_bytes = self.total_bytes
+            else:
+                approx_bytes = sum(_approx_size(value)
+                                   for context in self.memory.values() for value in context.data.values())
+            return {
+                "backend": "memory",
+                "entries": len(self.memory),
+                "approx_bytes": approx_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+    def _touch(self, interaction_id: str, context: InteractionContext, now: float):
+        context.accessed_at = now
+        self.memory.move_to_end(interaction_id)
+
+    def _expired(self, context: InteractionContext, now: float) -> bool:
+        return self.ttl_seconds is not None and now - context.accessed_at > self.ttl_seconds
+
+    def _remove(self, interaction_id: str):
+        context = self.memory.pop(interaction_id)
+        self.total_bytes -= context.size
+
+    def _evict(self, now: float, keep: str = None):
+        """Drops expired interactions, then least recently used ones while over a limit."""
+        # Contexts are ordered by last access, so expired ones are at the front.
+        while self.memory:
+            interaction_id, context = next(iter(self.memory.items()))
+            if interaction_id == keep or not self._expired(context, now):
+                break
+            self._remove(interaction_id)
+            self.expirations += 1
+
+        while len(self.memory) > 1 and (
+                (self.max_entries is not None and len(self.memory) > self.max_entries) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            interaction_id = next(iter(self.memory))
+            if interaction_id == keep:
+                break
+            self._remove(interaction_id)
+            self.evictions += 1
+
+
+class SQLiteMemoryBackend(MemoryBackend):
+    KNOWN_IDS = 4096
+
+    def __init__(self, path: str = "shared_memory.sqlite3", batch_size: int = 200,
+                 flush_interval: float = 0.5, max_entries: int = None, ttl_seconds: float = None):
+        """
+        A persistent store that several processes can open at once. SQLite in
+        WAL mode lets readers proceed while one writer commits; writes are
+        buffered and committed in batches so each store_data is not a
+        transaction of its own.
+
+        Values are stored as JSON, so they come back as plain dicts/lists and
+        anything not JSON-serializable is stored as its str().
+
+        Args:
+            path: The database file, shared by every process using the store.
+            batch_size: Buffered writes that trigger a commit.
+            flush_interval: Seconds after which buffered writes are committed
+                on the next write, even if the batch is not full.
+            max_entries: Interactions kept; least recently written are pruned
+                at flush time. None means unlimited.
+            ttl_seconds: Interactions not written to for this long are pruned.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flushes = 0
+        self._lock = threading.RLock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        # Interactions known to exist, so store() need not ask the database;
+        # the most recently used KNOWN_IDS, as _exists answers for the rest.
+        self._known = OrderedDict()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not cross a fork; workers reopen the database.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS contexts ("
+                " interaction_id TEXT PRIMARY KEY,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS contexts_updated ON contexts (updated_at);"
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " interaction_id TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT,"
+                " PRIMARY KEY (interaction_id, key));"
+            )
+            if self._pid is not None:
+                # Writes buffered before a fork belong to the parent.
+                self._pending = []
+                self._known = OrderedDict()
+            self._pid = os.getpid()
+        return self._conn
+
+    def initialize(self, interaction_id: str):
+        with self._lock:
+            now = time.time()
+            self._pending.append((
+                "INSERT INTO contexts (interaction_id, created_at, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(interaction_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (interaction_id, now, now),
+            ))
+            self._remember(interaction_id)
+            self._maybe_flush()
+
+    def store(self, interaction_id: str, key: str, value) -> bool:
+        with self._lock:
+            if interaction_id not in self._known and not self._exists(interaction_id):
+                return False
+            self._remember(interaction_id)
+            self._pending.append((
+                "INSERT OR REPLACE INTO entries (interaction_id, key, value) VALUES (?, ?, ?)",
+                (interaction_id, key, json.dumps(value, default=to_jsonable)),
+            ))
+            self._pending.append((
+                "UPDATE contexts SET updated_at = ? WHERE interaction_id = ?",
+                (time.time(), interaction_id),
+            ))
+            self._maybe_flush()
+            return True
+
+    def get_context(self, interaction_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            # Read-your-writes: commit anything buffered before reading.
+            self.flush()
+            if not self._exists(interaction_id):
+                return None
+            rows = self._connection().execute(
+                "SELECT key, value FROM entries WHERE interaction_id = ?", (interaction_id,)
+            ).fetchall()
+            return {key: json.loads(value) for key, value in rows}
+
+    def release(self, interaction_id: str) -> bool:
+        with self._lock:
+            self.flush()
+            self._known.pop(interaction_id, None)
+            conn = self._connection()
+            with _transaction(conn):
+                conn.execute("DELETE FROM entries WHERE interaction_id = ?", (interaction_id,))
+                cursor = conn.execute("DELETE FROM contexts WHERE interaction_id = ?", (interaction_id,))
+            return cursor.rowcount > 0
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            self.flush()
+            ids = [row[0] for row in self._connection().execute(
+                "SELECT interaction_id FROM contexts ORDER BY updated_at")]
+        for interaction_id in ids:
+            context = self.get_context(interaction_id)
+            if context is not None:
+                yield interaction_id, context
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self.flush()
+            (entries,) = self._connection().execute("SELECT COUNT(*) FROM contexts").fetchone()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "entries": entries,
+            "db_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "flushes": self.flushes,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+    def flush(self):
+        """Commits buffered writes in a single transaction."""
+        with self._lock:
+            conn = self._connection()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            with _transaction(conn):
+                for statement, params in pending:
+                    conn.execute(statement, params)
+                self._prune(conn)
+            self._last_flush = time.monotonic()
+            self.flushes += 1
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self.flush()
+                self._conn.close()
+            self._conn = None
+
+    def _maybe_flush(self):
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _exists(self, interaction_id: str) -> bool:
+        self.flush()
+        return self._connection().execute(
+            "SELECT 1 FROM contexts WHERE interaction_id = ?", (interaction_id,)
+        ).fetchone() is not None
+
+    def _prune(self, conn: sqlite3.Connection):
+        stale = []
+        if self.ttl_seconds is not None:
+            stale += [row[0] for row in conn.execute(
+                "SELECT interaction_id FROM contexts WHERE updated_at < ?", (time.time() - self.ttl_seconds,))]
+        if self.max_entries is not None:
+            stale += [row[0] for row in conn.execute(
+                "SELECT interaction_id FROM contexts ORDER BY updated_at DESC LIMIT -1 OFFSET ?",
+                (self.max_entries,))]
+        for interaction_id in stale:
+            conn.execute("DELETE FROM entries WHERE interaction_id = ?", (interaction_id,))
+            conn.execute("DELETE FROM contexts WHERE interaction_id = ?", (interaction_id,))
+            self._known.pop(interaction_id, None)
+
+    def _remember(self, interaction_id: str):
+        self._known[interaction_id] = None
+        self._known.move_to_end(interaction_id)
+        if len(self._known) > self.KNOWN_IDS:
+            self._known.popitem(last=False)
+
+
+class _transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK on an autocommit connection."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        # IMMEDIATE takes the write lock up front, so concurrent writers wait
+        # on busy_timeout instead of failing with a deadlock on upgrade.
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
 class SharedMemory:
-    def __init__(self):
-        self.memory = {}  # Using an in-memory dictionary for simplicity
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl_seconds: float = None,
+                 backend: MemoryBackend = None):
+        """
+        Args:
+            max_entries: Maximum number of interactions kept; the least
+                recently used are evicted beyond it. None means unlimited.
+            max_bytes: Approximate limit on the total size of stored values.
+            ttl_seconds: Interactions not touched for this long are dropped.
+            backend: Storage to use instead of the default in-process store
+                (e.g. SQLiteMemoryBackend to share state between processes).
+                The limits above only configure the default store.
+        """
+        self.backend = backend or InMemoryBackend(max_entries, max_bytes, ttl_seconds)
 
     def initialize_context(self, interaction_id: str):
-        if interaction_id not in self.memory:
-            self.memory[interaction_id] = {}
-        print(f"Memory initialized for interaction ID: {interaction_id}")
+        self.backend.initialize(interaction_id)
+        logger.debug("Memory initialized for interaction ID: %s", interaction_id)
 
     def store_data(self, interaction_id: str, key: str, value):
-        if interaction_id in self.memory:
-            self.memory[interaction_id][key] = value
-            print(f"Stored '{key}' for interaction ID '{interaction_id}'")
+        if self.backend.store(interaction_id, key, value):
+            logger.debug("Stored '%s' for interaction ID '%s'", key, interaction_id)
         else:
-            print(f"Warning: Interaction ID '{interaction_id}' not found in memory. Cannot store '{key}'.")
+            logger.warning("Interaction ID '%s' not found in memory. Cannot store '%s'.", interaction_id, key)
 
     def retrieve_data(self, interaction_id: str, key: str):
-        if interaction_id in self.memory and key in self.memory[interaction_id]:
-            return self.memory[interaction_id][key]
+        context = self.get_context(interaction_id)
+        if context is not None and key in context:
+            return context[key]
         return None
 
     def get_context(self, interaction_id: str):
-        return self.memory.get(interaction_id)
+        return self.backend.get_context(interaction_id)
+
+    def release(self, interaction_id: str) -> bool:
+        """Drops an interaction's context once nothing needs it any more."""
+        return self.backend.release(interaction_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns memory-use statistics, for sizing workers."""
+        return self.backend.stats()
+
+    def flush(self):
+        """Makes buffered writes visible to other processes sharing the backend."""
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
 
     def print_all_memory(self):
         print("\n--- Current Shared Memory Contents ---")
-        for interaction_id, context in self.memory.items():
+        for interaction_id, context in self.backend.items():
             print(f"Interaction ID: {interaction_id}")
             for key, value in context.items():
-                print(f"  {key}: {value}")
-        print("--------------------------------------")
\ No newline at end of file
+                print(f"  {key}: {to_plain(value)}")
+        print("--------------------------------------")
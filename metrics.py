@@ -0,0 +1,210 @@
+# metrics.py
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, List
+
+
+class _NoopSpan:
+    """Returned by span() while metrics are disabled, so timing costs nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("registry", "stage", "interaction_id", "agent", "started")
+
+    def __init__(self, registry, stage: str, interaction_id: str, agent: str):
+        self.registry = registry
+        self.stage = stage
+        self.interaction_id = interaction_id
+        self.agent = agent
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry._record_span(self.stage, self.agent, self.interaction_id,
+                                   time.perf_counter() - self.started, exc_type)
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False, recent_spans: int = 10_000):
+        """
+        A process-local registry of stage timings, counters and gauges.
+
+        Args:
+            enabled: When False, span() and incr() return immediately.
+            recent_spans: How many individual spans (with their interaction ID)
+                to keep for inspection; totals are kept for all of them.
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}    # (stage, agent) -> [count, total_seconds, max_seconds, errors]
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}    # (name, labels) -> value
+        self._recent = deque(maxlen=recent_spans)
+
+    def span(self, stage: str, interaction_id: str = None, agent: str = None):
+        """
+        Times a block as one pipeline stage:
+
+            with metrics.span("extract", interaction_id, "email_agent"):
+                ...
+
+        Exceptions raised inside the block are counted as errors for the stage.
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, stage, interaction_id, agent)
+
+    def incr(self, name: str, value: float = 1, **labels):
+        """Adds `value` to a counter, e.g. incr("llm_requests") or incr("errors", kind="parse")."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Records the current value of a level, such as a queue depth."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def _record_span(self, stage: str, agent: str, interaction_id: str, seconds: float, exc_type):
+        with self._lock:
+            stats = self._stages.get((stage, agent))
+            if stats is None:
+                stats = self._stages[(stage, agent)] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+            if exc_type is not None:
+                stats[3] += 1
+            self._recent.append((stage, agent, interaction_id, seconds))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns the current totals as plain, JSON-serializable data."""
+        with self._lock:
+            return self._snapshot_unlocked()
+
+    def _snapshot_unlocked(self) -> Dict[str, Any]:
+        return {
+            "stages": [
+                {"stage": stage, "agent": agent, "count": count, "total_seconds": total,
+                 "max_seconds": max_seconds, "errors": errors}
+                for (stage, agent), (count, total, max_seconds, errors) in self._stages.items()
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._gauges.items()
+            ],
+        }
+
+    def recent_spans(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"stage": stage, "agent": agent, "interaction_id": interaction_id, "seconds": seconds}
+                for stage, agent, interaction_id, seconds in self._recent
+            ]
+
+    def drain(self) -> Dict[str, Any]:
+        """Returns the current totals and resets them, for shipping to another process."""
+        with self._lock:
+            snapshot = self._snapshot_unlocked()
+            self._reset_unlocked()
+        return snapshot
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """Adds totals drained from another registry (e.g. a worker process) into this one."""
+        with self._lock:
+            for entry in snapshot.get("stages", []):
+                key = (entry["stage"], entry["agent"])
+                stats = self._stages.get(key)
+                if stats is None:
+                    stats = self._stages[key] = [0, 0.0, 0.0, 0]
+                stats[0] += entry["count"]
+                stats[1] += entry["total_seconds"]
+                stats[2] = max(stats[2], entry["max_seconds"])
+                stats[3] += entry["errors"]
+            for entry in snapshot.get("counters", []):
+                key = (entry["name"], tuple(sorted(entry["labels"].items())))
+                self._counters[key] = self._counters.get(key, 0) + entry["value"]
+            for entry in snapshot.get("gauges", []):
+                self._gauges[(entry["name"], tuple(sorted(entry["labels"].items())))] = entry["value"]
+
+    def reset(self):
+        with self._lock:
+            self._reset_unlocked()
+
+    def _reset_unlocked(self):
+        self._stages.clear()
+        self._counters.clear()
+        self._gauges.clear()
+        self._recent.clear()
+
+    def export_json(self, indent: int = 2) -> str:
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def export_prometheus(self, prefix: str = "flow") -> str:
+        """Renders the totals in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for entry in snapshot["stages"]:
+            labels = _format_labels({"stage": entry["stage"], "agent": entry["agent"]})
+            lines.append(f"{prefix}_stage_seconds_count{labels} {entry['count']}")
+            lines.append(f"{prefix}_stage_seconds_sum{labels} {entry['total_seconds']:.6f}")
+        lines.append(f"# TYPE {prefix}_stage_seconds_max gauge")
+        for entry in snapshot["stages"]:
+            labels = _format_labels({"stage": entry["stage"], "agent": entry["agent"]})
+            lines.append(f"{prefix}_stage_seconds_max{labels} {entry['max_seconds']:.6f}")
+        lines.append(f"# TYPE {prefix}_stage_errors_total counter")
+        for entry in snapshot["stages"]:
+            labels = _format_labels({"stage": entry["stage"], "agent": entry["agent"]})
+            lines.append(f"{prefix}_stage_errors_total{labels} {entry['errors']}")
+
+        for name in sorted({entry["name"] for entry in snapshot["counters"]}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for entry in snapshot["counters"]:
+                if entry["name"] == name:
+                    lines.append(f"{prefix}_{name}_total{_format_labels(entry['labels'])} {entry['value']}")
+        for name in sorted({entry["name"] for entry in snapshot["gauges"]}):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for entry in snapshot["gauges"]:
+                if entry["name"] == name:
+                    lines.append(f"{prefix}_{name}{_format_labels(entry['labels'])} {entry['value']}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    parts = [
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items() if v is not None
+    ]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+# The registry the agents report to. Off unless FLOW_METRICS=1 or a caller
+# sets metrics.enabled = True.
+metrics = Metrics(enabled=os.environ.get("FLOW_METRICS") == "1")
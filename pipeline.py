@@ -0,0 +1,288 @@
+# pipeline.py
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Dict, Any, Callable, Iterable, Iterator, Optional
+
+from agents.registry import AgentRegistry
+from document import read_document
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Agents that mostly wait (on the LLM, or on PDF extraction) rather than
+# compute. Their documents are extracted in the IO pool, so one slow LLM call
+# never holds up the email and JSON documents queued behind it.
+IO_AGENTS = frozenset({"invoice_agent"})
+
+# Put on a stage's queue once per thread when its producers are finished.
+_DONE = object()
+
+
+class _Job:
+    """One document on its way through the pipeline."""
+    __slots__ = ("record", "document", "started", "cancelled")
+
+    def __init__(self, path: str, cancelled: threading.Event):
+        self.record = {"file": path, "interaction_id": None, "format": None, "agent": None}
+        self.document = None
+        self.started = time.perf_counter()
+        self.cancelled = cancelled
+
+
+class Stage:
+    def __init__(self, name: str, handler: Callable[[Any], Optional[str]], workers: int,
+                 queue_size: int, pool: str,
+                 on_error: Optional[Callable[[Any, Exception], Optional[str]]] = None):
+        """
+        A pool of threads serving one bounded queue. Producers block while
+        the queue is full, so a slow stage holds back the ones feeding it
+        instead of letting work pile up in memory.
+
+        Args:
+            name: Used for thread names and the stage label of its metrics.
+            handler: Called with each item; returns the name of the stage to
+                hand the item to next (see feeds), or None to drop it.
+            workers: Threads serving the queue. 0 makes a sink, whose queue
+                the caller consumes.
+            queue_size: Items that may wait in the queue.
+            pool: "cpu" or "io", the pool label of its metrics.
+            on_error: Called with the item and the exception when the handler
+                raises; returns where the item goes next, as the handler does.
+                Without it the item is dropped.
+        """
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.workers = workers
+        self.pool = pool
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_depth = 0
+        self._downstream = {}
+        self._producers = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def feeds(self, *stages: "Stage"):
+        """Lets the handler hand items to `stages`, which are closed once this stage finishes."""
+        for stage in stages:
+            stage.add_producer()
+            self._downstream[stage.name] = stage
+
+    def add_producer(self):
+        with self._lock:
+            self._producers += 1
+
+    def close(self):
+        """Called by each producer when it is done; the last one stops the stage's threads."""
+        with self._lock:
+            self._producers -= 1
+            last = self._producers == 0
+        if last:
+            for _ in range(max(self.workers, 1)):
+                self.queue.put(_DONE)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            metrics.incr("queue_full", stage=self.name, pool=self.pool)
+            self.queue.put(item)
+        self._record_depth()
+
+    def get(self):
+        item = self.queue.get()
+        if item is not _DONE:
+            self._record_depth()
+        return item
+
+    def start(self):
+        self._running = self.workers
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._serve, name=f"pipeline-{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _record_depth(self):
+        depth = self.queue.qsize()
+        metrics.set_gauge("queue_depth", depth, stage=self.name, pool=self.pool)
+        if depth > self.max_depth:
+            self.max_depth = depth
+            metrics.set_gauge("queue_depth_max", depth, stage=self.name, pool=self.pool)
+
+    def _serve(self):
+        while True:
+            item = self.get()
+            if item is _DONE:
+                break
+            try:
+                next_stage = self.handler(item)
+            except Exception as e:
+                logger.exception("Unhandled error in pipeline stage %s", self.name)
+                next_stage = self._recover(item, e)
+            if next_stage is not None:
+                self._downstream[next_stage].put(item)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            for stage in self._downstream.values():
+                stage.close()
+
+    def _recover(self, item, error: Exception) -> Optional[str]:
+        if self.on_error is not None:
+            try:
+                return self.on_error(item, error)
+            except Exception:
+                logger.exception("Error handler of pipeline stage %s failed", self.name)
+        # Nothing to hand on: the item is dropped, this only keeps the thread alive.
+        metrics.incr("errors", kind="pipeline", agent=self.name)
+        return None
+
+
+class Pipeline:
+    def __init__(self, agents: AgentRegistry, cpu_workers: int = 1, io_workers: int = 8,
+                 queue_size: int = 64, persistent: bool = False):
+        """
+        Runs read -> classify -> extract as concurrent stages connected by
+        bounded queues, instead of one document at a time.
+
+        Classification and the regex/JSON extraction of email and JSON
+        documents run in the CPU pool; reading files and the LLM-backed
+        extraction of text and PDF invoices run in the IO pool, so documents
+        waiting on the LLM do not delay the rest. Each stage reports its
+        queue depth as the queue_depth and queue_depth_max gauges, and how
+        often it pushed back on its producers as the queue_full counter.
+
+        The stages are threads, so the CPU pool mostly keeps the cheap work
+        moving while the IO pool waits; for CPU-bound batches use batch.py's
+        process pool instead.
+
+        Args:
+            agents: The AgentRegistry documents are classified and processed with.
+            cpu_workers: Threads for each CPU stage.
+            io_workers: Threads for each IO stage, i.e. concurrent LLM calls.
+            queue_size: Documents that may wait in front of each stage.
+            persistent: Flush the shared memory after each document instead
+                of releasing its context (for a persistent memory backend).
+        """
+        self.agents = agents
+        self.memory = agents.memory
+        self.cpu_workers = cpu_workers
+        self.io_workers = io_workers
+        self.queue_size = queue_size
+        self.persistent = persistent
+
+    def run(self, file_paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Processes the files, yielding one result record per file (as batch.py
+        does) in the order they complete.
+
+        Args:
+            file_paths: The files to process; consumed lazily, as the read
+                stage has room for them.
+        """
+        cancelled = threading.Event()
+        results = Stage("results", None, 0, self.queue_size, "sink")
+        # A handler that raises still sends its document's record, with the
+        # error, on to the results: every file yields exactly one record.
+        extract_cpu = Stage("extract_cpu", self._extract, self.cpu_workers, self.queue_size, "cpu", self._fail)
+        extract_io = Stage("extract_io", self._extract, self.io_workers, self.queue_size, "io", self._fail)
+        classify = Stage("classify", self._classify, self.cpu_workers, self.queue_size, "cpu", self._fail)
+        read = Stage("read", self._read, self.io_workers, self.queue_size, "io", self._fail)
+        read.feeds(classify, results)
+        classify.feeds(extract_cpu, extract_io, results)
+        extract_cpu.feeds(results)
+        extract_io.feeds(results)
+        read.add_producer()
+
+        def feed():
+            try:
+                for path in file_paths:
+                    if cancelled.is_set():
+                        break
+                    read.put(_Job(path, cancelled))
+            finally:
+                read.close()
+
+        for stage in (results, extract_cpu, extract_io, classify, read):
+            stage.start()
+        threading.Thread(target=feed, name="pipeline-feed", daemon=True).start()
+
+        finished = False
+        try:
+            while True:
+                job = results.get()
+                if job is _DONE:
+                    finished = True
+                    return
+                yield job.record
+        finally:
+            if not finished:
+                # The caller stopped early: let the documents in flight through
+                # without processing them, so every thread can exit.
+                cancelled.set()
+                while results.get() is not _DONE:
+                    pass
+
+    def _read(self, job: _Job) -> str:
+        job.started = time.perf_counter()
+        if job.cancelled.is_set():
+            return "results"
+        with metrics.span("read", None, "pipeline"):
+            job.document = read_document(job.record["file"])
+        if job.document is None:
+            job.record["error"] = "Could not read invoice data from the file."
+            metrics.incr("errors", kind="read", agent="pipeline")
+            return self._finish(job)
+        interaction_id = job.record["interaction_id"] = str(uuid.uuid4())
+        self.memory.initialize_context(interaction_id)
+        return "classify"
+
+    def _classify(self, job: _Job) -> str:
+        if job.cancelled.is_set():
+            return self._finish(job)
+        record = job.record
+        classifier_agent = self.agents.get("classifier_agent")
+        try:
+            classification = classifier_agent.classify_invoice(job.document, record["interaction_id"])
+            record["format"] = classification.get("format")
+            record["agent"] = classifier_agent.route_invoice(job.document, classification, record["interaction_id"])
+        except Exception as e:
+            return self._fail(job, e)
+        if record["agent"] is None:
+            record["error"] = "No suitable agent found for the given format."
+            return self._finish(job)
+        return "extract_io" if record["agent"] in IO_AGENTS else "extract_cpu"
+
+    def _extract(self, job: _Job) -> str:
+        if job.cancelled.is_set():
+            return self._finish(job)
+        record = job.record
+        try:
+            record["results"] = self.agents.dispatch(job.document, record["format"], record["interaction_id"])
+        except Exception as e:
+            return self._fail(job, e)
+        return self._finish(job)
+
+    def _fail(self, job: _Job, error: Exception) -> str:
+        job.record["error"] = f"{type(error).__name__}: {error}"
+        metrics.incr("errors", kind="unhandled", agent=job.record["agent"])
+        return self._finish(job)
+
+    def _finish(self, job: _Job) -> str:
+        """Releases what the document held and sends its record on to the results."""
+        if job.document is not None:
+            job.document.close()
+            job.document = None
+        interaction_id = job.record["interaction_id"]
+        if interaction_id is not None:
+            if self.persistent:
+                self.memory.flush()
+            else:
+                self.memory.release(interaction_id)
+        job.record["elapsed_ms"] = round((time.perf_counter() - job.started) * 1000, 3)
+        return "results"
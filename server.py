@@ -0,0 +1,332 @@
+# server.py
+import argparse
+import base64
+import binascii
+import json
+import logging
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Callable, List, Optional
+from urllib.parse import urlsplit, parse_qs
+
+from dedup import DuplicateIndex
+from document import Document
+from invoicerecord import to_jsonable
+from memory import SharedMemory, SQLiteMemoryBackend
+from llmcache import ExtractionCache
+from llmresilience import set_rate
+from metrics import metrics
+from sinks import ResultSink, open_sink
+from agents.formatmodel import FormatModel
+from agents.registry import AgentRegistry, DEFAULT_AGENTS, ROUTES, route_for
+
+logger = logging.getLogger(__name__)
+
+# Requests with a larger body are refused with 413.
+MAX_BODY_BYTES = 32 << 20
+
+
+class BadRequest(ValueError):
+    """A request the client has to fix; answered with 400."""
+
+
+class InvoiceService:
+    def __init__(self, agents: AgentRegistry, workers: int = 8, sinks: List[ResultSink] = ()):
+        """
+        The warm state behind the server: one SharedMemory and one set of
+        agents, built once and shared by every request.
+
+        Args:
+            agents: The AgentRegistry to classify and process documents with.
+            workers: Threads a batched request is spread over.
+            sinks: ResultSinks every processed document is also written to.
+        """
+        self.agents = agents
+        self.sinks = list(sinks)
+        self.memory = agents.memory
+        self.started = time.time()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flow-service")
+
+    def warm(self):
+        """Builds every agent now rather than on the first request that needs it."""
+        for name in DEFAULT_AGENTS:
+            self.agents.get(name)
+
+    def classify(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Classifies one document entry (see _document) and returns its format and route."""
+        document = _document(entry)
+        interaction_id = str(uuid.uuid4())
+        self.memory.initialize_context(interaction_id)
+        classifier_agent = self.agents.get("classifier_agent")
+        response = _response(entry, interaction_id)
+        try:
+            classification = classifier_agent.classify_invoice(document, interaction_id)
+            response.update(classification)
+            response["agent"] = classifier_agent.route_invoice(document, classification, interaction_id)
+        except Exception as e:
+            logger.exception("Classification failed for interaction ID %s", interaction_id)
+            metrics.incr("errors", kind="unhandled", agent="classifier_agent")
+            response["error"] = f"{type(e).__name__}: {e}"
+        return response
+
+    def process(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Classifies one document entry (unless it names its "format") and
+        processes it with the agent the format routes to.
+        """
+        document = _document(entry)
+        format = entry.get("format")
+        if format is not None:
+            if not isinstance(format, str) or format not in ROUTES:
+                raise BadRequest(f'"format" must be one of {", ".join(sorted(ROUTES))}.')
+            if format == "pdf" and document.raw is None:
+                raise BadRequest('A "pdf" document must be sent as "content_base64".')
+        interaction_id = str(uuid.uuid4())
+        self.memory.initialize_context(interaction_id)
+        response = _response(entry, interaction_id)
+        if format is None:
+            classification = self.agents.get("classifier_agent").classify_invoice(document, interaction_id)
+            response.update(classification)
+            format = classification["format"]
+        else:
+            response["format"] = format
+        response["agent"] = route_for(format)
+        if response["agent"] is None:
+            response["error"] = "No suitable agent found for the given format."
+            return response
+        try:
+            response["results"] = self.agents.dispatch(document, format, interaction_id)
+        except Exception as e:
+            logger.exception("Processing failed for interaction ID %s", interaction_id)
+            metrics.incr("errors", kind="unhandled", agent=response["agent"])
+            response["error"] = f"{type(e).__name__}: {e}"
+        for sink in self.sinks:
+            sink.write(response)
+        return response
+
+    def handle(self, operation: Callable[[Dict[str, Any]], Dict[str, Any]], body: Any) -> Dict[str, Any]:
+        """
+        Runs `operation` on a request body: a single document entry, or
+        {"documents": [entry, ...]}, whose entries are handled concurrently
+        and answered as {"results": [...]} in the same order.
+        """
+        if not isinstance(body, dict):
+            raise BadRequest("The request body must be a JSON object.")
+        if "documents" not in body:
+            return operation(body)
+        entries = body["documents"]
+        if not isinstance(entries, list):
+            raise BadRequest('"documents" must be a list.')
+        return {"results": list(self._pool.map(lambda entry: self._guarded(operation, entry), entries))}
+
+    def _guarded(self, operation, entry) -> Dict[str, Any]:
+        # One bad entry in a batch is reported in its place; the rest still run.
+        try:
+            return operation(entry)
+        except BadRequest as e:
+            return {"id": entry.get("id") if isinstance(entry, dict) else None, "error": str(e)}
+        except Exception as e:
+            logger.exception("Unhandled error for a batched document")
+            metrics.incr("errors", kind="unhandled", agent="server")
+            return {"id": entry.get("id") if isinstance(entry, dict) else None, "error": f"{type(e).__name__}: {e}"}
+
+    def interaction(self, interaction_id: str) -> Optional[Dict[str, Any]]:
+        return self.memory.get_context(interaction_id)
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "agents": sorted(self.agents.created()),
+            "memory": self.memory.stats(),
+        }
+
+    def close(self):
+        """Stops the worker threads and closes the sinks, memory, LLM cache and duplicate index."""
+        self._pool.shutdown()
+        for sink in self.sinks:
+            sink.close()
+        self.memory.close()
+        cache = self.agents.options.get("invoice_agent", {}).get("cache")
+        for resource in (cache, self.agents.duplicates):
+            if resource is not None:
+                resource.close()
+
+
+def _document(entry: Any) -> Document:
+    """
+    Builds a Document from a request entry: {"content": text} or
+    {"content_base64": bytes} (for PDFs and files of unknown encoding).
+    """
+    if not isinstance(entry, dict):
+        raise BadRequest("Each document must be a JSON object.")
+    if isinstance(entry.get("content"), str):
+        return Document(text=entry["content"])
+    if isinstance(entry.get("content_base64"), str):
+        try:
+            return Document(raw=base64.b64decode(entry["content_base64"], validate=True))
+        except binascii.Error as e:
+            raise BadRequest(f'"content_base64" is not valid base64: {e}') from None
+    raise BadRequest('A document needs a "content" string or a "content_base64" string.')
+
+
+def _response(entry: Dict[str, Any], interaction_id: str) -> Dict[str, Any]:
+    response = {"interaction_id": interaction_id}
+    if "id" in entry:
+        # The caller's own reference, echoed back to match batched results.
+        response["id"] = entry["id"]
+    return response
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service: InvoiceService = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            self._send_json(200, self.service.health())
+        elif url.path == "/metrics":
+            if parse_qs(url.query).get("format") == ["json"]:
+                self._send(200, metrics.export_json().encode("utf-8"), "application/json")
+            else:
+                self._send(200, metrics.export_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        elif url.path.startswith("/interactions/"):
+            context = self.service.interaction(url.path[len("/interactions/"):])
+            if context is None:
+                self._send_json(404, {"error": "Unknown interaction ID."})
+            else:
+                self._send_json(200, context)
+        else:
+            self._send_json(404, {"error": f"No such endpoint: {url.path}"})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        operations = {"/classify": self.service.classify, "/process": self.service.process}
+        if path not in operations:
+            self._send_json(404, {"error": f"No such endpoint: {path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self._send_json(400, {"error": "Content-Length must be a non-negative integer."})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json(413, {"error": f"Request bodies are limited to {MAX_BODY_BYTES} bytes."})
+            return
+        try:
+            with metrics.span("request", None, path.strip("/")):
+                body = json.loads(self.rfile.read(length) or b"null")
+                self._send_json(200, self.service.handle(operations[path], body))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            self._send_json(400, {"error": f"The request body is not valid JSON: {e}"})
+        except BadRequest as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.exception("Unhandled error serving %s", path)
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _send_json(self, status: int, payload: Any):
+        self._send(status, json.dumps(payload, default=to_jsonable).encode("utf-8"), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        metrics.incr("http_requests", route=_route(urlsplit(self.path).path), status=status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def _route(path: str) -> str:
+    """The fixed route name a request path is counted under, so unknown paths add no metric series."""
+    if path.startswith("/interactions/"):
+        return "interactions"
+    if path in ("/process", "/classify", "/metrics", "/health"):
+        return path[1:]
+    return "other"
+
+
+def make_server(service: InvoiceService, host: str = "127.0.0.1", port: int = 8080) -> ThreadingHTTPServer:
+    """Returns an HTTP server (one thread per connection) answering for `service`."""
+    handler = type("Handler", (_Handler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Serve invoice classification and processing over HTTP, with the agents kept warm."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Threads each batched request is spread over.")
+    parser.add_argument("--llm-cache", metavar="PATH", default=None,
+                        help="SQLite file caching LLM extractions across restarts.")
+    parser.add_argument("--llm-rate", type=float, default=None, metavar="PER_SECOND",
+                        help="LLM requests per second; 0 for no limit (default: $FLOW_LLM_RATE, or no limit).")
+    parser.add_argument("--memory-db", metavar="PATH", default=None,
+                        help="Persist shared memory to this SQLite file.")
+    parser.add_argument("--memory-entries", type=int, default=10_000,
+                        help="Interactions kept in memory for /interactions/<id> (in-process memory only).")
+    parser.add_argument("--format-model", metavar="PATH", default=None,
+                        help="Trained format model for documents the classification rules are unsure of.")
+    parser.add_argument("--dedup-index", metavar="PATH", default=None,
+                        help="SQLite index of documents already processed; copies are answered as duplicates.")
+    parser.add_argument("--sink", action="append", default=[], metavar="KIND:PATH",
+                        help="Write processed documents to a sink: sqlite:results.db, csv:DIR, parquet:DIR "
+                             "or jsonl:PATH. May be repeated.")
+    parser.add_argument("--flush-records", type=int, default=500,
+                        help="Results buffered before a sink writes them out.")
+    parser.add_argument("--flush-seconds", type=float, default=5.0,
+                        help="Seconds a buffered result may wait before its sink writes it out.")
+    args = parser.parse_args(argv)
+    try:
+        sinks = [open_sink(spec, batch_size=args.flush_records, flush_interval=args.flush_seconds)
+                 for spec in args.sink]
+    except (ValueError, ImportError, OSError) as e:
+        parser.error(str(e))
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    metrics.enabled = True
+
+    if args.memory_db:
+        shared_memory = SharedMemory(backend=SQLiteMemoryBackend(args.memory_db))
+    else:
+        shared_memory = SharedMemory(max_entries=args.memory_entries)
+    if args.llm_rate is not None:
+        set_rate(args.llm_rate)
+    model = FormatModel.load(args.format_model) if args.format_model else None
+    cache = ExtractionCache(args.llm_cache) if args.llm_cache else None
+    agents = AgentRegistry(shared_memory, options={
+        "classifier_agent": {"model": model},
+        "invoice_agent": {"cache": cache},
+    }, duplicates=DuplicateIndex(args.dedup_index) if args.dedup_index else None)
+    service = InvoiceService(agents, workers=args.workers, sinks=sinks)
+    service.warm()
+
+    server = make_server(service, args.host, args.port)
+    logger.info("Serving on http://%s:%d", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+# sinks.py
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from collections.abc import Mapping, Sequence
+from typing import Dict, Any, Iterable, List, Optional, TextIO, Tuple, Union
+
+from invoicerecord import invoice_fields, to_jsonable
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The flat tables every tabular sink writes: one row per processed document,
+# and one row per line item, joined on interaction_id.
+INVOICE_COLUMNS = (
+    "interaction_id", "file", "format", "agent", "invoice_number", "invoice_date",
+    "vendor", "customer", "total_amount", "currency", "line_item_count", "error", "duplicate_of",
+)
+LINE_ITEM_COLUMNS = ("interaction_id", "position", "description", "quantity", "unit_price", "amount", "tax")
+
+# Line item fields under the names each agent uses for them.
+_ITEM_FIELDS = {
+    "description": ("description", "product"),
+    "quantity": ("quantity", "qty"),
+    "unit_price": ("unit_price", "unitPrice"),
+    "amount": ("amount", "line_total"),
+    "tax": ("tax", "tax_amount"),
+}
+_NUMERIC = {"total_amount", "quantity", "unit_price", "amount", "tax"}
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _text(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, Mapping):
+        # A vendor or customer block: its name stands for it.
+        return _text(value.get("name") if "name" in value else value.get("Name"))
+    return str(value)
+
+
+def flatten(record: Dict[str, Any]) -> Tuple[tuple, List[tuple]]:
+    """
+    Flattens one result record (as batch.py and the server produce them) to
+    an INVOICE_COLUMNS row and its LINE_ITEM_COLUMNS rows.
+    """
+    results = record.get("results")
+    fields = invoice_fields(results)
+    items = fields.get("items")
+    if not isinstance(items, Sequence) or isinstance(items, str):
+        items = []
+    error = record.get("error")
+    if error is None and isinstance(results, Mapping):
+        error = results.get("error") or results.get("llm_error")
+    duplicate = results.get("duplicate") if isinstance(results, Mapping) else None
+    interaction_id = record.get("interaction_id")
+    invoice = (
+        interaction_id, record.get("file"), record.get("format"), record.get("agent"),
+        _text(fields.get("invoice_number")), _text(fields.get("invoice_date")),
+        _text(fields.get("vendor")), _text(fields.get("customer")),
+        _number(fields.get("total_amount")), _text(fields.get("currency")), len(items), _text(error),
+        duplicate.get("of") if isinstance(duplicate, Mapping) else None,
+    )
+    rows = []
+    for position, item in enumerate(items):
+        if not isinstance(item, Mapping):
+            continue
+        row = [interaction_id, position]
+        for column, names in _ITEM_FIELDS.items():
+            value = next((item[name] for name in names if name in item), None)
+            row.append(_number(value) if column in _NUMERIC else _text(value))
+        rows.append(tuple(row))
+    return invoice, rows
+
+
+class ResultSink:
+    def __init__(self, batch_size: int = 500, flush_interval: float = 5.0):
+        """
+        Where processed documents go. Records are buffered and written in
+        bulk, once `batch_size` are waiting or the oldest has waited
+        `flush_interval` seconds, so writing output is a cost per batch
+        rather than per document. Subclasses implement _write_batch.
+
+        Safe to call from several threads. A failed flush is raised from the
+        next write, flush or close.
+
+        Args:
+            batch_size: Buffered records that trigger a flush.
+            flush_interval: Seconds a record may wait before it is flushed,
+                from a timer, even when no more records arrive. None or 0
+                flushes on size and on close only.
+        """
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.name = type(self).__name__
+        self.flushes = 0
+        self.written = 0
+        self._pending = []
+        self._lock = threading.RLock()
+        self._timer = None
+        self._error = None
+        self._closed = False
+
+    def write(self, record: Dict[str, Any]):
+        """Buffers one result record: {"file", "interaction_id", "format", "agent", "results", ...}."""
+        with self._lock:
+            self._raise_error()
+            if self._closed:
+                raise ValueError(f"{self.name} is closed.")
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Writes every buffered record now."""
+        with self._lock:
+            self._raise_error()
+            self._flush()
+
+    def close(self):
+        """Flushes what is left and releases the sink's files or connections."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self.flush()
+            finally:
+                self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        with metrics.span("sink_flush", None, self.name):
+            self._write_batch(batch)
+        self.flushes += 1
+        self.written += len(batch)
+        metrics.incr("sink_records", len(batch), sink=self.name)
+        metrics.incr("sink_flushes", sink=self.name)
+
+    def _timed_flush(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # A flush since this timer was set already wrote its records.
+                return
+            self._timer = None
+            try:
+                self._flush()
+            except Exception as e:
+                logger.exception("%s failed to flush", self.name)
+                metrics.incr("errors", kind="sink_flush", agent=self.name)
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_batch(self, records: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class JSONLSink(ResultSink):
+    def __init__(self, target: Union[str, TextIO] = None, **options):
+        """
+        One JSON record per line, the format batch.py has always written.
+
+        Args:
+            target: A path (appended to) or an open text stream; stdout by
+                default. Streams passed in are flushed but not closed.
+            **options: batch_size and flush_interval, see ResultSink.
+        """
+        super().__init__(**options)
+        self._owned = isinstance(target, str)
+        self._out = open(target, "a", encoding="utf-8") if self._owned else (target or sys.stdout)
+
+    def _write_batch(self, records):
+        self._out.write("".join(json.dumps(record, default=to_jsonable) + "\n" for record in records))
+        self._out.flush()
+
+    def _close(self):
+        if self._owned:
+            self._out.close()
+
+
+class SQLiteSink(ResultSink):
+    def __init__(self, path: str = "results.sqlite3", **options):
+        """
+        Writes an `invoices` table (INVOICE_COLUMNS plus the full result as
+        JSON) and a `line_items` table, each batch in one transaction.
+        Re-writing an interaction replaces its rows.
+
+        Args:
+            path: The database file.
+            **options: batch_size and flush_interval, see ResultSink.
+        """
+        super().__init__(**options)
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS invoices ("
+            " interaction_id TEXT PRIMARY KEY,"
+            " file TEXT, format TEXT, agent TEXT,"
+            " invoice_number TEXT, invoice_date TEXT, vendor TEXT, customer TEXT,"
+            " total_amount REAL, currency TEXT, line_item_count INTEGER, error TEXT, duplicate_of TEXT,"
+            " result TEXT);"
+            "CREATE INDEX IF NOT EXISTS invoices_number ON invoices (invoice_number);"
+            "CREATE TABLE IF NOT EXISTS line_items ("
+            " interaction_id TEXT NOT NULL,"
+            " position INTEGER NOT NULL,"
+            " description TEXT, quantity REAL, unit_price REAL, amount REAL, tax REAL,"
+            " PRIMARY KEY (interaction_id, position));"
+        )
+
+    def _write_batch(self, records):
+        invoices = []
+        items = []
+        for record in records:
+            invoice, rows = flatten(record)
+            invoices.append(invoice + (json.dumps(record, default=to_jsonable),))
+            items.extend(rows)
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("DELETE FROM line_items WHERE interaction_id = ?",
+                             [(invoice[0],) for invoice in invoices])
+            conn.executemany(f"INSERT OR REPLACE INTO invoices VALUES ({', '.join('?' * (len(INVOICE_COLUMNS) + 1))})",
+                             invoices)
+            conn.executemany(f"INSERT INTO line_items VALUES ({', '.join('?' * len(LINE_ITEM_COLUMNS))})", items)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _close(self):
+        self._conn.close()
+
+
+class CSVSink(ResultSink):
+    def __init__(self, directory: str, **options):
+        """
+        Appends to invoices.csv and line_items.csv in `directory`, for
+        spreadsheets and analytics tools; the header is written once, when a
+        file is created.
+
+        Args:
+            directory: Created if missing.
+            **options: batch_size and flush_interval, see ResultSink.
+        """
+        super().__init__(**options)
+        os.makedirs(directory, exist_ok=True)
+        self._files = {}
+        self._writers = {}
+        for table, columns in (("invoices", INVOICE_COLUMNS), ("line_items", LINE_ITEM_COLUMNS)):
+            path = os.path.join(directory, f"{table}.csv")
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            self._files[table] = open(path, "a", encoding="utf-8", newline="")
+            self._writers[table] = csv.writer(self._files[table])
+            if new:
+                self._writers[table].writerow(columns)
+
+    def _write_batch(self, records):
+        invoices, items = _flatten_batch(records)
+        self._writers["invoices"].writerows(invoices)
+        self._writers["line_items"].writerows(items)
+        for f in self._files.values():
+            f.flush()
+
+    def _close(self):
+        for f in self._files.values():
+            f.close()
+
+
+class ParquetSink(ResultSink):
+    def __init__(self, directory: str, **options):
+        """
+        Writes invoices.parquet and line_items.parquet in `directory`, one
+        row group per flush; columnar, typed and compressed for analytics.
+        Needs pyarrow. The files are complete once the sink is closed, and
+        are replaced, not appended to, by the next run.
+
+        Args:
+            directory: Created if missing.
+            **options: batch_size and flush_interval, see ResultSink. Parquet
+                favours large row groups, so batch_size defaults to 10000.
+        """
+        # pyarrow is optional, and imported only when Parquet output is asked for.
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs the pyarrow package: pip install pyarrow") from None
+        options.setdefault("batch_size", 10_000)
+        super().__init__(**options)
+        self._pa = pyarrow
+        os.makedirs(directory, exist_ok=True)
+        string, double, int64 = pyarrow.string(), pyarrow.float64(), pyarrow.int64()
+        self._schemas = {
+            "invoices": pyarrow.schema([
+                (column, double if column == "total_amount" else int64 if column == "line_item_count" else string)
+                for column in INVOICE_COLUMNS
+            ]),
+            "line_items": pyarrow.schema([
+                (column, double if column in _NUMERIC else int64 if column == "position" else string)
+                for column in LINE_ITEM_COLUMNS
+            ]),
+        }
+        self._writers = {
+            table: pyarrow.parquet.ParquetWriter(os.path.join(directory, f"{table}.parquet"), schema)
+            for table, schema in self._schemas.items()
+        }
+
+    def _write_batch(self, records):
+        invoices, items = _flatten_batch(records)
+        for table, rows in (("invoices", invoices), ("line_items", items)):
+            if not rows:
+                continue
+            schema = self._schemas[table]
+            # Rows to columns: one array per column.
+            columns = [self._pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            self._writers[table].write_table(self._pa.Table.from_arrays(columns, schema=schema))
+
+    def _close(self):
+        for writer in self._writers.values():
+            writer.close()
+
+
+def _flatten_batch(records: Iterable[Dict[str, Any]]) -> Tuple[List[tuple], List[tuple]]:
+    invoices = []
+    items = []
+    for record in records:
+        invoice, rows = flatten(record)
+        invoices.append(invoice)
+        items.extend(rows)
+    return invoices, items
+
+
+SINKS = {"jsonl": JSONLSink, "sqlite": SQLiteSink, "csv": CSVSink, "parquet": ParquetSink}
+
+
+def open_sink(spec: str, **options) -> ResultSink:
+    """
+    Opens a sink from a "kind:target" spec, e.g. "sqlite:results.db",
+    "csv:exports/", "parquet:exports/" or "jsonl:results.jsonl" ("jsonl:-"
+    for stdout).
+
+    Args:
+        spec: The sink kind (one of SINKS) and its path.
+        **options: batch_size and flush_interval, see ResultSink.
+    """
+    kind, _, target = spec.partition(":")
+    if kind not in SINKS or not target:
+        raise ValueError(f"Sinks are given as KIND:PATH with KIND one of {', '.join(SINKS)}, not {spec!r}")
+    if kind == "jsonl" and target == "-":
+        target = None
+    return SINKS[kind](target, **options)